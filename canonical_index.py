@@ -0,0 +1,275 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Machine-readable index of the canonical attributes of the entities of a canonical tree.
+
+The index is written at the root of the tree, both as JSON Lines (canonical.jsonl, one record per entity, sorted by
+path) and as a SQLite database (canonical.sqlite, with entities, tags, licenses & sources tables), so that other tools
+don't need to parse every YAML file.
+
+The vocabulary of tags of all entities (canonical-tags.json), with the number of entities & the sources of each tag,
+is computed in the same pass.
+
+While a tree is generated, only the summaries of the records (without the canonical attributes that links & indexes
+don't need, like descriptions) are kept in memory. The full records of the entities generated during the run are
+spooled to a scratch database, and the index is streamed in path order, from this spool and from the previous index.
+"""
+
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+
+
+index_jsonl_filename = 'canonical.jsonl'
+index_sqlite_filename = 'canonical.sqlite'
+# Canonical attributes kept in the summaries of records, and the ones among them set by links
+link_fields = ('tools', 'usedByProjects')
+summary_fields = ('license', 'name', 'tags') + link_fields
+tags_filename = 'canonical-tags.json'
+
+
+class RecordSpool:
+    """Scratch SQLite database of the full records of the entities generated during a run."""
+    def __init__(self):
+        self.scratch_dir = tempfile.TemporaryDirectory(prefix='canonical-index-')
+        self.connection = sqlite3.connect(os.path.join(self.scratch_dir.name, 'records.sqlite'))
+        self.connection.execute('CREATE TABLE records (path TEXT PRIMARY KEY, record TEXT NOT NULL)')
+
+    def add(self, record):
+        """Spool the full record of an entity and return its summary."""
+        self.connection.execute('INSERT OR REPLACE INTO records VALUES (?, ?)', (record['path'], dump_record(record)))
+        return summarize_record(record)
+
+    def close(self):
+        self.connection.close()
+        self.scratch_dir.cleanup()
+
+    def iter_records(self):
+        """Iterate over the spooled records, sorted by path."""
+        for record_json, in self.connection.execute('SELECT record FROM records ORDER BY path'):
+            yield json.loads(record_json)
+
+
+def dump_record(record):
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+
+def intern_record(record):
+    """Share the strings that repeat across records (keys, types, sources & tags) and return the record."""
+    record = intern_value(record)
+    record['type'] = sys.intern(record['type'])
+    record['sources'] = [sys.intern(source) for source in record['sources']]
+    for tags in record['canonical'].get('tags', {}).values():
+        for tag in tags:
+            tag['value'] = sys.intern(tag['value'])
+    return record
+
+
+def intern_value(value):
+    if isinstance(value, dict):
+        return {
+            sys.intern(key): sys.intern(item) if key == 'source' else intern_value(item)
+            for key, item in value.items()
+            }
+    if isinstance(value, list):
+        return [
+            sys.intern(item) if isinstance(item, str) else intern_value(item)
+            for item in value
+            ]
+    return value
+
+
+def iter_full_records(dir, record_by_relative_path, spool):
+    """Iterate over the full records of the entities of record_by_relative_path, sorted by path.
+
+    Each record comes from spool, or else from the previous index of dir, and gets the links of its summary.
+    """
+    previous_records = iter_records(dir) if os.path.exists(os.path.join(dir, index_jsonl_filename)) else iter(())
+    spooled_records = spool.iter_records()
+    previous_record = next(previous_records, None)
+    spooled_record = next(spooled_records, None)
+    for relative_path, summary in sorted(record_by_relative_path.items()):
+        while spooled_record is not None and spooled_record['path'] < relative_path:
+            spooled_record = next(spooled_records, None)
+        while previous_record is not None and previous_record['path'] < relative_path:
+            previous_record = next(previous_records, None)
+        if spooled_record is not None and spooled_record['path'] == relative_path:
+            record = spooled_record
+        elif previous_record is not None and previous_record['path'] == relative_path:
+            record = previous_record
+        else:
+            continue
+        canonical = record['canonical']
+        for field in link_fields:
+            if field in summary['canonical']:
+                canonical[field] = summary['canonical'][field]
+            else:
+                canonical.pop(field, None)
+        yield record
+
+
+def iter_records(dir):
+    """Iterate over the records of the index of dir, sorted by path."""
+    with open(os.path.join(dir, index_jsonl_filename), encoding='utf-8') as index_file:
+        for line in index_file:
+            yield json.loads(line)
+
+
+def load_record_by_relative_path(dir):
+    """Return the summaries of the records of the index of dir by relative path, or an empty dict when it doesn't exist
+    yet.
+    """
+    if not os.path.exists(os.path.join(dir, index_jsonl_filename)):
+        return {}
+    return {
+        record['path']: summarize_record(record)
+        for record in iter_records(dir)
+        }
+
+
+def make_record(entity_type, relative_path, entry):
+    """Return the index record of an entity, once its canonical attributes have been added."""
+    if not isinstance(entry, dict):
+        # Empty YAML file
+        entry = {}
+    return dict(
+        canonical = entry.get('canonical', {}),
+        name = os.path.splitext(os.path.basename(relative_path))[0],
+        path = relative_path,
+        sources = sorted(source for source in entry if source != 'canonical'),
+        type = entity_type,
+        )
+
+
+def save_index(dir, record_by_relative_path, spool, stats=None):
+    """Write the JSON Lines & SQLite indexes and the vocabulary of tags of dir, for the entities of
+    record_by_relative_path, streaming their full records (see iter_full_records). Each file is replaced atomically.
+
+    When stats (a collections.Counter) is given, it counts the distinct tags and their uses.
+    """
+    # Entities count & entities count by source of each tag, by language
+    vocabulary_by_language = {}
+
+    jsonl_path = os.path.join(dir, index_jsonl_filename)
+    sqlite_path = os.path.join(dir, index_sqlite_filename)
+    if os.path.exists(sqlite_path + '.tmp'):
+        os.remove(sqlite_path + '.tmp')
+    connection = sqlite3.connect(sqlite_path + '.tmp')
+    connection.executescript('''
+        CREATE TABLE entities (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL UNIQUE,
+            display_name TEXT,
+            canonical TEXT NOT NULL
+            );
+        CREATE TABLE licenses (entity_id INTEGER NOT NULL REFERENCES entities, value TEXT NOT NULL, source TEXT);
+        CREATE TABLE sources (entity_id INTEGER NOT NULL REFERENCES entities, source TEXT NOT NULL);
+        CREATE TABLE tags (
+            entity_id INTEGER NOT NULL REFERENCES entities,
+            language TEXT NOT NULL,
+            value TEXT NOT NULL,
+            sources TEXT NOT NULL
+            );
+        ''')
+    with open(jsonl_path + '.tmp', 'w', encoding='utf-8') as index_file:
+        for entity_id, record in enumerate(iter_full_records(dir, record_by_relative_path, spool), 1):
+            index_file.write(dump_record(record))
+            index_file.write('\n')
+            canonical = record['canonical']
+            connection.execute('INSERT INTO entities VALUES (?, ?, ?, ?, ?, ?)', (
+                entity_id,
+                record['type'],
+                record['name'],
+                record['path'],
+                canonical.get('name', {}).get('value'),
+                json.dumps(canonical, ensure_ascii=False, sort_keys=True),
+                ))
+            license = canonical.get('license')
+            if license is not None:
+                connection.execute('INSERT INTO licenses VALUES (?, ?, ?)', (entity_id, license['value'],
+                    license['source']))
+            connection.executemany('INSERT INTO sources VALUES (?, ?)', [
+                (entity_id, source)
+                for source in record['sources']
+                ])
+            connection.executemany('INSERT INTO tags VALUES (?, ?, ?, ?)', [
+                (entity_id, language, tag['value'], ','.join(tag['sources']))
+                for language, tags in sorted(canonical.get('tags', {}).items())
+                for tag in tags
+                ])
+            for language, tags in canonical.get('tags', {}).items():
+                vocabulary = vocabulary_by_language.setdefault(language, {})
+                for tag in tags:
+                    tag_stats = vocabulary.get(tag['value'])
+                    if tag_stats is None:
+                        tag_stats = vocabulary[tag['value']] = dict(
+                            count = 0,
+                            sources = {},
+                            )
+                    tag_stats['count'] += 1
+                    for source in tag['sources']:
+                        tag_stats['sources'][source] = tag_stats['sources'].get(source, 0) + 1
+    connection.execute('CREATE TABLE tags_vocabulary (language TEXT NOT NULL, value TEXT NOT NULL,'
+        ' count INTEGER NOT NULL, PRIMARY KEY (language, value))')
+    connection.executemany('INSERT INTO tags_vocabulary VALUES (?, ?, ?)', [
+        (language, value, tag_stats['count'])
+        for language, vocabulary in sorted(vocabulary_by_language.items())
+        for value, tag_stats in sorted(vocabulary.items())
+        ])
+    connection.executescript('''
+        CREATE INDEX entities_type_name ON entities (type, name);
+        CREATE INDEX licenses_value ON licenses (value);
+        CREATE INDEX sources_source ON sources (source);
+        CREATE INDEX tags_value ON tags (value, language);
+        ''')
+    connection.commit()
+    connection.close()
+    os.replace(jsonl_path + '.tmp', jsonl_path)
+    os.replace(sqlite_path + '.tmp', sqlite_path)
+
+    tags_path = os.path.join(dir, tags_filename)
+    with open(tags_path + '.tmp', 'w', encoding='utf-8') as tags_file:
+        json.dump(vocabulary_by_language, tags_file, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tags_path + '.tmp', tags_path)
+    if stats is not None:
+        for vocabulary in vocabulary_by_language.values():
+            stats['tags_distinct'] += len(vocabulary)
+            stats['tags_uses'] += sum(tag_stats['count'] for tag_stats in vocabulary.values())
+
+
+def summarize_record(record):
+    """Return the summary of a record: the record without the canonical attributes that links & indexes don't need."""
+    canonical = record['canonical']
+    return intern_record(dict(
+        canonical = {
+            field: canonical[field]
+            for field in summary_fields
+            if field in canonical
+            },
+        name = record['name'],
+        path = record['path'],
+        sources = record['sources'],
+        type = record['type'],
+        ))
@@ -0,0 +1,147 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Links between the canonical attributes of entities: projects → tools and tools → projects.
+
+The free-text names of the canonical tools of a project are resolved to tool entities using a name index of tools
+(exact, case-folded, then slugified names). Each resolved tool gets the unique name of the tool, and each tool gets
+the list of projects using it (canonical usedByProjects).
+
+Links are computed from the summaries of the records of the canonical index, once every entity has been
+canonicalized. To write each file once, the canonical attributes of a regenerated entity are first given the links of
+its previous record: only the entities whose links really changed are loaded again, patched & rewritten.
+"""
+
+
+import copy
+import logging
+import os
+
+from slugify import slugify
+
+import canonical_index
+import entity_tree
+import yaml_io
+
+
+log = logging.getLogger(__name__)
+
+
+def copy_links(canonical, previous_canonical):
+    """Give the canonical attributes of an entity the links of its previous canonical attributes and return them."""
+    if not previous_canonical:
+        return canonical
+    tool_name_by_value = {
+        tool['value']: tool['name']
+        for tool in previous_canonical.get('tools', [])
+        if 'name' in tool
+        }
+    for tool in canonical.get('tools', []):
+        name = tool_name_by_value.get(tool['value'])
+        if name is not None:
+            tool['name'] = name
+    used_by_projects = previous_canonical.get('usedByProjects')
+    if used_by_projects is not None:
+        canonical['usedByProjects'] = copy.deepcopy(used_by_projects)
+    return canonical
+
+
+def get_display_name(record):
+    return record['canonical'].get('name', {}).get('value') or record['name']
+
+
+def link_entities(dir, record_by_relative_path, manifest, stats=None):
+    """Add links to the canonical attributes of the entities of dir, rewriting the entities whose links changed.
+
+    The record summaries of the patched entities are updated. Return the number of patched entities.
+    """
+    linked_canonical_by_relative_path = make_linked_canonical_by_relative_path(record_by_relative_path)
+    patched_count = 0
+    for relative_path, linked_canonical in sorted(linked_canonical_by_relative_path.items()):
+        record = record_by_relative_path[relative_path]
+        if record['canonical'] == linked_canonical:
+            continue
+        path = os.path.join(dir, relative_path)
+        entry = yaml_io.load_file(path)
+        canonical = entry.get('canonical') or {}
+        for field in canonical_index.link_fields:
+            if field in linked_canonical:
+                canonical[field] = linked_canonical[field]
+            else:
+                canonical.pop(field, None)
+        if canonical:
+            entry['canonical'] = canonical
+        else:
+            entry.pop('canonical', None)
+        entity_tree.write_if_changed(dir, relative_path, yaml_io.dumps(entry), manifest)
+        record['canonical'] = linked_canonical
+        patched_count += 1
+    if stats is not None:
+        stats['entities_linked'] += patched_count
+    return patched_count
+
+
+def make_linked_canonical_by_relative_path(record_by_relative_path):
+    """Return the canonical attributes, with their links, of the projects & tools of the index."""
+    tool_relative_path_by_key_by_kind = dict(
+        casefold = {},
+        exact = {},
+        slug = {},
+        )
+    for relative_path, record in sorted(record_by_relative_path.items()):
+        if record['type'] != 'tools' or not record['sources']:
+            # Empty entities can't be linked.
+            continue
+        # When several tools share a key, the first one (by path) wins.
+        for name in (get_display_name(record), record['name']):
+            tool_relative_path_by_key_by_kind['exact'].setdefault(name, relative_path)
+            tool_relative_path_by_key_by_kind['casefold'].setdefault(name.casefold(), relative_path)
+            tool_relative_path_by_key_by_kind['slug'].setdefault(slugify(name), relative_path)
+
+    linked_canonical_by_relative_path = {}
+    projects_by_tool_relative_path = {}
+    for relative_path, record in sorted(record_by_relative_path.items()):
+        if record['type'] == 'tools':
+            canonical = copy.deepcopy(record['canonical'])
+            canonical.pop('usedByProjects', None)
+            linked_canonical_by_relative_path[relative_path] = canonical
+        elif record['type'] == 'projects':
+            canonical = copy.deepcopy(record['canonical'])
+            for tool in canonical.get('tools', []):
+                tool.pop('name', None)
+                value = tool['value']
+                tool_relative_path = tool_relative_path_by_key_by_kind['exact'].get(value) \
+                    or tool_relative_path_by_key_by_kind['casefold'].get(value.casefold()) \
+                    or tool_relative_path_by_key_by_kind['slug'].get(slugify(value))
+                if tool_relative_path is None:
+                    continue
+                tool['name'] = record_by_relative_path[tool_relative_path]['name']
+                projects_by_tool_relative_path.setdefault(tool_relative_path, {})[record['name']] = \
+                    get_display_name(record)
+            linked_canonical_by_relative_path[relative_path] = canonical
+    for tool_relative_path, project_display_name_by_name in projects_by_tool_relative_path.items():
+        linked_canonical_by_relative_path[tool_relative_path]['usedByProjects'] = [
+            dict(
+                name = name,
+                value = display_name,
+                )
+            for name, display_name in sorted(project_display_name_by_name.items())
+            ]
+    return linked_canonical_by_relative_path
@@ -0,0 +1,347 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Rules computing the canonical attributes of merged entities from the data of their sources.
+
+Each rule of a field has a kind:
+* first: the first (stripped, non empty) value found in its paths, in order of priority
+* first_by_language: the same, for each language yielded by the extractors of its paths
+* union: all the values (in English or without language) found in its paths, with their sources
+* union_by_language: all the values found in its paths, with their sources, for each language
+
+The rules are compiled once into a plan that groups their paths by source, so that the data of each source of an
+entity is visited once.
+"""
+
+
+import collections
+import functools
+import sys
+import time
+
+import item_path
+
+
+# Extractors
+
+
+def extract_from_list(language, value):
+    if value is not None:
+        for item in value:
+            yield language, item
+
+
+def extract_from_name_id(value):
+    if value is not None:
+        name = value['name']
+        if isinstance(name, str):
+            yield 'en', name
+        else:
+            yield from extract_from_value_by_language(name)
+
+
+def extract_from_name_id_list(value):
+    if value is not None:
+        for item in value:
+            yield from extract_from_name_id(item)
+
+
+def extract_from_singletion_or_list(language, value):
+    if value is not None:
+        if isinstance(value, list):
+            for item in value:
+                yield language, item
+        else:
+            yield language, value
+
+
+def extract_from_value(language, value):
+    if value is not None:
+        yield language, value
+
+
+def extract_from_value_by_language(value):
+    if value is not None:
+        yield from value.items()
+
+
+def extract_from_wikidata(value):
+    if value is not None:
+        for item in value:
+            yield item.get('xml:lang'), item['value']
+
+
+# Rules
+
+
+en = functools.partial(extract_from_value, 'en')
+fr = functools.partial(extract_from_value, 'fr')
+
+
+rules_by_entity_type = collections.OrderedDict([
+    ('actors', (
+        # Lowercase version of this name is the unique name of the actor and the slugified version of this unique name
+        # is the file name for the actor.
+        dict(field = 'name', kind = 'first', paths = (
+            'civic-graph.name',
+            )),
+        # Description of the actor, for each supported language, in a map indexed by the two letter (ISO-639-1)
+        # language code
+        dict(field = 'longDescription', kind = 'first_by_language', paths = (
+            ('civic-graph.description', en),
+            )),
+        dict(field = 'tags', kind = 'union_by_language', paths = (
+            ('civic-graph.categories', extract_from_name_id_list),
+            ('civic-graph.type', en),
+            )),
+        dict(field = 'website', kind = 'first', paths = (
+            'civic-graph.url',
+            )),
+        )),
+    ('projects', (
+        # Lowercase version of this name is the unique name of the project and the slugified version of this unique
+        # name is the file name for the project.
+        dict(field = 'name', kind = 'first', paths = (
+            'participatedb.Name',
+            )),
+        # Description of the project, for each supported language, in a map indexed by the two letter (ISO-639-1)
+        # language code
+        dict(field = 'longDescription', kind = 'first_by_language', paths = (
+            ('participatedb.Description', en),
+            )),
+        dict(field = 'tags', kind = 'union_by_language', paths = (
+            ('participatedb.Category', functools.partial(extract_from_singletion_or_list, 'en')),
+            ('participatedb.category', en),
+            )),
+        dict(field = 'tools', kind = 'union', paths = (
+            ('participatedb.Tools used', functools.partial(extract_from_list, None)),
+            )),
+        dict(field = 'website', kind = 'first', paths = (
+            'participatedb.Web',
+            )),
+        )),
+    ('tools', (
+        # URL of the service where bugs related to the tool can be reported
+        dict(field = 'bugTracker', kind = 'first', paths = (
+            'wikidata.bug_tracking_system.0.value',
+            'ogptoolbox-framacalc.URL suivi de bogues',
+            )),
+        # Name of the license governing the tool.
+        dict(field = 'license', kind = 'first', paths = (
+            'wikidata.license_label.0.value',
+            'civicstack.license.name.en',
+            'nuit-debout.Nom de la licence',
+            'ogptoolbox-framacalc.Licence',
+            )),
+        # Lowercase version of this name is the unique name of the tool and the slugified version of this unique name
+        # is the file name for the tool.
+        dict(field = 'name', kind = 'first', paths = (
+            'debian_appstream.Name.C',
+            'wikidata.label.0.value',
+            'civic-tech-field-guide.name',
+            'civicstack.name',
+            'tech-plateforms.Name',
+            'nuit-debout.Outil',
+            'participatedb.Name',
+            'harnessing-collaborative-technologies.title',
+            'ogptoolbox-framacalc.Nom',
+            )),
+        # Description of the tool, for each supported language, in a map indexed by the two letter (ISO-639-1)
+        # language code
+        dict(field = 'longDescription', kind = 'first_by_language', paths = (
+            ('wikidata.description', extract_from_wikidata),
+            ('debian.description.en.long_description', en),
+            ('debian.description.es.long_description', functools.partial(extract_from_value, 'es')),
+            ('debian.description.fr.long_description', fr),
+            ('civicstack.description', extract_from_value_by_language),
+            ('tech-plateforms.About', en),
+            ('participatedb.Description', en),
+            ('harnessing-collaborative-technologies.description', en),
+            ('nuit-debout.Détails', fr),
+            ('ogptoolbox-framacalc.Description', fr),
+            )),
+        dict(field = 'programmingLanguages', kind = 'union', paths = (
+            ('civicstack.technology', extract_from_name_id_list),
+            )),
+        # The URL of a screenshot displaying the tool user interface
+        dict(field = 'screenshot', kind = 'first', paths = (
+            'debian.screenshot.large_image_url',
+            'wikidata.image.0.value',
+            "ogptoolbox-framacalc.Capture d'écran",
+            'harnessing-collaborative-technologies.logo_url',
+            )),
+        # URL from which the source code of the tool can be obtained.
+        dict(field = 'sourceCode', kind = 'first', paths = (
+            'wikidata.source_code_repository.0.value',
+            'civicstack.github',
+            'nuit-debout.Lien vers le code',
+            'ogptoolbox-framacalc.URL code source',
+            )),
+        # Tag from http://stackexchange.org/ uniquely associated with the tool.
+        dict(field = 'stackexchangeTag', kind = 'first', paths = (
+            'wikidata.stack_exchange_tag.0.value',
+            'ogptoolbox-framacalc.Tag stack exchange',
+            )),
+        dict(field = 'tags', kind = 'union_by_language', paths = (
+            ('civic-tech-field-guide.category', en),
+            # ('civicstack.category', extract_from_name_id),
+            ('civicstack.tags', extract_from_name_id_list),
+            ('debian_appstream.Categories', functools.partial(extract_from_list, 'en')),
+            ('harnessing-collaborative-technologies.category', en),
+            ('nuit-debout.Fonction', fr),
+            ('ogptoolbox-framacalc.Catégorie', fr),
+            ('participatedb.Category', functools.partial(extract_from_singletion_or_list, 'en')),
+            ('participatedb.category', en),
+            ('tech-plateforms.CivicTech or GeneralPurpose', en),
+            ('tech-plateforms.Functions', en),
+            ('tech-plateforms.AppCivist Service 1', en),
+            ('tech-plateforms.AppCivist Service 2', en),
+            ('tech-plateforms.AppCivist Service 3', en),
+            ('wikidata.genre_label', extract_from_wikidata),
+            ('wikidata.instance_of_label', extract_from_wikidata),
+            )),
+        )),
+    ])
+
+
+# Engine
+
+
+RulePath = collections.namedtuple('RulePath', ['field', 'kind', 'priority', 'path', 'accessor', 'extractor'])
+
+
+def compile_rules(rules):
+    """Return the plan of rules: their paths grouped by source, as RulePath tuples whose accessor is relative to the
+    data of the source.
+    """
+    rule_paths_by_source = collections.OrderedDict()
+    for rule in rules:
+        for priority, path in enumerate(rule['paths']):
+            extractor = None
+            if isinstance(path, tuple):
+                path, extractor = path
+            source, _, relative_path = path.partition('.')
+            rule_paths_by_source.setdefault(source, []).append(RulePath(
+                field = rule['field'],
+                kind = rule['kind'],
+                priority = priority,
+                path = path,
+                accessor = item_path.compile_path(relative_path),
+                extractor = extractor,
+                ))
+    return rule_paths_by_source
+
+
+plan_by_entity_type = collections.OrderedDict(
+    (entity_type, compile_rules(rules))
+    for entity_type, rules in rules_by_entity_type.items()
+    )
+
+
+def canonicalize(entity_type, entry, stats=None):
+    """Return the canonical attributes of an entity.
+
+    When stats (a collections.Counter) is given, it counts the hits (contributed values) and the evaluation time of
+    each rule path, under the "rule <field> <path> hits|seconds" keys.
+    """
+    canonical = collections.OrderedDict()
+    if not isinstance(entry, dict):
+        # Empty YAML file
+        return canonical
+    best_by_field_language = {}
+    sources_by_value_by_field_language = {}
+    for source, rule_paths in plan_by_entity_type[entity_type].items():
+        source_data = entry.get(source)
+        if source_data is None:
+            continue
+        for rule_path in rule_paths:
+            if stats is not None:
+                start_time = time.perf_counter()
+            hits = 0
+            kind = rule_path.kind
+            if kind == 'first':
+                best = best_by_field_language.get((rule_path.field, None))
+                value = rule_path.accessor.get(source_data) if best is None or rule_path.priority < best[0] else None
+                if value is not None:
+                    assert isinstance(value, str), (rule_path.path, value)
+                    value = value.strip()
+                    if value:
+                        best_by_field_language[(rule_path.field, None)] = (rule_path.priority, source, value)
+                        hits += 1
+            else:
+                value = rule_path.accessor.get(source_data)
+                for language, item in rule_path.extractor(value):
+                    assert isinstance(item, str), (rule_path.path, language, item, value)
+                    if kind == 'union':
+                        if language not in (None, 'en'):
+                            continue
+                        language = None
+                    elif language is None:
+                        continue
+                    if item is None:
+                        continue
+                    item = item.strip()
+                    if not item:
+                        continue
+                    hits += 1
+                    if kind == 'first_by_language':
+                        best = best_by_field_language.get((rule_path.field, language))
+                        if best is None or rule_path.priority < best[0]:
+                            best_by_field_language[(rule_path.field, language)] = (rule_path.priority, source, item)
+                    else:
+                        # Values of unions (tags, programming languages...) repeat across entities: share them.
+                        sources_by_value_by_field_language.setdefault((rule_path.field, language), {}).setdefault(
+                            sys.intern(item), set()).add(source)
+            if stats is not None:
+                key = 'rule {} {}'.format(rule_path.field, rule_path.path)
+                stats[key + ' hits'] += hits
+                stats[key + ' seconds'] += time.perf_counter() - start_time
+
+    for (field, language), (priority, source, value) in best_by_field_language.items():
+        canonical_value = dict(
+            source = source,
+            value = value,
+            )
+        if language is None:
+            canonical[field] = canonical_value
+        else:
+            canonical.setdefault(field, {})[language] = canonical_value
+    for (field, language), sources_by_value in sources_by_value_by_field_language.items():
+        canonical_values = [
+            dict(
+                sources = sorted(sources),
+                value = value,
+                )
+            for value, sources in sorted(sources_by_value.items())
+            ]
+        if language is None:
+            canonical[field] = canonical_values
+        else:
+            canonical.setdefault(field, {})[language] = canonical_values
+    return canonical
+
+
+def iter_rule_stats_keys(entity_type):
+    """Iterate over the keys of the statistics of the rules of an entity type, including the rules that never hit."""
+    for rule_paths in plan_by_entity_type[entity_type].values():
+        for rule_path in rule_paths:
+            key = 'rule {} {}'.format(rule_path.field, rule_path.path)
+            yield key + ' hits'
+            yield key + ' seconds'
@@ -21,251 +21,316 @@
 # along with this program.  If not, see <http:>www.gnu.org/licenses/>.
 
 
-"""Convert directory of YAML files containing canonical informations to a single CSV file (with only canonical data)."""
+"""Convert directory of YAML files containing canonical informations to CSV, JSON Lines & SQLite files (with only
+canonical data), one file of each format by entity type.
+
+Entities are streamed: a first pass over the canonical index (canonical.jsonl, when it exists) or over the YAML files
+computes the number of tag & tool columns and the order of the rows, keeping only the name and the location of each
+entity. A second pass, for each entity type (in parallel with --jobs), loads the entities again, one at a time, in
+this order and writes them in every requested format.
+"""
 
 
 import argparse
 import collections
 import csv
+import json
 import logging
+import multiprocessing
 import os
+import sqlite3
 import sys
 
-import yaml, yaml.constructor, yaml.parser, yaml.scanner
-
-
-# YAML configuration
+import canonical_index
+import item_path
+import yaml_io
 
 
-class folded_str(str):
-    pass
-
-
-class literal_str(str):
-    pass
+#
 
 
-def dict_constructor(loader, node):
-    return collections.OrderedDict(loader.construct_pairs(node))
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+args = None
+# Columns of each entity type: (header, field, path) triplets of the single-valued columns, then of the multi-valued
+# columns (one CSV column per value, as many as the maximum number of values of an entity). A path containing
+# "{language}" gives a column for each requested language.
+columns_by_entity_type = collections.OrderedDict([
+    ('actors', dict(
+        multi_valued = (
+            ('Tag', 'tags', 'tags.{language}'),
+            ),
+        single_valued = (
+            ('Name', 'name', 'name.value'),
+            ('Description', 'longDescription', 'longDescription.{language}.value'),
+            ('Website', 'website', 'website.value'),
+            ),
+        )),
+    ('projects', dict(
+        multi_valued = (
+            ('Tag', 'tags', 'tags.{language}'),
+            ('Tool', 'tools', 'tools'),
+            ),
+        single_valued = (
+            ('Name', 'name', 'name.value'),
+            ('Description', 'longDescription', 'longDescription.{language}.value'),
+            ('Website', 'website', 'website.value'),
+            ),
+        )),
+    ('tools', dict(
+        multi_valued = (
+            ('Tag', 'tags', 'tags.{language}'),
+            ),
+        single_valued = (
+            ('Name', 'name', 'name.value'),
+            ('Description', 'longDescription', 'longDescription.{language}.value'),
+            ('License', 'license', 'license.value'),
+            ('Source Code URL', 'sourceCode', 'sourceCode.value'),
+            ('Bug Tracker URL', 'bugTracker', 'bugTracker.value'),
+            ('Screenshot URL', 'screenshot', 'screenshot.value'),
+            ('StackExchange Tag', 'stackexchangeTag', 'stackexchangeTag.value'),
+            ),
+        )),
+    ])
+supported_formats = ('csv', 'jsonl', 'sqlite')
+log = logging.getLogger(app_name)
 
 
-def dict_representer(dumper, data):
-    return dumper.represent_dict(sorted(data.items()))
+Column = collections.namedtuple('Column', ['header', 'field', 'language', 'path'])
+
+
+def expand_columns(columns, languages):
+    """Return the Column tuples of (header, field, path) triplets, with a column for each language of the per-language
+    paths. Headers are suffixed with their language only when several languages are requested.
+    """
+    expanded_columns = []
+    for header, field, path in columns:
+        if '{language}' not in path:
+            expanded_columns.append(Column(header, field, None, path))
+            continue
+        for language in languages:
+            expanded_columns.append(Column(
+                header if len(languages) == 1 else '{} ({})'.format(header, language),
+                field,
+                language,
+                path.format(language = language),
+                ))
+    return expanded_columns
+
+
+def export_entity_type(task):
+    """Write the files of an entity type, loading its entities in the order of keys. Return the number of entities."""
+    entity_type, keys, values_count, index_path, target_dir, formats, languages = task
+    columns = columns_by_entity_type[entity_type]
+    single_valued_columns = expand_columns(columns['single_valued'], languages)
+    multi_valued_columns = expand_columns(columns['multi_valued'], languages)
+    csv_file = jsonl_file = connection = index_file = None
+    try:
+        if index_path is not None:
+            index_file = open(index_path, 'rb')
+        if 'csv' in formats:
+            csv_file = open(os.path.join(target_dir, '{}.csv'.format(entity_type)), 'w')
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow([
+                column.header
+                for column in single_valued_columns
+                ] + [
+                column.header
+                for column, count in zip(multi_valued_columns, values_count)
+                for index in range(count)
+                ])
+        if 'jsonl' in formats:
+            jsonl_path = os.path.join(target_dir, '{}.jsonl'.format(entity_type))
+            jsonl_file = open(jsonl_path + '.tmp', 'w', encoding='utf-8')
+        if 'sqlite' in formats:
+            sqlite_path = os.path.join(target_dir, '{}.sqlite'.format(entity_type))
+            if os.path.exists(sqlite_path + '.tmp'):
+                os.remove(sqlite_path + '.tmp')
+            connection = sqlite3.connect(sqlite_path + '.tmp')
+            connection.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY, {})'.format(entity_type, ', '.join(
+                '"{}" TEXT'.format(get_sql_name(column))
+                for column in single_valued_columns
+                )))
+            for column in multi_valued_columns:
+                connection.execute('CREATE TABLE "{}_{}" (entity_id INTEGER NOT NULL REFERENCES {}, position INTEGER'
+                    ' NOT NULL, value TEXT NOT NULL)'.format(entity_type, get_sql_name(column), entity_type))
+            insert_entity_sql = 'INSERT INTO {} VALUES ({})'.format(entity_type,
+                ', '.join(['?'] * (len(single_valued_columns) + 1)))
+
+        for entity_id, (name, location) in enumerate(keys, 1):
+            canonical = load_canonical(location, index_file)
+            single_values = [
+                get_path(canonical, column.path)
+                for column in single_valued_columns
+                ]
+            multi_values = [
+                [
+                    item['value']
+                    for item in get_path(canonical, column.path, [])
+                    ]
+                for column in multi_valued_columns
+                ]
+            if csv_file is not None:
+                row = [
+                    value or ''
+                    for value in single_values
+                    ]
+                for values, count in zip(multi_values, values_count):
+                    row.extend(values + [''] * (count - len(values)))
+                csv_writer.writerow(row)
+            if jsonl_file is not None:
+                entry = collections.OrderedDict()
+                for column, value in zip(single_valued_columns, single_values):
+                    if value is not None:
+                        set_entry_value(entry, column, value)
+                for column, values in zip(multi_valued_columns, multi_values):
+                    if values:
+                        set_entry_value(entry, column, values)
+                jsonl_file.write(json.dumps(entry, ensure_ascii=False))
+                jsonl_file.write('\n')
+            if connection is not None:
+                connection.execute(insert_entity_sql, [entity_id] + single_values)
+                for column, values in zip(multi_valued_columns, multi_values):
+                    connection.executemany('INSERT INTO "{}_{}" VALUES (?, ?, ?)'.format(entity_type,
+                        get_sql_name(column)), [
+                        (entity_id, position, value)
+                        for position, value in enumerate(values)
+                        ])
+    finally:
+        for file in (csv_file, jsonl_file, index_file):
+            if file is not None:
+                file.close()
+        if connection is not None:
+            connection.commit()
+            connection.close()
+    if jsonl_file is not None:
+        os.replace(jsonl_path + '.tmp', jsonl_path)
+    if connection is not None:
+        os.replace(sqlite_path + '.tmp', sqlite_path)
+    return len(keys)
 
 
-yaml.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
+def get_path(item, path, default=None):
+    return item_path.compile_path(path).get(item, default=default)
 
-yaml.add_representer(folded_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='>'))
-yaml.add_representer(literal_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='|'))
-yaml.add_representer(collections.OrderedDict, dict_representer)
-yaml.add_representer(str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str', data))
 
+def get_sql_name(column):
+    return column.field if column.language is None else '{}_{}'.format(column.field, column.language)
 
-#
 
+def iter_canonicals(source_dir, index_file=None):
+    """Iterate over the (entity type, relative path, location, canonical attributes) of the entities of source_dir.
 
-app_name = os.path.splitext(os.path.basename(__file__))[0]
-args = None
-log = logging.getLogger(app_name)
+    The location of an entity is its offset in the index file when it is given, or the path of its YAML file. Both
+    sort like the relative paths.
+    """
+    if index_file is not None:
+        index_file.seek(0)
+        while True:
+            offset = index_file.tell()
+            line = index_file.readline()
+            if not line:
+                break
+            record = json.loads(line.decode('utf-8'))
+            yield record['type'], record['path'], offset, record['canonical']
+    else:
+        for entity_type in columns_by_entity_type:
+            for yaml_file_path, entry in yaml_io.iter_yaml_files(os.path.join(source_dir, entity_type)):
+                yield entity_type, os.path.relpath(yaml_file_path, source_dir), yaml_file_path, \
+                    entry.get('canonical', {}) if isinstance(entry, dict) else {}
 
 
-def get_path(item, path, default=None):
-    if item is None:
-        return default
-    if not path:
-        return item
-    split_path = path.split('.', 1)
-    key = split_path[0]
-    if key.isdigit():
-        if not isinstance(item, (list, tuple)):
-            return default
-        index = int(key)
-        value = item[index] if 0 <= index < len(item) else None
-    else:
-        if not isinstance(item, dict):
-            return default
-        value = item.get(key)
-    if len(split_path) <= 1:
-        return value if value is not None else default
-    return get_path(value, split_path[1], default=default)
-
-
-def iter_yaml_files(dir):
-    assert os.path.exists(dir), "Directory doesn't exist: {}".format(dir)
-    for sub_dir, dirs_name, filenames in os.walk(dir):
-        for dir_name in dirs_name[:]:
-            if dir_name.startswith('.'):
-                dirs_name.remove(dir_name)
-        for filename in filenames:
-            if not filename.endswith(".yaml"):
-                continue
-            yaml_file_path = os.path.join(sub_dir, filename)
-            with open(yaml_file_path) as yaml_file:
-                try:
-                    yield yaml_file_path, yaml.load(yaml_file)
-                except (UnicodeDecodeError, yaml.constructor.ConstructorError, yaml.parser.ParserError,
-                        yaml.scanner.ScannerError):
-                    log.warning("Invalid syntax in YAML file {}".format(yaml_file_path))
+def load_canonical(location, index_file=None):
+    if index_file is not None:
+        index_file.seek(location)
+        return json.loads(index_file.readline().decode('utf-8'))['canonical']
+    entry = yaml_io.load_file(location)
+    return entry.get('canonical', {}) if isinstance(entry, dict) else {}
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('source_dir', help='path of YAML data directory')
     parser.add_argument('target_dir', help='name of directory containing generated CSV file')
+    parser.add_argument('-f', '--format', action='append', choices=supported_formats, dest='formats',
+        help='format of generated files, repeatable (default: csv)')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+        help='number of worker processes exporting entity types concurrently (default: 1, no worker)')
+    parser.add_argument('-l', '--language', action='append', dest='languages',
+        help='language of the description & tags columns, repeatable (default: en)')
+    parser.add_argument('--no-index', action='store_true', default=False, dest='no_index',
+        help='read the YAML files even when the canonical index of source_dir exists')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='increase output verbosity')
     global args
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stdout)
 
+    formats = sorted(set(args.formats or ['csv']))
+    languages = list(collections.OrderedDict.fromkeys(args.languages or ['en']))
+
     if not os.path.exists(args.target_dir):
         os.makedirs(args.target_dir)
 
-    # ACTORS
-
-    actors_csv_path = os.path.join(args.target_dir, 'actors.csv')
-    entries = []
-    tagsCount = 0
-    for actor_path, actor in iter_yaml_files(os.path.join(args.source_dir, 'actors')):
-        canonical = actor['canonical']
-        tags = [
-            tag['value']
-            for tag in get_path(canonical, 'tags.en', [])
-            ]
-        entries.append(dict(
-            longDescription = get_path(canonical, 'longDescription.en.value'),
-            name = get_path(canonical, 'name.value'),
-            tags = tags,
-            website = get_path(canonical, 'website.value'),
-            ))
-        if len(tags) > tagsCount:
-            tagsCount = len(tags)
-
-    with open(actors_csv_path, 'w') as target_file:
-        csv_writer = csv.writer(target_file)
-        csv_writer.writerow([
-            'Name',
-            'Description',
-            'Website',
-            ] + ['Tag'] * tagsCount)
-        entries.sort(key = lambda entry: entry['name'] or '')
-        for entry in entries:
-            if entry['name'] is None:
-                print('Skipping entry without name: {}'.format(entry))
-                continue
-            tags = entry['tags']
-            row = [
-                entry['name'] or '',
-                entry['longDescription'] or '',
-                entry['website'] or '',
-                ] + tags + [''] * (tagsCount - len(tags))
-            csv_writer.writerow(row)
-
-    # PROJECTS
-
-    projects_csv_path = os.path.join(args.target_dir, 'projects.csv')
-    entries = []
-    tagsCount = 0
-    toolsCount = 0
-    for project_path, project in iter_yaml_files(os.path.join(args.source_dir, 'projects')):
-        canonical = project['canonical']
-        tags = [
-            tag['value']
-            for tag in get_path(canonical, 'tags.en', [])
-            ]
-        tools = [
-            tool['value']
-            for tool in get_path(canonical, 'tools', [])
-            ]
-        entries.append(dict(
-            longDescription = get_path(canonical, 'longDescription.en.value'),
-            name = get_path(canonical, 'name.value'),
-            tags = tags,
-            tools = tools,
-            website = get_path(canonical, 'website.value'),
-            ))
-        if len(tags) > tagsCount:
-            tagsCount = len(tags)
-        if len(tools) > toolsCount:
-            toolsCount = len(tools)
-
-    with open(projects_csv_path, 'w') as target_file:
-        csv_writer = csv.writer(target_file)
-        csv_writer.writerow([
-            'Name',
-            'Description',
-            'Website',
-            ] + ['Tag'] * tagsCount + ['Tool'] * toolsCount)
-        entries.sort(key = lambda entry: entry['name'] or '')
-        for entry in entries:
-            if entry['name'] is None:
-                print('Skipping entry without name: {}'.format(entry))
+    index_path = os.path.join(args.source_dir, canonical_index.index_jsonl_filename)
+    if args.no_index or not os.path.exists(index_path):
+        index_path = None
+
+    # First pass: count the multi-valued columns and sort the entities by name (then by path).
+    keys_by_entity_type = {
+        entity_type: []
+        for entity_type in columns_by_entity_type
+        }
+    multi_valued_columns_by_entity_type = {
+        entity_type: expand_columns(columns['multi_valued'], languages)
+        for entity_type, columns in columns_by_entity_type.items()
+        }
+    values_count_by_entity_type = {
+        entity_type: [0] * len(multi_valued_columns)
+        for entity_type, multi_valued_columns in multi_valued_columns_by_entity_type.items()
+        }
+    index_file = open(index_path, 'rb') if index_path is not None else None
+    try:
+        for entity_type, relative_path, location, canonical in iter_canonicals(args.source_dir, index_file):
+            if entity_type not in columns_by_entity_type:
                 continue
-            tags = entry['tags']
-            tools = entry['tools']
-            row = [
-                entry['name'] or '',
-                entry['longDescription'] or '',
-                entry['website'] or '',
-                ] + tags + [''] * (tagsCount - len(tags)) + tools + [''] * (toolsCount - len(tools))
-            csv_writer.writerow(row)
-
-    # TOOLS
-
-    tools_csv_path = os.path.join(args.target_dir, 'tools.csv')
-    entries = []
-    tagsCount = 0
-    for tool_path, tool in iter_yaml_files(os.path.join(args.source_dir, 'tools')):
-        canonical = tool['canonical']
-        tags = [
-            tag['value']
-            for tag in get_path(canonical, 'tags.en', [])
-            ]
-        entries.append(dict(
-            bugTracker = get_path(canonical, 'bugTracker.value'),
-            license = get_path(canonical, 'license.value'),
-            longDescription = get_path(canonical, 'longDescription.en.value'),
-            name = get_path(canonical, 'name.value'),
-            screenshot = get_path(canonical, 'screenshot.value'),
-            sourceCode = get_path(canonical, 'sourceCode.value'),
-            stackexchangeTag = get_path(canonical, 'stackexchangeTag.value'),
-            tags = tags,
-            ))
-        if len(tags) > tagsCount:
-            tagsCount = len(tags)
-
-    with open(tools_csv_path, 'w') as target_file:
-        csv_writer = csv.writer(target_file)
-        csv_writer.writerow([
-            'Name',
-            'Description',
-            'License',
-            'Source Code URL',
-            'Bug Tracker URL',
-            'Screenshot URL',
-            'StackExchange Tag',
-            ] + ['Tag'] * tagsCount)
-        entries.sort(key = lambda entry: entry['name'] or '')
-        for entry in entries:
-            if entry['name'] is None:
-                print('Skipping entry without name: {}'.format(entry))
+            name = get_path(canonical, 'name.value')
+            if name is None:
+                print('Skipping entity without name: {}'.format(relative_path))
                 continue
-            tags = entry['tags']
-            row = [
-                entry['name'] or '',
-                entry['longDescription'] or '',
-                entry['license'] or '',
-                entry['sourceCode'] or '',
-                entry['bugTracker'] or '',
-                entry['screenshot'] or '',
-                entry['stackexchangeTag'] or '',
-                ] + tags + [''] * (tagsCount - len(tags))
-            csv_writer.writerow(row)
+            values_count = values_count_by_entity_type[entity_type]
+            for index, column in enumerate(multi_valued_columns_by_entity_type[entity_type]):
+                values_count[index] = max(values_count[index], len(get_path(canonical, column.path, [])))
+            keys_by_entity_type[entity_type].append((name, location))
+    finally:
+        if index_file is not None:
+            index_file.close()
+
+    # Second pass: write the files of each entity type, one entity at a time.
+    tasks = []
+    for entity_type in columns_by_entity_type:
+        keys = keys_by_entity_type.pop(entity_type)
+        keys.sort()
+        tasks.append((entity_type, keys, values_count_by_entity_type[entity_type], index_path, args.target_dir,
+            formats, languages))
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(tasks)))
+        exported_counts = pool.map(export_entity_type, tasks, 1)
+        pool.close()
+        pool.join()
+    else:
+        exported_counts = list(map(export_entity_type, tasks))
+    for (entity_type, *_), exported_count in zip(tasks, exported_counts):
+        log.info('{} {} exported'.format(exported_count, entity_type))
 
     return 0
 
 
+def set_entry_value(entry, column, value):
+    if column.language is None:
+        entry[column.field] = value
+    else:
+        entry.setdefault(column.field, collections.OrderedDict())[column.language] = value
+
+
 if __name__ == "__main__":
     sys.exit(main())
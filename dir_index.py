@@ -0,0 +1,111 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Index of the YAML files of a directory tree, built in a single os.scandir pass.
+
+An index maps the relative path of each YAML file to its size and mtime. It can be persisted in a cache directory and
+is then reused as long as the modification times of all the scanned directories are unchanged, because adding,
+removing or renaming a file changes the mtime of its directory.
+"""
+
+
+import collections
+import hashlib
+import json
+import logging
+import os
+
+
+index_version = 2
+log = logging.getLogger(__name__)
+
+
+def get_index_path(dir, cache_dir):
+    dir = os.path.abspath(dir)
+    return os.path.join(cache_dir, '{}-{}.json'.format(os.path.basename(dir),
+        hashlib.sha1(dir.encode('utf-8')).hexdigest()[:12]))
+
+
+def is_index_valid(dir, index):
+    if index.get('version') != index_version:
+        return False
+    for relative_dir, mtime_ns in index['dirs_mtime'].items():
+        try:
+            if os.stat(os.path.join(dir, relative_dir)).st_mtime_ns != mtime_ns:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def load_yaml_dir_index(dir, cache_dir=None):
+    """Return the index of the YAML files of dir, reusing the one persisted in cache_dir when still valid."""
+    assert os.path.exists(dir), "Directory doesn't exist: {}".format(dir)
+    if cache_dir is None:
+        return scan_yaml_dir(dir)
+    index_path = get_index_path(dir, cache_dir)
+    if os.path.exists(index_path):
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if is_index_valid(dir, index):
+            log.info('Reusing index of directory {}'.format(dir))
+            return index
+    index = scan_yaml_dir(dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(index_path, 'w') as index_file:
+        json.dump(index, index_file)
+    return index
+
+
+def iter_names(index):
+    """Iterate over the (name, relative_path) couples of the YAML files of an index, sorted by relative path."""
+    for relative_path in index['files']:
+        yield os.path.splitext(os.path.basename(relative_path))[0], relative_path
+
+
+def scan_yaml_dir(dir):
+    """Scan dir and return its index: the mtimes of its (non hidden) directories and the size & mtime of its YAML
+    files, by relative path.
+    """
+    dirs_mtime = {}
+    file_stat_by_relative_path = {}
+    relative_dirs = ['']
+    while relative_dirs:
+        relative_dir = relative_dirs.pop()
+        sub_dir = os.path.join(dir, relative_dir)
+        dirs_mtime[relative_dir] = os.stat(sub_dir).st_mtime_ns
+        with os.scandir(sub_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    relative_dirs.append(os.path.join(relative_dir, entry.name))
+                elif entry.name.endswith('.yaml'):
+                    stat = entry.stat()
+                    file_stat_by_relative_path[os.path.join(relative_dir, entry.name)] = [
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        ]
+    return dict(
+        dirs_mtime = dirs_mtime,
+        files = collections.OrderedDict(sorted(file_stat_by_relative_path.items())),
+        version = index_version,
+        )
@@ -0,0 +1,147 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Write-if-changed output of entity trees (<target_dir>/<entity_type>/<name>.yaml).
+
+Each tree contains a manifest (.manifest.json) mapping the relative path of every entity file to the SHA-256 of its
+content, its size & its modification time, so that unchanged files are neither rewritten nor re-read. A file whose
+size or modification time differs from the manifest (edited, checked out...) is hashed again, so that a full run
+always repairs the tree.
+
+In the sharded layout, entity files are spread in sub-directories named like the ones of Debian pools
+(<target_dir>/<entity_type>/<shard>/<name>.yaml, where shard is "libx" for a name starting with "libx" and the first
+letter of the name otherwise). Readers walk entity type directories recursively, so they handle both layouts.
+"""
+
+
+import hashlib
+import json
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+manifest_filename = '.manifest.json'
+
+
+def get_relative_path(entity_type, name, sharded=False):
+    if not sharded:
+        return os.path.join(entity_type, '{}.yaml'.format(name))
+    return os.path.join(entity_type, get_shard(name), '{}.yaml'.format(name))
+
+
+def get_shard(name):
+    shard = name[:4] if name.startswith('lib') else name[0]
+    # Hidden directories are ignored by readers.
+    return '_' + shard if shard.startswith('.') else shard
+
+
+def get_manifest_digest(dir, relative_path, manifest):
+    """Return the SHA-256 of the content of dir/relative_path recorded in manifest, or None when the file doesn't
+    exist, isn't in manifest or has been modified since.
+    """
+    entry = manifest.get(relative_path)
+    if not isinstance(entry, dict):
+        # Missing or written by a previous version (hash only)
+        return None
+    try:
+        stat = os.stat(os.path.join(dir, relative_path))
+    except FileNotFoundError:
+        return None
+    if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']:
+        return None
+    return entry['hash']
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path):
+    with open(path, 'rb') as file:
+        return hash_bytes(file.read())
+
+
+def load_manifest(dir):
+    manifest_path = os.path.join(dir, manifest_filename)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def remove_vanished_files(dir, manifest, kept_relative_paths):
+    """Remove the YAML files of dir (and their manifest entries) whose relative path is not in kept_relative_paths.
+
+    Emptied shard directories are removed too, but not the directory of an entity type.
+    """
+    removed_relative_paths = []
+    for relative_path in list(manifest):
+        if relative_path not in kept_relative_paths:
+            del manifest[relative_path]
+    for entity_type in os.listdir(dir):
+        entity_type_dir = os.path.join(dir, entity_type)
+        if entity_type.startswith('.') or not os.path.isdir(entity_type_dir):
+            continue
+        for sub_dir, dirs_name, filenames in os.walk(entity_type_dir, topdown=False):
+            for filename in filenames:
+                if not filename.endswith('.yaml'):
+                    continue
+                path = os.path.join(sub_dir, filename)
+                relative_path = os.path.relpath(path, dir)
+                if relative_path not in kept_relative_paths:
+                    log.info('Removing {}'.format(path))
+                    os.remove(path)
+                    removed_relative_paths.append(relative_path)
+            if sub_dir != entity_type_dir and not os.listdir(sub_dir):
+                os.rmdir(sub_dir)
+    return removed_relative_paths
+
+
+def save_manifest(dir, manifest):
+    manifest_path = os.path.join(dir, manifest_filename)
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=0, sort_keys=True)
+
+
+def write_if_changed(dir, relative_path, text, manifest):
+    """Write text to dir/relative_path, unless this file already has the same content.
+
+    Return True when file has been written.
+    """
+    data = text.encode('utf-8')
+    digest = hash_bytes(data)
+    path = os.path.join(dir, relative_path)
+    existing_digest = get_manifest_digest(dir, relative_path, manifest)
+    if existing_digest is None and os.path.exists(path):
+        existing_digest = hash_file(path)
+    if existing_digest != digest:
+        parent_dir = os.path.dirname(path)
+        if not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+        with open(path, 'wb') as file:
+            file.write(data)
+    stat = os.stat(path)
+    manifest[relative_path] = dict(
+        hash = digest,
+        mtime_ns = stat.st_mtime_ns,
+        size = stat.st_size,
+        )
+    return existing_digest != digest
@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+
+
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Suggest entities of a canonical directory that are probably the same entity described by different sources.
+
+Instead of comparing all pairs of entities, candidates are entities sharing a normalized name (blocking) or a bucket
+of the locality-sensitive hashing (LSH) of the MinHash signatures of their descriptions & URLs. Only candidates
+without any source in common are kept (two entities of the same source are distinct by construction), ignoring the
+update-only sources, which only enrich entities created by other sources, matching them by name.
+
+Suggestions are ranked by score and written in the format of specificities files.
+"""
+
+
+import argparse
+import difflib
+import logging
+import os
+import re
+import sys
+import zlib
+
+from slugify import slugify
+
+import canonical_index
+import yaml_io
+
+
+#
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+args = None
+# LSH: signatures of bands_count * rows_count MinHash values, candidates when all the rows of a band are equal
+bands_count = 16
+log = logging.getLogger(app_name)
+max_bucket_size = 50
+rows_count = 4
+# Sources of merge.py that are not allowed to create new entities (update_only)
+update_only_sources_name = frozenset(['debian-appstream', 'udd', 'wikidata'])
+url_fields = ('bugTracker', 'screenshot', 'sourceCode', 'website')
+word_re = re.compile(r'\w+')
+
+
+def get_minhash_signature(shingles):
+    """Return the one-permutation MinHash signature of a set of shingles.
+
+    The 32 bits hash of each shingle selects a bin with its low bits and competes for the minimum of this bin with its
+    other bits, so that a signature is computed in a single pass over the shingles. Empty bins take the value of the
+    next non-empty bin, with its distance (densification by rotation).
+    """
+    signature_size = bands_count * rows_count
+    minimums = [None] * signature_size
+    for shingle in shingles:
+        shingle_hash = zlib.crc32(shingle.encode('utf-8'))
+        bin_index = shingle_hash % signature_size
+        value = shingle_hash // signature_size
+        minimum = minimums[bin_index]
+        if minimum is None or value < minimum:
+            minimums[bin_index] = value
+    signature = []
+    for bin_index, minimum in enumerate(minimums):
+        distance = 0
+        while minimum is None:
+            distance += 1
+            minimum = minimums[(bin_index + distance) % signature_size]
+        signature.append((minimum, distance))
+    return tuple(signature)
+
+
+def iter_records(dir, entity_type):
+    if os.path.exists(os.path.join(dir, canonical_index.index_jsonl_filename)):
+        for record in canonical_index.iter_records(dir):
+            if record['type'] == entity_type:
+                yield record
+    else:
+        entity_type_dir = os.path.join(dir, entity_type)
+        for yaml_file_path, entry in yaml_io.iter_yaml_files(entity_type_dir):
+            yield canonical_index.make_record(entity_type, os.path.join(entity_type,
+                os.path.relpath(yaml_file_path, entity_type_dir)), entry)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source_dir', help='path of canonical data directory')
+    parser.add_argument('-o', '--output', help='path of YAML file where suggestions are written (default: stdout)')
+    parser.add_argument('-s', '--min-score', default=0.5, dest='min_score', type=float,
+        help='minimum score of suggested duplicates, between 0 and 1 (default: 0.5)')
+    parser.add_argument('-t', '--type', choices=['actors', 'projects', 'tools'], default='tools',
+        help='type of entities to compare (default: tools)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='increase output verbosity')
+    global args
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stdout)
+
+    assert os.path.exists(args.source_dir)
+
+    entities = []
+    entities_index_by_block_key = {}
+    entities_index_by_bucket = {}
+    for record in iter_records(args.source_dir, args.type):
+        if not record['sources']:
+            continue
+        canonical = record['canonical']
+        display_name = canonical.get('name', {}).get('value') or record['name']
+        normalized_name = normalize_name(display_name)
+        urls = set(
+            normalize_url(canonical[field]['value'])
+            for field in url_fields
+            if field in canonical
+            )
+        words = word_re.findall(' '.join(
+            description['value']
+            for language, description in sorted(canonical.get('longDescription', {}).items())
+            ).lower())
+        # Shingles: the triplets of consecutive words of the descriptions and the URLs
+        shingles = set('url:' + url for url in urls)
+        if words:
+            shingles.update(
+                ' '.join(words[index:index + 3])
+                for index in range(max(1, len(words) - 2))
+                )
+        entity = dict(
+            display_name = display_name,
+            name = record['name'],
+            normalized_name = normalized_name,
+            signature = get_minhash_signature(shingles) if shingles else None,
+            sources = set(record['sources']),
+            urls = urls,
+            )
+        entity_index = len(entities)
+        entities.append(entity)
+        if normalized_name:
+            entities_index_by_block_key.setdefault(normalized_name, []).append(entity_index)
+        if entity['signature'] is not None:
+            for band_index in range(bands_count):
+                band = entity['signature'][band_index * rows_count:(band_index + 1) * rows_count]
+                entities_index_by_bucket.setdefault((band_index, band), []).append(entity_index)
+    log.info('{} {} hashed'.format(len(entities), args.type))
+
+    candidate_pairs = set()
+    for entities_index in list(entities_index_by_block_key.values()) + list(entities_index_by_bucket.values()):
+        if len(entities_index) < 2:
+            continue
+        if len(entities_index) > max_bucket_size:
+            # A too common name or description (like an empty template) says nothing about identity.
+            continue
+        for index, entity_index in enumerate(entities_index):
+            for other_entity_index in entities_index[index + 1:]:
+                candidate_pairs.add((entity_index, other_entity_index))
+    log.info('{} candidate pairs'.format(len(candidate_pairs)))
+
+    suggestions = []
+    for entity_index, other_entity_index in candidate_pairs:
+        entity = entities[entity_index]
+        other_entity = entities[other_entity_index]
+        if (entity['sources'] & other_entity['sources']) - update_only_sources_name:
+            continue
+        reasons = []
+        if entity['normalized_name'] and entity['normalized_name'] == other_entity['normalized_name']:
+            name_similarity = 1.0
+            reasons.append('same normalized name')
+        else:
+            name_similarity = difflib.SequenceMatcher(None, entity['normalized_name'],
+                other_entity['normalized_name']).ratio()
+        if entity['signature'] is not None and other_entity['signature'] is not None:
+            text_similarity = sum(
+                1
+                for value, other_value in zip(entity['signature'], other_entity['signature'])
+                if value == other_value
+                ) / (bands_count * rows_count)
+        else:
+            text_similarity = 0.0
+        if text_similarity > 0:
+            reasons.append('similar descriptions & URLs ({:.2f})'.format(text_similarity))
+        common_urls = sorted(entity['urls'] & other_entity['urls'])
+        for url in common_urls:
+            reasons.append('same URL {}'.format(url))
+        score = round(0.4 * name_similarity + 0.4 * text_similarity + (0.2 if common_urls else 0.0), 3)
+        if score < args.min_score:
+            continue
+        # The entity with the most sources keeps its name, the other one is renamed in its sources.
+        kept, renamed = sorted([entity, other_entity], key = lambda entity: (-len(entity['sources']), entity['name']))
+        suggestions.append(dict(
+            canonical = kept['name'],
+            duplicate = renamed['name'],
+            reasons = reasons,
+            score = score,
+            specificities = {
+                source: dict(name = renamed['name'])
+                for source in sorted(renamed['sources'])
+                # An update-only source already matches the kept entity by its name.
+                if source not in update_only_sources_name or source not in kept['sources']
+                },
+            ))
+    suggestions.sort(key = lambda suggestion: (-suggestion['score'], suggestion['canonical'], suggestion['duplicate']))
+    log.info('{} suggestions'.format(len(suggestions)))
+
+    if args.output is None:
+        yaml_io.dump(suggestions, sys.stdout)
+    else:
+        with open(args.output, 'w') as output_file:
+            yaml_io.dump(suggestions, output_file)
+
+    return 0
+
+
+def normalize_name(name):
+    return slugify(name, separator='')
+
+
+def normalize_url(url):
+    url = url.strip().lower()
+    url = re.sub(r'^[a-z]+://', '', url)
+    if url.startswith('www.'):
+        url = url[4:]
+    return url.rstrip('/')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,44 +23,22 @@
 
 import argparse
 import collections
-import functools
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
-import shutil
 import sys
 
 import apt_pkg
-import yaml, yaml.constructor, yaml.parser, yaml.scanner
 
-
-# YAML configuration
-
-
-class folded_str(str):
-    pass
-
-
-class literal_str(str):
-    pass
-
-
-def dict_constructor(loader, node):
-    return collections.OrderedDict(loader.construct_pairs(node))
-
-
-def dict_representer(dumper, data):
-    return dumper.represent_dict(sorted(data.items()))
-
-
-yaml.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
-
-yaml.add_representer(folded_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='>'))
-yaml.add_representer(literal_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='|'))
-yaml.add_representer(dict, dict_representer)
-yaml.add_representer(collections.OrderedDict, dict_representer)
-yaml.add_representer(str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str', data))
+import canonical_index
+import canonical_links
+import canonical_rules
+import entity_tree
+import item_path
+import run_report
+import yaml_io
 
 
 #
@@ -68,547 +46,177 @@ yaml.add_representer(str, lambda dumper, data: dumper.represent_scalar(u'tag:yam
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
 args = None
+canonical_state_filename = '.inputs.json'
 log = logging.getLogger(app_name)
-
-
-def extract_from_list(language, value):
-    if value is not None:
-        for item in value:
-            yield language, item
-
-
-def extract_from_name_id(value):
-    if value is not None:
-        name = value['name']
-        if isinstance(name, str):
-            yield 'en', name
-        else:
-            yield from extract_from_value_by_language(name)
-
-
-def extract_from_name_id_list(value):
-    if value is not None:
-        for item in value:
-            yield from extract_from_name_id(item)
-
-
-def extract_from_singletion_or_list(language, value):
-    if value is not None:
-        if isinstance(value, list):
-            for item in value:
-                yield language, item
-        else:
-            yield language, value
-
-
-def extract_from_value(language, value):
-    if value is not None:
-        yield language, value
-
-
-def extract_from_value_by_language(value):
-    if value is not None:
-        yield from value.items()
-
-
-def extract_from_wikidata(value):
-    if value is not None:
-        for item in value:
-            yield item.get('xml:lang'), item['value']
-
-
-def get_path(item, path):
-    if item is None:
-        return item
-    if not path:
-        return item
-    split_path = path.split('.', 1)
-    key = split_path[0]
-    if key.isdigit():
-        if not isinstance(item, (list, tuple)):
-            return None
-        index = int(key)
-        value = item[index] if 0 <= index < len(item) else None
-    else:
-        if not isinstance(item, dict):
-            return None
-        value = item.get(key)
-    if len(split_path) <= 1:
-        return value
-    return get_path(value, split_path[1])
-
-
-def get_path_source(path):
-    return path.split('.', 1)[0]
-
-
-def iter_yaml_files(dir):
-    assert os.path.exists(dir), "Directory doesn't exist: {}".format(dir)
-    for sub_dir, dirs_name, filenames in os.walk(dir):
-        for dir_name in dirs_name[:]:
-            if dir_name.startswith('.'):
-                dirs_name.remove(dir_name)
-        for filename in filenames:
-            if not filename.endswith(".yaml"):
-                continue
-            yaml_file_path = os.path.join(sub_dir, filename)
-            with open(yaml_file_path) as yaml_file:
-                try:
-                    yield yaml_file_path, yaml.load(yaml_file)
-                except (UnicodeDecodeError, yaml.constructor.ConstructorError, yaml.parser.ParserError,
-                        yaml.scanner.ScannerError):
-                    log.warning("Invalid syntax in YAML file {}".format(yaml_file_path))
+pool = None
+report = run_report.RunReport()
+
+
+def canonicalize_file(task):
+    """Load an entity file and return its YAML dump with canonical attributes & its index record (None & None when its
+    syntax is invalid) and its statistics.
+    """
+    entity_type, yaml_file_path, relative_path, previous_canonical, rules_stats_enabled = task
+    stats = collections.Counter()
+    try:
+        entry = yaml_io.load_file(yaml_file_path)
+    except yaml_io.load_errors:
+        log.warning("Invalid syntax in YAML file {}".format(yaml_file_path))
+        stats['parse_failures'] += 1
+        return None, None, stats
+    stats['files_parsed'] += 1
+    canonical = canonical_rules.canonicalize(entity_type, entry, stats=stats if rules_stats_enabled else None)
+    # Keep the previous links, so that the file is written once when they don't change.
+    canonical = canonical_links.copy_links(canonical, previous_canonical)
+    if canonical:
+        entry['canonical'] = canonical
+    return yaml_io.dumps(entry), canonical_index.make_record(entity_type, relative_path, entry), stats
+
+
+def get_rules_version():
+    """Return the hash of the modules generating the canonical files: when one of them changes, every entity must be
+    generated again.
+    """
+    hasher = hashlib.sha256()
+    for module_path in sorted([
+            os.path.abspath(__file__),
+            canonical_index.__file__,
+            canonical_links.__file__,
+            canonical_rules.__file__,
+            entity_tree.__file__,
+            item_path.__file__,
+            yaml_io.__file__,
+            ]):
+        with open(module_path, 'rb') as module_file:
+            hasher.update(module_file.read())
+    return hasher.hexdigest()
+
+
+def load_canonical_state(dir):
+    state_path = os.path.join(dir, canonical_state_filename)
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def map_in_pool(function, items):
+    """Apply function to each item, using the worker processes when --jobs is given.
+
+    Items are dispatched one at a time to the first idle worker, so that a single huge entity doesn't hold back the
+    items queued behind it. Results are always returned in the order of items, so that output stays deterministic.
+    """
+    if pool is None:
+        return map(function, items)
+    return pool.imap(function, items, 1)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('source_dir', help='path of source data directory')
     parser.add_argument('target_dir', help='path of target directory for generated YAML files')
+    parser.add_argument('--report', help='path of JSON file where a report of the run (times, counters...) is written')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+        help='number of worker processes used to canonicalize entities (default: 1, no worker)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='increase output verbosity')
     global args
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stdout)
 
+    global pool
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+
     assert os.path.exists(args.source_dir)
-    if os.path.exists(args.target_dir):
-        for filename in os.listdir(args.target_dir):
-            if filename.startswith('.'):
-                continue
-            path = os.path.join(args.target_dir, filename)
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-    else:
+    if not os.path.exists(args.target_dir):
         os.makedirs(args.target_dir)
-
-    # ACTORS
-
-    entity_type = 'actors'
-    source_entity_type_dir = os.path.join(args.source_dir, entity_type)
-    target_entity_type_dir = os.path.join(args.target_dir, entity_type)
-    if not os.path.exists(target_entity_type_dir):
-        os.makedirs(target_entity_type_dir)
-    for yaml_file_path, entry in iter_yaml_files(source_entity_type_dir):
-        yaml_file_relative_path = os.path.relpath(yaml_file_path, source_entity_type_dir)
-
-        canonical = collections.OrderedDict()
-
-        # name
-        # Lowercase version of this name is the unique name of the actor and the slugified version of this unique name
-        # is the file name for the actor.
-        for path in (
-                'civic-graph.name',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['name'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        # longDescription
-        # Description of the actor, for each supported language, in a map indexed by the two letter (ISO-639-1)
-        # language code
-        for language, paths in dict(
-                en = (
-                    'civic-graph.description',
-                    ),
-                es = (
-                    ),
-                fr = (
-                    ),
-                ).items():
-            for path in paths:
-                value = get_path(entry, path)
-                if value is not None:
-                    value = value.strip()
-                    if value:
-                        canonical.setdefault('longDescription', {})[language] = dict(
-                            source = get_path_source(path),
-                            value = value,
-                            )
-                        break
-
-        # tags
-        sources_by_value_by_language = {}
-        for path, extractor in (
-                ('civic-graph.categories', extract_from_name_id_list),
-                ('civic-graph.type', functools.partial(extract_from_value, 'en')),
-                ):
-            source = get_path_source(path)
-            value = get_path(entry, path)
-            for language, item in extractor(value):
-                assert isinstance(item, str), (path, language, item, value)
-                if language is not None and item is not None:
-                    item = item.strip()
-                    if item:
-                        sources_by_value_by_language.setdefault(language, {}).setdefault(item, set()).add(source)
-        if sources_by_value_by_language:
-            for language, sources_by_value in sources_by_value_by_language.items():
-                canonical.setdefault('tags', {})[language] = [
-                    dict(
-                        sources = sorted(sources),
-                        value = value,
-                        )
-                    for value, sources in sorted(sources_by_value.items())
-                    ]
-
-        # website
-        for path in (
-                'civic-graph.url',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['website'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        if canonical:
-            entry['canonical'] = canonical
-        with open(os.path.join(target_entity_type_dir, yaml_file_relative_path), 'w') as yaml_file:
-            yaml.dump(entry, yaml_file, allow_unicode=True, default_flow_style=False, indent=2, width=120)
-
-    # PROJECTS
-
-    entity_type = 'projects'
-    source_entity_type_dir = os.path.join(args.source_dir, entity_type)
-    target_entity_type_dir = os.path.join(args.target_dir, entity_type)
-    if not os.path.exists(target_entity_type_dir):
-        os.makedirs(target_entity_type_dir)
-    for yaml_file_path, entry in iter_yaml_files(source_entity_type_dir):
-        yaml_file_relative_path = os.path.relpath(yaml_file_path, source_entity_type_dir)
-
-        canonical = collections.OrderedDict()
-
-        # name
-        # Lowercase version of this name is the unique name of the project and the slugified version of this unique name
-        # is the file name for the project.
-        for path in (
-                'participatedb.Name',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['name'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        # longDescription
-        # Description of the project, for each supported language, in a map indexed by the two letter (ISO-639-1)
-        # language code
-        for language, paths in dict(
-                en = (
-                    'participatedb.Description',
-                    ),
-                es = (
-                    ),
-                fr = (
-                    ),
-                ).items():
-            for path in paths:
-                value = get_path(entry, path)
-                if value is not None:
-                    value = value.strip()
-                    if value:
-                        canonical.setdefault('longDescription', {})[language] = dict(
-                            source = get_path_source(path),
-                            value = value,
-                            )
-                        break
-
-        # tags
-        sources_by_value_by_language = {}
-        for path, extractor in (
-                ('participatedb.Category', functools.partial(extract_from_singletion_or_list, 'en')),
-                ('participatedb.category', functools.partial(extract_from_value, 'en')),
-                ):
-            source = get_path_source(path)
-            value = get_path(entry, path)
-            for language, item in extractor(value):
-                assert isinstance(item, str), (path, language, item, value)
-                if language is not None and item is not None:
-                    item = item.strip()
-                    if item:
-                        sources_by_value_by_language.setdefault(language, {}).setdefault(item, set()).add(source)
-        if sources_by_value_by_language:
-            for language, sources_by_value in sources_by_value_by_language.items():
-                canonical.setdefault('tags', {})[language] = [
-                    dict(
-                        sources = sorted(sources),
-                        value = value,
-                        )
-                    for value, sources in sorted(sources_by_value.items())
-                    ]
-
-        # tools
-        sources_by_value = {}
-        for path, extractor in (
-                ('participatedb.Tools used', functools.partial(extract_from_list, None)),
-                ):
-            source = get_path_source(path)
-            value = get_path(entry, path)
-            for language, item in extractor(value):
-                assert isinstance(item, str), (path, language, item, value)
-                if language in (None, 'en') and item is not None:
-                    item = item.strip()
-                    if item:
-                        sources_by_value.setdefault(item, set()).add(source)
-        if sources_by_value:
-            canonical['tools'] = [
-                dict(
-                    sources = sorted(sources),
-                    value = value,
-                    )
-                for value, sources in sorted(sources_by_value.items())
-                ]
-
-        # website
-        for path in (
-                'participatedb.Web',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['website'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        if canonical:
-            entry['canonical'] = canonical
-        with open(os.path.join(target_entity_type_dir, yaml_file_relative_path), 'w') as yaml_file:
-            yaml.dump(entry, yaml_file, allow_unicode=True, default_flow_style=False, indent=2, width=120)
-
-    # TOOLS
-
-    entity_type = 'tools'
-    source_entity_type_dir = os.path.join(args.source_dir, entity_type)
-    target_entity_type_dir = os.path.join(args.target_dir, entity_type)
-    if not os.path.exists(target_entity_type_dir):
-        os.makedirs(target_entity_type_dir)
-    for yaml_file_path, entry in iter_yaml_files(source_entity_type_dir):
-        yaml_file_relative_path = os.path.relpath(yaml_file_path, source_entity_type_dir)
-
-        canonical = collections.OrderedDict()
-
-        # bugTracker
-        # URL of the service where bugs related to the tool can be reported
-        for path in (
-                'wikidata.bug_tracking_system.0.value',
-                'ogptoolbox-framacalc.URL suivi de bogues',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['bugTracker'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        # license
-        # Name of the license governing the tool.
-        for path in (
-                'wikidata.license_label.0.value',
-                'civicstack.license.name.en',
-                'nuit-debout.Nom de la licence',
-                'ogptoolbox-framacalc.Licence',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['license'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        # name
-        # Lowercase version of this name is the unique name of the tool and the slugified version of this unique name is
-        # the file name for the tool.
-        for path in (
-                'debian_appstream.Name.C',
-                'wikidata.label.0.value',
-                'civic-tech-field-guide.name',
-                'civicstack.name',
-                'tech-plateforms.Name',
-                'nuit-debout.Outil',
-                'participatedb.Name',
-                'harnessing-collaborative-technologies.title',
-                'ogptoolbox-framacalc.Nom',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['name'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        # longDescription
-        # Description of the tool, for each supported language, in a map indexed by the two letter (ISO-639-1) language
-        # code
-        for path, extractor in (
-                ('wikidata.description', extract_from_wikidata),
-                ('debian.description.en.long_description', functools.partial(extract_from_value, 'en')),
-                ('debian.description.es.long_description', functools.partial(extract_from_value, 'es')),
-                ('debian.description.fr.long_description', functools.partial(extract_from_value, 'fr')),
-                ('civicstack.description', extract_from_value_by_language),
-                ('tech-plateforms.About', functools.partial(extract_from_value, 'en')),
-                ('participatedb.Description', functools.partial(extract_from_value, 'en')),
-                ('harnessing-collaborative-technologies.description', functools.partial(extract_from_value, 'en')),
-                ('nuit-debout.Détails', functools.partial(extract_from_value, 'fr')),
-                ('ogptoolbox-framacalc.Description', functools.partial(extract_from_value, 'fr')),
-                ):
-            source = get_path_source(path)
-            value = get_path(entry, path)
-            for language, item in extractor(value):
-                assert isinstance(item, str), (path, language, item, value)
-                if language is not None and item is not None:
-                    item = item.strip()
-                    if item:
-                        canonical_value_by_language = canonical.setdefault('longDescription', {})
-                        if language not in canonical_value_by_language:
-                            canonical_value_by_language[language] = dict(
-                                source = source,
-                                value = item,
-                                )
-
-        # programmingLanguages
-        sources_by_value = {}
-        for path, extractor in (
-                ('civicstack.technology', extract_from_name_id_list),
-                ):
-            source = get_path_source(path)
-            value = get_path(entry, path)
-            for language, item in extractor(value):
-                assert isinstance(item, str), (path, language, item, value)
-                if language in (None, 'en') and item is not None:
-                    item = item.strip()
-                    if item:
-                        sources_by_value.setdefault(item, set()).add(source)
-        if sources_by_value:
-            canonical['programmingLanguages'] = [
-                dict(
-                    sources = sorted(sources),
-                    value = value,
-                    )
-                for value, sources in sorted(sources_by_value.items())
-                ]
-
-        # screenshot
-        # The URL of a screenshot displaying the tool user interface
-        for path in (
-                'debian.screenshot.large_image_url',
-                'wikidata.image.0.value',
-                "ogptoolbox-framacalc.Capture d'écran",
-                'harnessing-collaborative-technologies.logo_url',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['screenshot'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        # sourceCode
-        # URL from which the source code of the tool can be obtained.
-        for path in (
-                'wikidata.source_code_repository.0.value',
-                'civicstack.github',
-                'nuit-debout.Lien vers le code',
-                'ogptoolbox-framacalc.URL code source',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['sourceCode'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        # stackexchangeTag:
-        # Tag from http://stackexchange.org/ uniquely associated with the tool.
-        for path in (
-                'wikidata.stack_exchange_tag.0.value',
-                'ogptoolbox-framacalc.Tag stack exchange',
-                ):
-            value = get_path(entry, path)
-            if value is not None:
-                value = value.strip()
-                if value:
-                    canonical['stackexchangeTag'] = dict(
-                        source = get_path_source(path),
-                        value = value,
-                        )
-                    break
-
-        # tags
-        sources_by_value_by_language = {}
-        for path, extractor in (
-                ('civic-tech-field-guide.category', functools.partial(extract_from_value, 'en')),
-                # ('civicstack.category', extract_from_name_id),
-                ('civicstack.tags', extract_from_name_id_list),
-                ('debian_appstream.Categories', functools.partial(extract_from_list, 'en')),
-                ('harnessing-collaborative-technologies.category', functools.partial(extract_from_value, 'en')),
-                ('nuit-debout.Fonction', functools.partial(extract_from_value, 'fr')),
-                ('ogptoolbox-framacalc.Catégorie', functools.partial(extract_from_value, 'fr')),
-                ('participatedb.Category', functools.partial(extract_from_singletion_or_list, 'en')),
-                ('participatedb.category', functools.partial(extract_from_value, 'en')),
-                ('tech-plateforms.CivicTech or GeneralPurpose', functools.partial(extract_from_value, 'en')),
-                ('tech-plateforms.Functions', functools.partial(extract_from_value, 'en')),
-                ('tech-plateforms.AppCivist Service 1', functools.partial(extract_from_value, 'en')),
-                ('tech-plateforms.AppCivist Service 2', functools.partial(extract_from_value, 'en')),
-                ('tech-plateforms.AppCivist Service 3', functools.partial(extract_from_value, 'en')),
-                ('wikidata.genre_label', extract_from_wikidata),
-                ('wikidata.instance_of_label', extract_from_wikidata),
-                ):
-            source = get_path_source(path)
-            value = get_path(entry, path)
-            for language, item in extractor(value):
-                assert isinstance(item, str), (path, language, item, value)
-                if language is not None and item is not None:
-                    item = item.strip()
-                    if item:
-                        sources_by_value_by_language.setdefault(language, {}).setdefault(item, set()).add(source)
-        if sources_by_value_by_language:
-            for language, sources_by_value in sources_by_value_by_language.items():
-                canonical.setdefault('tags', {})[language] = [
-                    dict(
-                        sources = sorted(sources),
-                        value = value,
-                        )
-                    for value, sources in sorted(sources_by_value.items())
-                    ]
-
-        if canonical:
-            entry['canonical'] = canonical
-        with open(os.path.join(target_entity_type_dir, yaml_file_relative_path), 'w') as yaml_file:
-            yaml.dump(entry, yaml_file, allow_unicode=True, default_flow_style=False, indent=2, width=120)
+    manifest = entity_tree.load_manifest(args.target_dir)
+    # Hash of the merged file of each entity, when its canonical file has been generated by the current rules
+    state = load_canonical_state(args.target_dir)
+    rules_version = get_rules_version()
+    if state.get('rules_version') != rules_version:
+        state = dict(
+            input_hash_by_relative_path = {},
+            rules_version = rules_version,
+            )
+    input_hash_by_relative_path = state['input_hash_by_relative_path']
+    # Summaries of the index records, the full records of the generated entities being spooled
+    record_by_relative_path = canonical_index.load_record_by_relative_path(args.target_dir)
+    record_spool = canonical_index.RecordSpool()
+    relative_paths = set()
+
+    for entity_type in canonical_rules.rules_by_entity_type:
+        source_entity_type_dir = os.path.join(args.source_dir, entity_type)
+        target_entity_type_dir = os.path.join(args.target_dir, entity_type)
+        if not os.path.exists(target_entity_type_dir):
+            os.makedirs(target_entity_type_dir)
+        with report.stage(entity_type) as counters:
+            if args.report is not None:
+                counters.update(dict.fromkeys(canonical_rules.iter_rule_stats_keys(entity_type), 0))
+            changed_inputs = []
+            tasks = []
+            for yaml_file_path in yaml_io.iter_yaml_paths(source_entity_type_dir):
+                relative_path = os.path.join(entity_type, os.path.relpath(yaml_file_path, source_entity_type_dir))
+                counters['files_scanned'] += 1
+                counters['bytes_read'] += os.path.getsize(yaml_file_path)
+                input_hash = entity_tree.hash_file(yaml_file_path)
+                if input_hash_by_relative_path.get(relative_path) == input_hash \
+                        and relative_path in record_by_relative_path \
+                        and entity_tree.get_manifest_digest(args.target_dir, relative_path, manifest) is not None:
+                    relative_paths.add(relative_path)
+                    counters['files_skipped'] += 1
+                    continue
+                changed_inputs.append((relative_path, input_hash))
+                previous_record = record_by_relative_path.get(relative_path)
+                tasks.append((entity_type, yaml_file_path, relative_path,
+                    previous_record['canonical'] if previous_record is not None else None, args.report is not None))
+            for (relative_path, input_hash), (text, record, stats) in zip(changed_inputs,
+                    map_in_pool(canonicalize_file, tasks)):
+                counters.update(stats)
+                if text is None:
+                    input_hash_by_relative_path.pop(relative_path, None)
+                    continue
+                relative_paths.add(relative_path)
+                input_hash_by_relative_path[relative_path] = input_hash
+                record_by_relative_path[relative_path] = record_spool.add(record)
+                if entity_tree.write_if_changed(args.target_dir, relative_path, text, manifest):
+                    counters['files_written'] += 1
+                else:
+                    counters['files_unchanged'] += 1
+
+    for relative_path in list(record_by_relative_path):
+        if relative_path not in relative_paths:
+            del record_by_relative_path[relative_path]
+    with report.stage('link entities') as counters:
+        canonical_links.link_entities(args.target_dir, record_by_relative_path, manifest, stats=counters)
+
+    with report.stage('remove vanished entities') as counters:
+        counters['files_removed'] += len(entity_tree.remove_vanished_files(args.target_dir, manifest, relative_paths))
+    for relative_path in list(input_hash_by_relative_path):
+        if relative_path not in relative_paths:
+            del input_hash_by_relative_path[relative_path]
+    with report.stage('write index') as counters:
+        canonical_index.save_index(args.target_dir, record_by_relative_path, record_spool, stats=counters)
+    record_spool.close()
+    entity_tree.save_manifest(args.target_dir, manifest)
+    save_canonical_state(args.target_dir, state)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if args.report is not None:
+        report.save(args.report)
 
     return 0
 
 
+def save_canonical_state(dir, state):
+    state_path = os.path.join(dir, canonical_state_filename)
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file, indent=0, sort_keys=True)
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,67 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Dotted paths (like "wikidata.license_label.0.value") compiled once into accessors of nested YAML data.
+
+A segment made of digits is an index in a list, any other segment is a key in a mapping.
+"""
+
+
+import functools
+
+
+class CompiledPath:
+    __slots__ = ('keys', 'path', 'source')
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = tuple(
+            int(key) if key.isdigit() else key
+            for key in path.split('.')
+            ) if path else ()
+        # The first segment of a path is the name of the source of the data.
+        self.source = path.split('.', 1)[0]
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.path)
+
+    def get(self, item, default=None):
+        """Return the value at this path in item, or default when it is missing (or None)."""
+        for key in self.keys:
+            if item is None:
+                return default
+            if isinstance(key, int):
+                if not isinstance(item, (list, tuple)):
+                    return default
+                item = item[key] if key < len(item) else None
+            else:
+                if not isinstance(item, dict):
+                    return default
+                item = item.get(key)
+        return item if item is not None else default
+
+
+@functools.lru_cache(maxsize=None)
+def compile_path(path):
+    return CompiledPath(path)
+
+
+def get_path(item, path, default=None):
+    return compile_path(path).get(item, default=default)
@@ -23,175 +23,217 @@
 
 import argparse
 import collections
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
 import os
-import shutil
+import pickle
+import sqlite3
+import subprocess
 import sys
+import tempfile
 
 import apt_pkg
-import yaml
 
-
-# YAML configuration
-
-
-class folded_str(str):
-    pass
-
-
-class literal_str(str):
-    pass
-
-
-def dict_constructor(loader, node):
-    return collections.OrderedDict(loader.construct_pairs(node))
-
-
-def dict_representer(dumper, data):
-    return dumper.represent_dict(sorted(data.items()))
-
-
-yaml.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
-
-yaml.add_representer(folded_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='>'))
-yaml.add_representer(literal_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='|'))
-yaml.add_representer(collections.OrderedDict, dict_representer)
-yaml.add_representer(str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str', data))
+import canonical_index
+import canonical_links
+import canonical_rules
+import dir_index
+import entity_tree
+import run_report
+import yaml_io
 
 
 # YAML directories iterators
 
 
-def iter_udd_yaml_dir(dir, canonical_name_by_name, entity_by_canonical_name, update_only):
-    assert os.path.exists(dir), "Directory doesn't exist: {}".format(dir)
-
-    apt_pkg.init()
-
-    tools_name = set()
-    for part in ('packages', 'sources'):
-        for sub_dir, dirs_name, filenames in os.walk(os.path.join(dir, part)):
-            for dir_name in dirs_name[:]:
-                if dir_name.startswith('.'):
-                    dirs_name.remove(dir_name)
-            for filename in filenames:
-                if not filename.endswith(".yaml"):
-                    continue
-                name = os.path.splitext(filename)[0]
-                tools_name.add(name)
+def iter_udd_yaml_dir(dir, canonical_name_by_name, entity_by_canonical_name, update_only, names=None):
+    # Index packages & sources in a single pass, instead of looking for each name in both parts.
+    index = dir_index.load_yaml_dir_index(dir, cache_dir=args.cache_dir)
+    file_stat_by_relative_path = index['files']
+    paths_by_name = {}
+    for name, relative_path in dir_index.iter_names(index):
+        if names is not None and name not in names:
+            continue
+        part = relative_path.split(os.sep, 1)[0]
+        if part not in ('packages', 'sources'):
+            continue
+        report.add('files_scanned')
+        paths = paths_by_name.setdefault(name, [None, None])
+        paths[0 if part == 'packages' else 1] = os.path.join(dir, relative_path)
 
-    for name in tools_name:
+    canonical_names = []
+    names_and_paths = []
+    for name, (package_path, source_path) in sorted(paths_by_name.items()):
         canonical_name = canonical_name_by_name.get(name, name)
         entity = entity_by_canonical_name.get(canonical_name)
         if entity is None and update_only:
             continue
-
-        package_path = os.path.join(
-            dir,
-            'packages',
-            name[:4] if name.startswith('lib') else name[0],
-            '{}.yaml'.format(name),
-            )
-        if os.path.exists(package_path):
-            with open(package_path) as package_file:
-                package = yaml.load(package_file)
-        else:
-            package = None
-
-        source_path = os.path.join(
-            dir,
-            'sources',
-            name[:4] if name.startswith('lib') else name[0],
-            '{}.yaml'.format(name)
-            )
-        if os.path.exists(source_path):
-            with open(source_path) as source_file:
-                source = yaml.load(source_file)
-        else:
-            source = None
-
-        debian = collections.OrderedDict()
-        debian['name'] = name
-        if package is not None:
-            descriptions_by_architecture = {}
-            release_by_name = package.get('releases', {})
-            release = release_by_name.get(debian_stable_release_name)
-            releases = release_by_name.values() if release is None else [release]
-            for release in releases:
-                for component in release.values():
-                    versions = component.get('versions')
-                    if versions is None:
-                        continue
-                    latest_version_str = None
-                    for version_str in versions:
-                        if latest_version_str is None or apt_pkg.version_compare(latest_version_str, version_str) < 0:
-                            latest_version_str = version_str
-                    version = versions[latest_version_str]
-                    for architecture, package in version.get('architectures', {}).items():
-                        description_md5 = package['description_md5']
-                        descriptions = component.get('descriptions', {}).get(description_md5)
-                        if descriptions is not None:
-                            descriptions_by_architecture[architecture] = descriptions
-            if descriptions_by_architecture:
-                debian['description'] = descriptions_by_architecture.get('all') or \
-                    descriptions_by_architecture.get('amd64') or list(descriptions_by_architecture.values())[0]
-
-            screenshots = package.get('screenshots')
-            screenshot = extract_latest_debian_screenshot(*screenshots) if screenshots is not None else None
-            versions = package.get('versions')
-            if versions is not None:
-                for version in versions.values():
-                    screenshots = version.get('screenshots')
-                    if screenshots is not None:
-                        screenshot = extract_latest_screenshot(screenshot, *screenshots)
-            if screenshot:
-                debian['screenshot'] = collections.OrderedDict([
-                    ('large_image_url', screenshot['large_image_url']),
-                    ('screenshot_url', screenshot['screenshot_url']),
-                    ('small_image_url', screenshot['small_image_url']),
-                ])
-
-        if source is not None:
-            security_issues = source.get('security_issues')
-            if security_issues:
-                debian['security_issues'] = security_issues
-
+        canonical_names.append(canonical_name)
+        names_and_paths.append((name, package_path, source_path))
+        for path in (package_path, source_path):
+            if path is not None:
+                report.add('files_parsed')
+                report.add('bytes_read', file_stat_by_relative_path[os.path.relpath(path, dir)][0])
+
+    for canonical_name, debian in zip(canonical_names, map_in_pool(load_udd_tool, names_and_paths)):
         if not debian:
             continue
         yield canonical_name, debian
 
 
+def load_udd_tool(name_and_paths):
+    name, package_path, source_path = name_and_paths
+    package = yaml_io.load_file(package_path) if package_path is not None else None
+    source = yaml_io.load_file(source_path) if source_path is not None else None
+
+    debian = collections.OrderedDict()
+    debian['name'] = name
+    if package is not None:
+        descriptions_by_architecture = {}
+        release_by_name = package.get('releases', {})
+        release = release_by_name.get(debian_stable_release_name)
+        releases = release_by_name.values() if release is None else [release]
+        for release in releases:
+            for component in release.values():
+                versions = component.get('versions')
+                if versions is None:
+                    continue
+                version = versions[get_latest_debian_version_str(versions)]
+                for architecture, package in version.get('architectures', {}).items():
+                    description_md5 = package['description_md5']
+                    descriptions = component.get('descriptions', {}).get(description_md5)
+                    if descriptions is not None:
+                        descriptions_by_architecture[architecture] = descriptions
+        if descriptions_by_architecture:
+            debian['description'] = descriptions_by_architecture.get('all') or \
+                descriptions_by_architecture.get('amd64') or list(descriptions_by_architecture.values())[0]
+
+        screenshots = package.get('screenshots')
+        screenshot = extract_latest_debian_screenshot(*screenshots) if screenshots is not None else None
+        versions = package.get('versions')
+        if versions is not None:
+            for version in versions.values():
+                screenshots = version.get('screenshots')
+                if screenshots is not None:
+                    screenshot = extract_latest_screenshot(screenshot, *screenshots)
+        if screenshot:
+            debian['screenshot'] = collections.OrderedDict([
+                ('large_image_url', screenshot['large_image_url']),
+                ('screenshot_url', screenshot['screenshot_url']),
+                ('small_image_url', screenshot['small_image_url']),
+            ])
+
+    if source is not None:
+        security_issues = source.get('security_issues')
+        if security_issues:
+            debian['security_issues'] = security_issues
+
+    return debian
+
+
 def make_yaml_dir_iter(entity_relative_dir=None):
-    def iter_yaml_dir(dir, canonical_name_by_name, entity_by_canonical_name, update_only):
+    def iter_yaml_dir(dir, canonical_name_by_name, entity_by_canonical_name, update_only, names=None):
         if entity_relative_dir is not None:
             dir = os.path.join(dir, entity_relative_dir)
         assert os.path.exists(dir), "Directory doesn't exist: {}".format(dir)
-        for sub_dir, dirs_name, filenames in os.walk(dir):
-            for dir_name in dirs_name[:]:
-                if dir_name.startswith('.'):
-                    dirs_name.remove(dir_name)
-            for filename in filenames:
-                if not filename.endswith(".yaml"):
-                    continue
-                name = os.path.splitext(filename)[0]
-                canonical_name = canonical_name_by_name.get(name, name)
-                entity = entity_by_canonical_name.get(canonical_name)
-                if entity is None and update_only:
-                    continue
-                yaml_path = os.path.join(sub_dir, filename)
-                with open(yaml_path) as yaml_file:
-                    yield canonical_name, yaml.load(yaml_file)
+        canonical_names = []
+        yaml_paths = []
+        # Use the (cached) index of the directory instead of walking it and, for update-only sources, load only the
+        # files of already existing entities.
+        index = dir_index.load_yaml_dir_index(dir, cache_dir=args.cache_dir)
+        for name, relative_path in dir_index.iter_names(index):
+            if names is not None and name not in names:
+                continue
+            report.add('files_scanned')
+            canonical_name = canonical_name_by_name.get(name, name)
+            entity = entity_by_canonical_name.get(canonical_name)
+            if entity is None and update_only:
+                continue
+            canonical_names.append(canonical_name)
+            yaml_paths.append(os.path.join(dir, relative_path))
+            report.add('files_parsed')
+            report.add('bytes_read', index['files'][relative_path][0])
+        yield from zip(canonical_names, map_in_pool(yaml_io.load_file, yaml_paths))
     return iter_yaml_dir
 
 
+def iter_source_entities(source_name, canonical_name_by_name, entity_by_canonical_name_by_type, names=None):
+    """Iterate over the (entity_type, canonical_name, source_entity) triples of a source.
+
+    entity_by_canonical_name_by_type gives the existing entities, used to filter the entities of update-only sources.
+    When names is given, only the files with these names are parsed.
+    """
+    source_config = source_config_by_name[source_name]
+    print('Merging source {}...'.format(source_name))
+    update_only = source_config.get('update_only', False)
+    with report.stage('merge {}'.format(source_name)):
+        for entity_type in ('actors', 'projects', 'tools'):
+            entities_iter = source_config.get('{}_iter'.format(entity_type))
+            if entities_iter is None:
+                continue
+            for canonical_name, source_entity in entities_iter(
+                    os.path.join(args.source_dir, source_config['dir']),
+                    canonical_name_by_name,
+                    entity_by_canonical_name_by_type.setdefault(entity_type, {}),
+                    update_only,
+                    names = names,
+                    ):
+                source_entity['_source'] = dict(
+                    data_repository_url = source_config['data_repository_url'],
+                    name = source_config['name'],
+                    source_url = source_config['source_url'],
+                    )
+                yield entity_type, canonical_name, source_entity
+
+
+def merge_source(source_name, canonical_name_by_name, entity_by_canonical_name_by_type, names=None):
+    """Merge the entities of a source into entity_by_canonical_name_by_type.
+
+    Return the canonical names of the entities that received a sub-document from this source, by entity type.
+    """
+    merged_canonical_names_by_type = {}
+    for entity_type, canonical_name, source_entity in iter_source_entities(source_name, canonical_name_by_name,
+            entity_by_canonical_name_by_type, names = names):
+        entity_by_canonical_name = entity_by_canonical_name_by_type[entity_type]
+        entity = entity_by_canonical_name.get(canonical_name)
+        if entity is None:
+            entity_by_canonical_name[canonical_name] = entity = {}
+            report.add('entities_created')
+        else:
+            report.add('entities_updated')
+        entity[source_name] = source_entity
+        merged_canonical_names_by_type.setdefault(entity_type, set()).add(canonical_name)
+    return merged_canonical_names_by_type
+
+
+def map_in_pool(function, items):
+    """Apply function to each item, using the worker processes when --jobs is given.
+
+    Results are always returned in the order of items, so that merging stays deterministic.
+    """
+    if pool is None:
+        return map(function, items)
+    chunksize = max(1, min(64, len(items) // (args.jobs * 4)))
+    return pool.imap(function, items, chunksize)
+
+
 #
 
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
 args = None
+# Summaries of the index records of the entities of canonical_dir, by relative path
+canonical_record_by_relative_path = None
+# Full index records of the entities written to canonical_dir during the run
+canonical_record_spool = None
 debian_stable_release_name = 'jessie'
 log = logging.getLogger(app_name)
+merge_state_filename = '.sources.json'
+pool = None
+report = run_report.RunReport()
 source_config_by_name = {
     # Sources that are allowed to create new entities
     'civic-graph': dict(
@@ -289,6 +331,23 @@ source_config_by_name = {
 sources_name = sorted(source_config_by_name.keys())
 
 
+class SpilledEntities:
+    """Read-only view of the entities of a given type stored in a scratch database.
+
+    Like a dict, it provides the get() method used by sources iterators.
+    """
+    def __init__(self, connection, entity_type):
+        self.connection = connection
+        self.entity_type = entity_type
+
+    def get(self, canonical_name, default=None):
+        row = self.connection.execute(
+            'SELECT 1 FROM source_entity WHERE entity_type = ? AND canonical_name = ? LIMIT 1',
+            (self.entity_type, canonical_name),
+            ).fetchone()
+        return default if row is None else True
+
+
 def extract_latest_debian_screenshot(*screenshots):
     latest_number = -1
     latest_screenshot = None
@@ -302,107 +361,491 @@ def extract_latest_debian_screenshot(*screenshots):
     return latest_screenshot
 
 
+def get_merge_ordered_sources_name():
+    """Return the names of the sources, in merge order: sources allowed to create new entities come first."""
+    return [
+        source_name
+        for source_name, source_config in sorted(source_config_by_name.items(),
+            key = lambda name_config_couple: name_config_couple[1].get('update_only', False))
+        ]
+
+
+def get_source_changes(dir, previous_commit):
+    """Use git to find the YAML files changed in the repository of a source since its previous merge.
+
+    Return a (commit, names) couple, where commit is the current HEAD (None when it must not be recorded, because the
+    directory is not a clean git repository) and names is the set of the names of the added, modified & deleted files
+    (None when the whole source must be parsed again).
+    """
+    process = run_git(dir, 'rev-parse', 'HEAD')
+    if process.returncode != 0:
+        log.info('Source directory {} is not a git repository'.format(dir))
+        return None, None
+    commit = process.stdout.strip()
+    process = run_git(dir, 'status', '--porcelain', '--', '.')
+    if process.returncode != 0 or process.stdout.strip():
+        log.info('Git repository {} is dirty, it will be fully parsed'.format(dir))
+        return None, None
+    if previous_commit is None:
+        return commit, None
+    if previous_commit == commit:
+        return commit, set()
+    if run_git(dir, 'merge-base', '--is-ancestor', previous_commit, commit).returncode != 0:
+        log.info('History of git repository {} has been rewritten, it will be fully parsed'.format(dir))
+        return commit, None
+    process = run_git(dir, 'diff', '--name-only', '--no-renames', '--relative', '-z', previous_commit, commit, '--',
+        '.')
+    if process.returncode != 0:
+        return commit, None
+    return commit, set(
+        os.path.splitext(os.path.basename(path))[0]
+        for path in process.stdout.split('\0')
+        if path.endswith('.yaml')
+        )
+
+
+def get_specificities_hash(canonical_name_by_name_by_source):
+    return hashlib.sha256(json.dumps(canonical_name_by_name_by_source, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_latest_debian_version_str(versions_str):
+    # A plain loop calling apt_pkg directly: memoizing the comparisons, sorting with functools.cmp_to_key, caching sort
+    # keys by version string or persisting the latest version by tuple of versions all add more Python overhead than
+    # calls to apt_pkg.version_compare cost, even for long version histories (see tests/benchmark_debian_versions.py).
+    latest_version_str = None
+    for version_str in versions_str:
+        if latest_version_str is None or apt_pkg.version_compare(latest_version_str, version_str) < 0:
+            latest_version_str = version_str
+    return latest_version_str
+
+
+def init_rules_stats():
+    """Add the statistics of all the canonical rules to the current stage of the report, so that rules that never hit
+    are reported too.
+    """
+    if args.canonical_dir is not None and args.report is not None:
+        for entity_type in canonical_rules.rules_by_entity_type:
+            report.counters.update(dict.fromkeys(canonical_rules.iter_rule_stats_keys(entity_type), 0))
+
+
+def iter_spilled_entities(connection):
+    """Iterate over the (entity_type, canonical_name, entity) triples of a scratch database, sorted by entity type and
+    canonical name, so that only one entity is in memory at a time.
+    """
+    rows = connection.execute(
+        'SELECT entity_type, canonical_name, source_name, source_entity FROM source_entity'
+        ' ORDER BY entity_type, canonical_name')
+    for (entity_type, canonical_name), entity_rows in itertools.groupby(rows, key=lambda row: row[:2]):
+        yield entity_type, canonical_name, {
+            source_name: pickle.loads(source_entity)
+            for _, _, source_name, source_entity in entity_rows
+            }
+
+
+def load_merged_entities(dir):
+    entity_by_canonical_name_by_type = {}
+    with report.stage('load merged entities'):
+        for entity_type in os.listdir(dir):
+            type_dir = os.path.join(dir, entity_type)
+            if entity_type.startswith('.') or not os.path.isdir(type_dir):
+                continue
+            canonical_names = []
+            entities_path = []
+            # Entities may be sharded in sub-directories.
+            for entity_path in sorted(yaml_io.iter_yaml_paths(type_dir), key = os.path.basename):
+                canonical_names.append(os.path.splitext(os.path.basename(entity_path))[0])
+                entities_path.append(entity_path)
+            report.add('files_parsed', len(entities_path))
+            entity_by_canonical_name_by_type[entity_type] = dict(zip(canonical_names,
+                map_in_pool(yaml_io.load_file, entities_path)))
+    return entity_by_canonical_name_by_type
+
+
+def load_merge_state(dir):
+    state_path = os.path.join(dir, merge_state_filename)
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def make_entity_type_dirs(dir):
+    """Create the directory of each entity type that an enabled source provides, even when it has no entity, as
+    expected by the readers of merged & canonical trees.
+    """
+    for entity_type in canonical_rules.rules_by_entity_type:
+        if any(
+                source_config.get('{}_iter'.format(entity_type)) is not None
+                for source_config in source_config_by_name.values()
+                if not source_config.get('disabled', False)
+                ):
+            entity_type_dir = os.path.join(dir, entity_type)
+            if not os.path.exists(entity_type_dir):
+                os.makedirs(entity_type_dir)
+
+
+def patch_merged_entities(entity_by_canonical_name_by_type, names_by_source_name, canonical_name_by_name_by_source):
+    """Merge some sources again into already merged entities.
+
+    names_by_source_name gives, for each source to merge again, the names of the files to parse again (None to parse
+    the whole source). Sources are merged in the same order as in a full merge.
+
+    Return the canonical names of the changed entities, by entity type.
+    """
+    existing_canonical_names_by_type = {
+        entity_type: set(entity_by_canonical_name)
+        for entity_type, entity_by_canonical_name in entity_by_canonical_name_by_type.items()
+        }
+    changed_canonical_names_by_type = {}
+    created_canonical_names = set()
+    for source_name in get_merge_ordered_sources_name():
+        if source_name not in names_by_source_name:
+            continue
+        names = names_by_source_name[source_name]
+        canonical_name_by_name = canonical_name_by_name_by_source.get(source_name, {})
+        update_only = source_config_by_name[source_name].get('update_only', False)
+        if names is None:
+            canonical_names = None
+        else:
+            canonical_names = set(canonical_name_by_name.get(name, name) for name in names)
+            if update_only:
+                # Entities created during this merge must receive the sub-documents of update-only sources too.
+                canonical_names.update(created_canonical_names)
+            if not canonical_names:
+                continue
+            # Parse again every file merged into the same entities, because the last one wins.
+            names = set(names)
+            names.update(
+                name
+                for name, canonical_name in canonical_name_by_name.items()
+                if canonical_name in canonical_names
+                )
+            names.update(
+                canonical_name
+                for canonical_name in canonical_names
+                if canonical_name_by_name.get(canonical_name, canonical_name) == canonical_name
+                )
+
+        for entity_type, entity_by_canonical_name in entity_by_canonical_name_by_type.items():
+            for canonical_name in (entity_by_canonical_name if canonical_names is None else canonical_names):
+                entity = entity_by_canonical_name.get(canonical_name)
+                if entity is not None and entity.pop(source_name, None) is not None:
+                    changed_canonical_names_by_type.setdefault(entity_type, set()).add(canonical_name)
+
+        for entity_type, merged_canonical_names in merge_source(source_name, canonical_name_by_name,
+                entity_by_canonical_name_by_type, names = names).items():
+            changed_canonical_names_by_type.setdefault(entity_type, set()).update(merged_canonical_names)
+            new_canonical_names = merged_canonical_names - existing_canonical_names_by_type.get(entity_type, set())
+            created_canonical_names.update(new_canonical_names)
+    return changed_canonical_names_by_type
+
+
+def run_git(dir, *arguments):
+    return subprocess.run(['git', '-C', dir] + list(arguments), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True)
+
+
+def save_merge_state(dir, state):
+    state_path = os.path.join(dir, merge_state_filename)
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+
+
+def spill_source(source_name, canonical_name_by_name, connection):
+    """Store the entities of a source in a scratch database, instead of merging them in memory."""
+    entity_by_canonical_name_by_type = {
+        entity_type: SpilledEntities(connection, entity_type)
+        for entity_type in ('actors', 'projects', 'tools')
+        }
+    for entity_type, canonical_name, source_entity in iter_source_entities(source_name, canonical_name_by_name,
+            entity_by_canonical_name_by_type):
+        connection.execute('INSERT OR REPLACE INTO source_entity VALUES (?, ?, ?, ?)',
+            (entity_type, canonical_name, source_name, pickle.dumps(source_entity, pickle.HIGHEST_PROTOCOL)))
+        report.add('entities_spilled')
+    connection.commit()
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('source_name', choices=['all'] + sources_name, help='source name ("all" to merge all sources)')
+    parser.add_argument('source_name', choices=['all'] + sources_name,
+        help='source name ("all" to merge all sources, a source name to update only this source in target_dir)')
     parser.add_argument('source_dir', help='path of directory containing source data directories')
-    parser.add_argument('target_dir', help='path of target directory for generated YAML files')
+    parser.add_argument('target_dir', nargs='?',
+        help='path of target directory for generated YAML files (optional with --canonical-dir, for "all" only)')
+    parser.add_argument('--cache-dir', dest='cache_dir',
+        help='path of directory where indexes of source directories are kept between runs')
+    parser.add_argument('--canonical-dir', dest='canonical_dir',
+        help='path of directory where merged YAML files with canonical attributes are also generated')
+    parser.add_argument('-i', '--incremental', action='store_true', default=False,
+        help='parse only the files changed (according to git) since the previous merge of each source ("all" only)')
+    parser.add_argument('--low-memory', action='store_true', default=False, dest='low_memory',
+        help='spill parsed entities to a scratch database instead of keeping them all in memory ("all" only)')
+    parser.add_argument('--report', help='path of JSON file where a report of the run (times, counters...) is written')
+    parser.add_argument('--sharded', action='store_true', default=False,
+        help='write entities in sub-directories named after the first letter (or "libx" prefix) of their name')
     parser.add_argument('--specificities-dir', default='./specificities', dest='specificities_dir',
         help='path of directory containing merge particularities in YAML files')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+        help='number of worker processes used to parse YAML files (default: 1, no worker)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='increase output verbosity')
     global args
     args = parser.parse_args()
+    if args.target_dir is None:
+        if args.canonical_dir is None:
+            parser.error('target_dir is required without --canonical-dir')
+        if args.source_name != 'all' or args.incremental:
+            parser.error('target_dir is required to update a merged tree')
+    elif args.canonical_dir is not None and os.path.abspath(args.canonical_dir) == os.path.abspath(args.target_dir):
+        parser.error('--canonical-dir must differ from target_dir')
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stdout)
 
+    apt_pkg.init()
+    global pool
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=apt_pkg.init)
+
     assert os.path.exists(args.source_dir)
-    if os.path.exists(args.target_dir):
-        for filename in os.listdir(args.target_dir):
-            if filename.startswith('.'):
-                continue
-            path = os.path.join(args.target_dir, filename)
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-    else:
-        os.makedirs(args.target_dir)
 
     canonical_name_by_name_by_source = {}
-    for filename in os.listdir(args.specificities_dir):
-        if not filename.endswith(".yaml"):
-            continue
-        canonical_name = os.path.splitext(filename)[0]
-        yaml_path = os.path.join(args.specificities_dir, filename)
-        with open(yaml_path) as yaml_file:
-            specificities = yaml.load(yaml_file)
-            for source_name, source_specificities in specificities.items():
-                if source_specificities is None:
-                    continue
-                assert source_name in sources_name, 'Invalid source "{}" in specificities file "{}"'.format(
-                    source_name, yaml_path)
-                name = source_specificities.get('name')
-                if name:
-                    canonical_name_by_name_by_source.setdefault(source_name, {})[name] = canonical_name
+    with report.stage('load specificities'):
+        for filename in os.listdir(args.specificities_dir):
+            if not filename.endswith(".yaml"):
+                continue
+            canonical_name = os.path.splitext(filename)[0]
+            yaml_path = os.path.join(args.specificities_dir, filename)
+            with open(yaml_path) as yaml_file:
+                specificities = yaml_io.load(yaml_file)
+                report.add('files_parsed')
+                for source_name, source_specificities in specificities.items():
+                    if source_specificities is None:
+                        continue
+                    assert source_name in sources_name, 'Invalid source "{}" in specificities file "{}"'.format(
+                        source_name, yaml_path)
+                    name = source_specificities.get('name')
+                    if name:
+                        canonical_name_by_name_by_source.setdefault(source_name, {})[name] = canonical_name
+
+    manifest = None
+    if args.target_dir is not None:
+        if not os.path.exists(args.target_dir):
+            os.makedirs(args.target_dir)
+        manifest = entity_tree.load_manifest(args.target_dir)
+    canonical_manifest = None
+    if args.canonical_dir is not None:
+        if not os.path.exists(args.canonical_dir):
+            os.makedirs(args.canonical_dir)
+        canonical_manifest = entity_tree.load_manifest(args.canonical_dir)
+        global canonical_record_by_relative_path
+        canonical_record_by_relative_path = canonical_index.load_record_by_relative_path(args.canonical_dir)
+        global canonical_record_spool
+        canonical_record_spool = canonical_index.RecordSpool()
+    state = load_merge_state(args.target_dir) if args.target_dir is not None else {}
+    specificities_hash = get_specificities_hash(canonical_name_by_name_by_source)
+    if args.source_name != 'all' and state.get('sharded', False) != args.sharded \
+            and os.path.exists(os.path.join(args.target_dir, entity_tree.manifest_filename)):
+        log.error('Layout of merged tree {} differs from --sharded option: merge all sources to change it'.format(
+            args.target_dir))
+        return 1
+    if state.get('specificities') != specificities_hash or state.get('sharded', False) != args.sharded:
+        # Entities may have been renamed or moved: previous commits can't be used anymore.
+        state = dict(
+            commit_by_source_name = {},
+            sharded = args.sharded,
+            specificities = specificities_hash,
+            )
+    commit_by_source_name = state['commit_by_source_name']
 
     if args.source_name == 'all':
-        entity_by_canonical_name_by_type = {}
-        for source_name, source_config in sorted(source_config_by_name.items(),
-                key = lambda name_config_couple: name_config_couple[1].get('update_only', False)):
-            if source_config.get('disabled', False):
+        enabled_sources_name = []
+        for source_name in get_merge_ordered_sources_name():
+            if source_config_by_name[source_name].get('disabled', False):
                 print('Skipping disabled source {}.'.format(source_name))
                 continue
-            print('Merging source {}...'.format(source_name))
-            canonical_name_by_name = canonical_name_by_name_by_source.get(source_name, {})
-            update_only = source_config.get('update_only', False)
-            for entity_type in ('actors', 'projects', 'tools'):
-                entities_iter = source_config.get('{}_iter'.format(entity_type))
-                if entities_iter is None:
-                    continue
-                entity_by_canonical_name = entity_by_canonical_name_by_type.setdefault(entity_type, {}) 
-                for canonical_name, source_entity in entities_iter(
-                        os.path.join(args.source_dir, source_config['dir']),
-                        canonical_name_by_name,
-                        entity_by_canonical_name,
-                        update_only,
-                        ):
-                    source_entity['_source'] = dict(
-                        data_repository_url = source_config['data_repository_url'],
-                        name = source_config['name'],
-                        source_url = source_config['source_url'],
-                        )
-                    entity = entity_by_canonical_name.get(canonical_name)
-                    if entity is None:
-                        entity_by_canonical_name[canonical_name] = entity = {}
-                    entity[source_name] = source_entity
-
-        for entity_type, entity_by_canonical_name in entity_by_canonical_name_by_type.items():
-            type_dir = os.path.join(args.target_dir, entity_type)
-            if not os.path.exists(type_dir):
-                os.makedirs(type_dir)
-            for canonical_name, entity in entity_by_canonical_name.items():
-                entity_path = os.path.join(type_dir, '{}.yaml'.format(canonical_name))
-                with open(entity_path, 'w') as entity_file:
-                    yaml.dump(entity, entity_file, allow_unicode=True, default_flow_style=False, indent=2, width=120)
-    # else:
-    #     TODO
-    #     source_config = source_config_by_name[args.source_name]
-    #     if not source_config.get('disabled', False):
-    #         update_only = source_config.get('update_only', False)
-    #     entity_by_canonical_name_by_type = {}
-    #     for entity_type in os.listdir(args.target_dir):
-    #         if entity_type.startswith('.'):
-    #             continue
-    #         entity_by_canonical_name = entity_by_canonical_name_by_type.setdefault(entity_type, {})
-    #         for filename in os.listdir(os.path.join(args.source_name, entity_type)):
-    #             if not filename.endsswith('.yaml'):
-    #                 continue
-    #             canonical_name = os.path.splitext(filename)[0]
-    #             with open(os.path.join(os.path.join(args.source_name, entity_type, filename))) as entity_file:
-    #                 entity = yaml.load(entity_file)
-    #             with open()
-    #             entity_by_canonical_name[canonical_name] = yaml.load(yaml_file)
+            enabled_sources_name.append(source_name)
+
+        names_by_source_name = {}
+        with report.stage('detect source changes'):
+            for source_name in enabled_sources_name:
+                previous_commit = commit_by_source_name.get(source_name) \
+                    if args.incremental and set(commit_by_source_name) == set(enabled_sources_name) else None
+                commit, names_by_source_name[source_name] = get_source_changes(
+                    os.path.join(args.source_dir, source_config_by_name[source_name]['dir']), previous_commit)
+                if commit is None:
+                    commit_by_source_name.pop(source_name, None)
+                else:
+                    commit_by_source_name[source_name] = commit
+        for source_name in list(commit_by_source_name):
+            if source_name not in enabled_sources_name:
+                del commit_by_source_name[source_name]
+
+        if all(names is None for names in names_by_source_name.values()):
+            if args.low_memory:
+                # Spill the entities of every source to a scratch SQLite database, then read them back sorted by
+                # canonical name.
+                scratch_dir = tempfile.TemporaryDirectory(prefix='{}-'.format(app_name))
+                connection = sqlite3.connect(os.path.join(scratch_dir.name, 'entities.sqlite'))
+                connection.execute('CREATE TABLE source_entity (entity_type TEXT, canonical_name TEXT,'
+                    ' source_name TEXT, source_entity BLOB, PRIMARY KEY (entity_type, canonical_name, source_name))')
+            else:
+                entity_by_canonical_name_by_type = {}
+            for source_name in enabled_sources_name:
+                if args.low_memory:
+                    spill_source(source_name, canonical_name_by_name_by_source.get(source_name, {}), connection)
+                else:
+                    merge_source(source_name, canonical_name_by_name_by_source.get(source_name, {}),
+                        entity_by_canonical_name_by_type)
+
+            if args.low_memory:
+                entities = iter_spilled_entities(connection)
+            else:
+                entities = (
+                    (entity_type, canonical_name, entity)
+                    for entity_type, entity_by_canonical_name in entity_by_canonical_name_by_type.items()
+                    for canonical_name, entity in entity_by_canonical_name.items()
+                    )
+            with report.stage('write merged entities'):
+                init_rules_stats()
+                relative_paths = set()
+                for entity_type, canonical_name, entity in entities:
+                    relative_path = entity_tree.get_relative_path(entity_type, canonical_name, args.sharded)
+                    relative_paths.add(relative_path)
+                    write_entity(entity_type, relative_path, entity, manifest, canonical_manifest)
+                if canonical_record_by_relative_path is not None:
+                    for relative_path in list(canonical_record_by_relative_path):
+                        if relative_path not in relative_paths:
+                            del canonical_record_by_relative_path[relative_path]
+                if manifest is not None:
+                    report.add('files_removed', len(entity_tree.remove_vanished_files(args.target_dir, manifest,
+                        relative_paths)))
+                if canonical_manifest is not None:
+                    report.add('canonical_files_removed', len(entity_tree.remove_vanished_files(args.canonical_dir,
+                        canonical_manifest, relative_paths)))
+            if args.low_memory:
+                connection.close()
+                scratch_dir.cleanup()
+        else:
+            # Patch the previously merged entities with the files changed in the git repositories of the sources.
+            for source_name, names in names_by_source_name.items():
+                if names:
+                    print('Source {}: {} changed files'.format(source_name, len(names)))
+                elif names is not None:
+                    print('Source {}: unchanged'.format(source_name))
+            entity_by_canonical_name_by_type = load_merged_entities(args.target_dir)
+            changed_canonical_names_by_type = patch_merged_entities(entity_by_canonical_name_by_type,
+                names_by_source_name, canonical_name_by_name_by_source)
+            write_patched_entities(entity_by_canonical_name_by_type, changed_canonical_names_by_type, manifest,
+                canonical_manifest)
+    else:
+        # Update only the sub-documents of a single source in an existing merged tree.
+        source_config = source_config_by_name[args.source_name]
+        if source_config.get('disabled', False):
+            print('Skipping disabled source {}.'.format(args.source_name))
+        else:
+            commit, _ = get_source_changes(os.path.join(args.source_dir, source_config['dir']), None)
+            entity_by_canonical_name_by_type = load_merged_entities(args.target_dir)
+            existing_canonical_names_by_type = {
+                entity_type: set(entity_by_canonical_name)
+                for entity_type, entity_by_canonical_name in entity_by_canonical_name_by_type.items()
+                }
+            changed_canonical_names_by_type = patch_merged_entities(entity_by_canonical_name_by_type,
+                {args.source_name: None}, canonical_name_by_name_by_source)
+            for entity_type, canonical_names in changed_canonical_names_by_type.items():
+                new_canonical_names = canonical_names - existing_canonical_names_by_type.get(entity_type, set())
+                if new_canonical_names and not source_config.get('update_only', False):
+                    log.warning('{} new {} created by source {}: merge update-only sources again to complete them'
+                        .format(len(new_canonical_names), entity_type, args.source_name))
+            write_patched_entities(entity_by_canonical_name_by_type, changed_canonical_names_by_type, manifest,
+                canonical_manifest)
+            if commit is None:
+                commit_by_source_name.pop(args.source_name, None)
+            else:
+                commit_by_source_name[args.source_name] = commit
+
+    if manifest is not None:
+        make_entity_type_dirs(args.target_dir)
+        entity_tree.save_manifest(args.target_dir, manifest)
+        save_merge_state(args.target_dir, state)
+    if canonical_manifest is not None:
+        make_entity_type_dirs(args.canonical_dir)
+        with report.stage('link canonical entities') as counters:
+            canonical_links.link_entities(args.canonical_dir, canonical_record_by_relative_path, canonical_manifest,
+                stats=counters)
+        with report.stage('write canonical index') as counters:
+            canonical_index.save_index(args.canonical_dir, canonical_record_by_relative_path, canonical_record_spool,
+                stats=counters)
+        canonical_record_spool.close()
+        entity_tree.save_manifest(args.canonical_dir, canonical_manifest)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if args.report is not None:
+        report.save(args.report)
 
     return 0
 
 
+def write_entity(entity_type, relative_path, entity, manifest, canonical_manifest):
+    """Write a merged entity to target_dir and, with --canonical-dir, the entity with its canonical attributes to
+    canonical_dir, without reparsing the merged YAML file.
+    """
+    if manifest is not None:
+        if entity_tree.write_if_changed(args.target_dir, relative_path, yaml_io.dumps(entity), manifest):
+            log.info('Updated {}'.format(os.path.join(args.target_dir, relative_path)))
+            report.add('files_written')
+        else:
+            report.add('files_unchanged')
+    if canonical_manifest is not None:
+        canonical = canonical_rules.canonicalize(entity_type, entity,
+            stats=report.counters if args.report is not None else None)
+        # Keep the previous links, so that the file is written once when they don't change.
+        previous_record = canonical_record_by_relative_path.get(relative_path)
+        canonical = canonical_links.copy_links(canonical,
+            previous_record['canonical'] if previous_record is not None else None)
+        if canonical:
+            entity = entity.copy()
+            entity['canonical'] = canonical
+        canonical_record_by_relative_path[relative_path] = canonical_record_spool.add(canonical_index.make_record(
+            entity_type, relative_path, entity))
+        if entity_tree.write_if_changed(args.canonical_dir, relative_path, yaml_io.dumps(entity), canonical_manifest):
+            report.add('canonical_files_written')
+        else:
+            report.add('canonical_files_unchanged')
+
+
+def write_patched_entities(entity_by_canonical_name_by_type, changed_canonical_names_by_type, manifest,
+        canonical_manifest):
+    with report.stage('write merged entities'):
+        init_rules_stats()
+        for entity_type, canonical_names in sorted(changed_canonical_names_by_type.items()):
+            entity_by_canonical_name = entity_by_canonical_name_by_type[entity_type]
+            for canonical_name in sorted(canonical_names):
+                entity = entity_by_canonical_name[canonical_name]
+                relative_path = entity_tree.get_relative_path(entity_type, canonical_name, args.sharded)
+                if all(
+                        source_config_by_name[source_name].get('update_only', False)
+                        for source_name in entity
+                        ):
+                    # No remaining source is allowed to create this entity.
+                    del entity_by_canonical_name[canonical_name]
+                    if canonical_record_by_relative_path is not None:
+                        canonical_record_by_relative_path.pop(relative_path, None)
+                    for dir, dir_manifest, counter_name in (
+                            (args.target_dir, manifest, 'files_removed'),
+                            (args.canonical_dir, canonical_manifest, 'canonical_files_removed'),
+                            ):
+                        if dir_manifest is None:
+                            continue
+                        dir_manifest.pop(relative_path, None)
+                        entity_path = os.path.join(dir, relative_path)
+                        if os.path.exists(entity_path):
+                            log.info('Removing {}'.format(entity_path))
+                            os.remove(entity_path)
+                            report.add(counter_name)
+                    continue
+                write_entity(entity_type, relative_path, entity, manifest, canonical_manifest)
+
+
 if __name__ == "__main__":
     sys.exit(main())
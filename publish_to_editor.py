@@ -21,44 +21,35 @@
 # along with this program.  If not, see <http:>www.gnu.org/licenses/>.
 
 
+"""Publish the canonical tools of a directory of YAML files to the OGPToolbox Editor.
+
+All requests share a single HTTP session (with keep-alive connections) and tools are sent by a bounded pool of
+threads. The latency of the requests is summarized at the end of the run.
+
+A local ledger keeps, for each tool published to a server, its editor id, the hash of its last sent payload and the
+hash of its YAML file. Only the tools whose file and payload changed since then are sent again. The ledger is kept
+outside of the source directory (in the current directory by default), because the source directory is a published
+data repository.
+"""
+
+
 import argparse
 import collections
+import concurrent.futures
+import json
 import logging
 import os
+import shutil
 import sys
+import time
 import urllib.parse
 
 import requests
-import yaml
-
-
-# YAML configuration
-
-
-class folded_str(str):
-    pass
-
-
-class literal_str(str):
-    pass
-
-
-def dict_constructor(loader, node):
-    return collections.OrderedDict(loader.construct_pairs(node))
-
-
-def dict_representer(dumper, data):
-    return dumper.represent_dict(sorted(data.items()))
-
-
-yaml.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
+import requests.adapters
 
-yaml.add_representer(folded_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='>'))
-yaml.add_representer(literal_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='|'))
-yaml.add_representer(collections.OrderedDict, dict_representer)
-yaml.add_representer(str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str', data))
+import entity_tree
+import run_report
+import yaml_io
 
 
 #
@@ -66,32 +57,48 @@ yaml.add_representer(str, lambda dumper, data: dumper.represent_scalar(u'tag:yam
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
 args = None
+default_ledger_filename = '.publish-ledger.json'
+latencies_by_method = collections.defaultdict(list)
 log = logging.getLogger(app_name)
+report = run_report.RunReport()
+session = None
 
 
-def iter_yaml_files(dir):
-    assert os.path.exists(dir), "Directory doesn't exist: {}".format(dir)
-    for sub_dir, dirs_name, filenames in os.walk(dir):
-        for dir_name in dirs_name[:]:
-            if dir_name.startswith('.'):
-                dirs_name.remove(dir_name)
-        for filename in filenames:
-            if not filename.endswith(".yaml"):
-                continue
-            yaml_file_path = os.path.join(sub_dir, filename)
-            with open(yaml_file_path) as yaml_file:
-                try:
-                    yield yaml_file_path, yaml.load(yaml_file)
-                except (UnicodeDecodeError, yaml.constructor.ConstructorError, yaml.parser.ParserError,
-                        yaml.scanner.ScannerError):
-                    log.warning("Invalid syntax in YAML file {}".format(yaml_file_path))
+def get_latency_stats(latencies):
+    """Return the count and the mean, median, 95th percentile & maximum (in milliseconds) of latencies."""
+    latencies = sorted(latencies)
+    return collections.OrderedDict([
+        ('count', len(latencies)),
+        ('mean_ms', round(1000 * sum(latencies) / len(latencies), 3)),
+        ('p50_ms', round(1000 * latencies[(len(latencies) - 1) // 2], 3)),
+        ('p95_ms', round(1000 * latencies[(len(latencies) - 1) * 95 // 100], 3)),
+        ('max_ms', round(1000 * latencies[-1], 3)),
+        ])
+
+
+def load_ledger(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as ledger_file:
+        return json.load(ledger_file)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('source_dir', help='path of source directory containing YAML files')
     parser.add_argument('server_url', help='URL of OGPToolbox Editor')
+    parser.add_argument('-c', '--concurrency', default=4, type=int,
+        help='maximum number of requests sent concurrently to the editor (default: 4)')
+    parser.add_argument('-f', '--full', action='store_true', default=False,
+        help='ignore the ledger and process every tool again (the ledger is rebuilt)')
+    parser.add_argument('-l', '--ledger', default=default_ledger_filename,
+        help='path of JSON file of the tools already published (default: {} in current directory)'.format(
+            default_ledger_filename))
     parser.add_argument('-p', '--password', help='password of user')
+    parser.add_argument('--report', help='path of JSON file where a report of the run (times, counters, latencies...)'
+        ' is written')
+    parser.add_argument('-t', '--timeout', default=60, type=float,
+        help='timeout of each request, in seconds (default: 60)')
     parser.add_argument('-u', '--user', help='username or email address of user')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='increase output verbosity')
     global args
@@ -99,101 +106,248 @@ def main():
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stdout)
 
-    # Login to retrieve user API key.
-    response = requests.post(urllib.parse.urljoin(args.server_url, 'login'), json = {
-        "userName": args.user,
-        "password": args.password,
-        })
-    data = response.json() 
-    api_key = data['data']['apiKey']
-
-    response = requests.get(
-        urllib.parse.urljoin(args.server_url, '/tools'),
-        headers = {
-            "OGPToolbox-API-Key": api_key,
-            },
-        )
-    tools_by_name = {
-        tool['name']: tool
-        for tool in response.json()['data']
-        }
-
-    for source_data_path, source_data in iter_yaml_files(args.source_dir):
-        canonical = source_data['canonical']
-        tool = dict(
-            name = source_data['name'],
-            )
-
-        description_fr = canonical.get('longDescription', {}).get('fr', {}).get('value')
-        if description_fr is not None:
-            tool['description_fr'] = description_fr
-
-        description_en = canonical.get('longDescription', {}).get('en', {}).get('value')
-        if description_en is not None:
-            tool['description_en'] = description_en
-
-        license = canonical.get('license', {}).get('value')
-        if license is not None:
-            tool['license'] = license
-
-        source_code_url = canonical.get('sourceCode', {}).get('value')
-        if source_code_url is not None:
-            tool['sourceCode'] = source_code_url
-
-        bug_tracker_url = canonical.get('bugTracker', {}).get('value')
-        if bug_tracker_url is not None:
-            tool['bugTrackerURL'] = bug_tracker_url
-
-        screenshot_url = canonical.get('screenshot', {}).get('value')
-        if screenshot_url is not None:
-            tool['screenshots'] = [screenshot_url]
-
-        stackexchange_tag = canonical.get('stackexchangeTag', {}).get('value')
-        if stackexchange_tag is not None:
-            tool['stackexchangeTag'] = [stackexchange_tag]
-
-        categories = canonical.get('categories', [])
-        if categories:
-            categories = [
-                category['value']
-                for category in categories
-                if category['value']
-                ]
-            if categories:
-                tool['otherCategories'] = categories
-
-        technology = canonical.get('technology', {}).get('fr', {}).get('value')
-        if technology is not None:
-            tool['technologies'] = [technology]
-
-        existing_tool = tools_by_name.get(tool['name'])
-        if existing_tool is None:
-            print('New tool: {}'.format(tool['name']))
-            response = requests.post(
-                urllib.parse.urljoin(args.server_url, '/tools'),
-                headers = {
-                    "OGPToolbox-API-Key": api_key,
-                    },
-                json = tool,
-                )
-        else:
-            updated_tool = existing_tool.copy()
-            changed = False
-            for key, value in tool.items():
-                if key not in updated_tool:
-                    updated_tool[key] = value
-                    changed = True
-            if changed:
-                print('Updated tool: {}'.format(tool['name']))
-                response = requests.put(
-                    urllib.parse.urljoin(args.server_url, '/tools/{}'.format(updated_tool['id'])),
-                    headers = {
-                        "OGPToolbox-API-Key": api_key,
-                        },
-                    json = updated_tool,
+    assert args.concurrency > 0, args.concurrency
+    source_ledger_path = os.path.join(args.source_dir, default_ledger_filename)
+    if not os.path.exists(args.ledger) and os.path.exists(source_ledger_path):
+        # Previous versions kept the ledger in the source directory, where it was committed with the data.
+        log.warning('Moving ledger {} to {}'.format(source_ledger_path, args.ledger))
+        shutil.move(source_ledger_path, args.ledger)
+    ledger = load_ledger(args.ledger)
+    # Ledger entries (file hash, payload hash, editor id & relative path of YAML file) of tools, by name
+    tool_entry_by_name = {} if args.full else ledger.get(args.server_url, {})
+
+    global session
+    session = requests.Session()
+    # Keep as many connections alive as there are concurrent requests.
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    with report.stage('fetch tools') as counters:
+        # Login to retrieve user API key.
+        response = record_response(counters, *send('POST', urllib.parse.urljoin(args.server_url, 'login'), json = {
+            "userName": args.user,
+            "password": args.password,
+            }))
+        if response is None or not response.ok:
+            log.error('Login to {} failed'.format(args.server_url))
+            return 1
+        data = response.json()
+        api_key = data['data']['apiKey']
+        session.headers["OGPToolbox-API-Key"] = api_key
+
+        response = record_response(counters, *send('GET', urllib.parse.urljoin(args.server_url, '/tools')))
+        if response is None or not response.ok:
+            log.error('Fetching tools of {} failed'.format(args.server_url))
+            return 1
+        tools_by_name = {
+            tool['name']: tool
+            for tool in response.json()['data']
+            }
+        counters['tools_fetched'] += len(tools_by_name)
+
+        for name in list(tool_entry_by_name):
+            if name not in tools_by_name:
+                # Tool removed from editor: publish it again.
+                del tool_entry_by_name[name]
+        name_by_relative_path = {
+            tool_entry['path']: name
+            for name, tool_entry in tool_entry_by_name.items()
+            }
+
+    with report.stage('publish tools') as counters, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        # Name & ledger entry of the tool sent by each pending request
+        tool_by_future = {}
+        published_names = set()
+        completed = False
+        try:
+            for yaml_file_path in yaml_io.iter_yaml_paths(args.source_dir):
+                relative_path = os.path.relpath(yaml_file_path, args.source_dir)
+                file_hash = entity_tree.hash_file(yaml_file_path)
+                name = name_by_relative_path.get(relative_path)
+                if name is not None and tool_entry_by_name[name]['file_hash'] == file_hash:
+                    published_names.add(name)
+                    counters['tools_unchanged'] += 1
+                    continue
+
+                try:
+                    source_data = yaml_io.load_file(yaml_file_path)
+                except yaml_io.load_errors:
+                    log.warning("Invalid syntax in YAML file {}".format(yaml_file_path))
+                    counters['parse_failures'] += 1
+                    continue
+                counters['files_parsed'] += 1
+                tool = make_tool(source_data)
+                name = tool['name']
+                published_names.add(name)
+                tool_entry = dict(
+                    file_hash = file_hash,
+                    hash = entity_tree.hash_bytes(json.dumps(tool, ensure_ascii=False, sort_keys=True).encode('utf-8')),
+                    id = None,
+                    path = relative_path,
                     )
 
+                existing_tool = tools_by_name.get(name)
+                previous_tool_entry = tool_entry_by_name.get(name)
+                if previous_tool_entry is not None and previous_tool_entry['hash'] == tool_entry['hash']:
+                    # Only the YAML file changed, not the payload.
+                    tool_entry['id'] = previous_tool_entry['id']
+                    tool_entry_by_name[name] = tool_entry
+                    counters['tools_unchanged'] += 1
+                    continue
+                if existing_tool is None:
+                    print('New tool: {}'.format(name))
+                    request = ('POST', urllib.parse.urljoin(args.server_url, '/tools'), tool)
+                    counters['tools_created'] += 1
+                else:
+                    tool_entry['id'] = existing_tool.get('id')
+                    updated_tool = existing_tool.copy()
+                    changed = False
+                    for key, value in tool.items():
+                        if key not in updated_tool:
+                            updated_tool[key] = value
+                            changed = True
+                    if not changed:
+                        tool_entry_by_name[name] = tool_entry
+                        counters['tools_unchanged'] += 1
+                        continue
+                    print('Updated tool: {}'.format(name))
+                    request = ('PUT', urllib.parse.urljoin(args.server_url, '/tools/{}'.format(updated_tool['id'])),
+                        updated_tool)
+                    counters['tools_updated'] += 1
+
+                if len(tool_by_future) >= 2 * args.concurrency:
+                    # Don't queue more tools than the workers can send soon.
+                    done = concurrent.futures.wait(tool_by_future, return_when=concurrent.futures.FIRST_COMPLETED).done
+                    for future in done:
+                        record_sent_tool(counters, tool_entry_by_name, *tool_by_future.pop(future), *future.result())
+                method, url, payload = request
+                tool_by_future[executor.submit(send, method, url, json = payload)] = (name, tool_entry)
+            completed = True
+        finally:
+            # Record the tools sent by the pending requests and save the ledger, even when the run is interrupted.
+            for future in concurrent.futures.as_completed(tool_by_future):
+                record_sent_tool(counters, tool_entry_by_name, *tool_by_future[future], *future.result())
+            if completed:
+                for name in list(tool_entry_by_name):
+                    if name not in published_names:
+                        # YAML file removed from source directory
+                        del tool_entry_by_name[name]
+            ledger[args.server_url] = tool_entry_by_name
+            save_ledger(args.ledger, ledger)
+
+    for method, latencies in sorted(latencies_by_method.items()):
+        latency_stats = get_latency_stats(latencies)
+        print('{} requests: {}'.format(method, ', '.join(
+            '{} {}'.format(key, value)
+            for key, value in latency_stats.items()
+            )))
+    if args.report is not None:
+        report.save(args.report)
+
     return 0
 
+
+def make_tool(source_data):
+    """Return the payload of a tool for the editor."""
+    canonical = source_data['canonical']
+    tool = dict(
+        name = source_data['name'],
+        )
+
+    description_fr = canonical.get('longDescription', {}).get('fr', {}).get('value')
+    if description_fr is not None:
+        tool['description_fr'] = description_fr
+
+    description_en = canonical.get('longDescription', {}).get('en', {}).get('value')
+    if description_en is not None:
+        tool['description_en'] = description_en
+
+    license = canonical.get('license', {}).get('value')
+    if license is not None:
+        tool['license'] = license
+
+    source_code_url = canonical.get('sourceCode', {}).get('value')
+    if source_code_url is not None:
+        tool['sourceCode'] = source_code_url
+
+    bug_tracker_url = canonical.get('bugTracker', {}).get('value')
+    if bug_tracker_url is not None:
+        tool['bugTrackerURL'] = bug_tracker_url
+
+    screenshot_url = canonical.get('screenshot', {}).get('value')
+    if screenshot_url is not None:
+        tool['screenshots'] = [screenshot_url]
+
+    stackexchange_tag = canonical.get('stackexchangeTag', {}).get('value')
+    if stackexchange_tag is not None:
+        tool['stackexchangeTag'] = [stackexchange_tag]
+
+    categories = canonical.get('categories', [])
+    if categories:
+        categories = [
+            category['value']
+            for category in categories
+            if category['value']
+            ]
+        if categories:
+            tool['otherCategories'] = categories
+
+    technology = canonical.get('technology', {}).get('fr', {}).get('value')
+    if technology is not None:
+        tool['technologies'] = [technology]
+
+    return tool
+
+
+def record_response(counters, method, url, response, latency):
+    """Count a response and its latency (in the main thread) and return it, or None when the request raised an
+    exception (connection error, timeout...).
+    """
+    latencies_by_method[method].append(latency)
+    counters['requests {}'.format(method)] += 1
+    counters['requests {} seconds'.format(method)] += latency
+    if isinstance(response, requests.RequestException):
+        counters['requests_failed'] += 1
+        log.warning('{} {} failed: {}'.format(method, url, response))
+        return None
+    if not response.ok:
+        counters['requests_failed'] += 1
+        log.warning('{} {} failed: {} {}'.format(method, url, response.status_code, response.text[:200]))
+    return response
+
+
+def record_sent_tool(counters, tool_entry_by_name, name, tool_entry, method, url, response, latency):
+    """Count the response to a sent tool and, when it succeeded, record the tool in the ledger."""
+    response = record_response(counters, method, url, response, latency)
+    if response is None or not response.ok:
+        # Keep the previous ledger entry, so that the tool is sent again by next run.
+        return
+    if tool_entry['id'] is None:
+        try:
+            tool_entry['id'] = response.json()['data']['id']
+        except (KeyError, TypeError, ValueError):
+            log.warning('Missing id of created tool {} in response: {}'.format(name, response.text[:200]))
+    tool_entry_by_name[name] = tool_entry
+
+
+def save_ledger(path, ledger):
+    with open(path, 'w') as ledger_file:
+        json.dump(ledger, ledger_file, indent=0, sort_keys=True)
+
+
+def send(method, url, **kwargs):
+    """Send a request with the shared session. Return the method, the URL, the response (or the exception raised by
+    the request) and the latency of the request.
+    """
+    start_time = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=args.timeout, **kwargs)
+    except requests.RequestException as error:
+        response = error
+    return method, url, response, time.perf_counter() - start_time
+
+
 if __name__ == "__main__":
     sys.exit(main())
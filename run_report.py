@@ -0,0 +1,91 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Run report: wall time, CPU time, counters (files scanned & parsed, bytes read, entities...) and peak memory of
+each stage of a script, saved as JSON.
+"""
+
+
+import collections
+import contextlib
+import datetime
+import json
+import resource
+import time
+
+
+def get_max_rss_kb(who=resource.RUSAGE_SELF):
+    # On Linux, ru_maxrss is in kilobytes.
+    return resource.getrusage(who).ru_maxrss
+
+
+class RunReport:
+    def __init__(self):
+        self.counters_stack = []
+        self.stages = []
+        self.start_cpu_time = time.process_time()
+        self.start_time = time.perf_counter()
+        self.started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def add(self, key, value=1):
+        """Add value to a counter of the current stage."""
+        if self.counters_stack:
+            self.counters_stack[-1][key] += value
+
+    @property
+    def counters(self):
+        """The collections.Counter of the current stage (None outside of any stage)."""
+        return self.counters_stack[-1] if self.counters_stack else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure a stage of the run. The context value is the collections.Counter of the stage."""
+        counters = collections.Counter()
+        self.counters_stack.append(counters)
+        start_cpu_time = time.process_time()
+        start_time = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            self.counters_stack.pop()
+            self.stages.append(collections.OrderedDict([
+                ('name', name),
+                ('wall_time', round(time.perf_counter() - start_time, 6)),
+                ('cpu_time', round(time.process_time() - start_cpu_time, 6)),
+                ('max_rss_kb', get_max_rss_kb()),
+                ('counters', dict(counters)),
+                ]))
+
+    def save(self, path):
+        total_counters = collections.Counter()
+        for stage in self.stages:
+            total_counters.update(stage['counters'])
+        with open(path, 'w') as report_file:
+            json.dump(collections.OrderedDict([
+                ('started', self.started),
+                ('wall_time', round(time.perf_counter() - self.start_time, 6)),
+                ('cpu_time', round(time.process_time() - self.start_cpu_time, 6)),
+                # Worker processes are accounted for only once they have been waited for.
+                ('children_cpu_time', round(sum(resource.getrusage(resource.RUSAGE_CHILDREN)[:2]), 6)),
+                ('max_rss_kb', get_max_rss_kb()),
+                ('children_max_rss_kb', get_max_rss_kb(resource.RUSAGE_CHILDREN)),
+                ('counters', dict(total_counters)),
+                ('stages', self.stages),
+                ]), report_file, indent=2)
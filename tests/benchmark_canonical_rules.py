@@ -0,0 +1,217 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Benchmark of the per-entity cost of canonicalization, before & after the compilation of the dotted paths of the
+canonical rules into accessors, on a synthetic directory of merged tools.
+
+It times the evaluation of every rule path of tools with the previous recursive get_path, with item_path.get_path and
+with precompiled accessors, then canonical_rules.canonicalize with both ways of walking paths.
+
+Run it from the root of the repository: python3 -m tests.benchmark_canonical_rules
+"""
+
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import canonical_rules
+import item_path
+import yaml_io
+
+
+words = [
+    'alpha', 'beta', 'café', 'civic', 'data', 'debate', 'delta', 'élan', 'gamma', 'loomio', 'mail', 'map', 'open',
+    'participation', 'vote', 'wiki',
+    ]
+
+
+class RecursivePath:
+    """Accessor walking a dotted path like the get_path function used before compiled paths."""
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, item, default=None):
+        return get_path_recursive(item, self.path, default=default)
+
+
+def get_path_recursive(item, path, default=None):
+    """Previous get_path, splitting path & recursing at each call."""
+    if item is None:
+        return default
+    if not path:
+        return item
+    split_path = path.split('.', 1)
+    key = split_path[0]
+    if key.isdigit():
+        if not isinstance(item, (list, tuple)):
+            return default
+        index = int(key)
+        value = item[index] if 0 <= index < len(item) else None
+    else:
+        if not isinstance(item, dict):
+            return default
+        value = item.get(key)
+    if len(split_path) <= 1:
+        return value if value is not None else default
+    return get_path_recursive(value, split_path[1], default=default)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--tools', default=2000, type=int, help='number of synthetic tools')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='number of runs of each variant')
+    args = parser.parse_args()
+
+    random_generator = random.Random(0)
+    with tempfile.TemporaryDirectory() as tools_dir:
+        for index in range(args.tools):
+            with open(os.path.join(tools_dir, 'tool-{}.yaml'.format(index)), 'w') as yaml_file:
+                yaml_io.dump(make_tool(random_generator, index), yaml_file)
+        entries = [
+            entry
+            for yaml_file_path, entry in yaml_io.iter_yaml_files(tools_dir)
+            ]
+    paths = [
+        path[0] if isinstance(path, tuple) else path
+        for rule in canonical_rules.rules_by_entity_type['tools']
+        for path in rule['paths']
+        ]
+    accessors = [
+        item_path.compile_path(path)
+        for path in paths
+        ]
+    recursive_plan_by_entity_type = canonical_rules.plan_by_entity_type.copy()
+    recursive_plan_by_entity_type['tools'] = type(canonical_rules.plan_by_entity_type['tools'])(
+        (source, [
+            rule_path._replace(accessor = RecursivePath(rule_path.path.partition('.')[2]))
+            for rule_path in rule_paths
+            ])
+        for source, rule_paths in canonical_rules.plan_by_entity_type['tools'].items()
+        )
+    print('{} tools, {} rule paths'.format(len(entries), len(paths)))
+
+    def canonicalize_recursive(entry):
+        plan_by_entity_type = canonical_rules.plan_by_entity_type
+        canonical_rules.plan_by_entity_type = recursive_plan_by_entity_type
+        try:
+            return canonical_rules.canonicalize('tools', entry)
+        finally:
+            canonical_rules.plan_by_entity_type = plan_by_entity_type
+
+    expected_values = [
+        [
+            get_path_recursive(entry, path)
+            for path in paths
+            ]
+        for entry in entries
+        ]
+    expected_canonicals = [
+        canonical_rules.canonicalize('tools', entry)
+        for entry in entries
+        ]
+    for name, evaluate, expected in (
+            ('rule paths, recursive get_path (before)', lambda entry: [
+                get_path_recursive(entry, path)
+                for path in paths
+                ], expected_values),
+            ('rule paths, item_path.get_path', lambda entry: [
+                item_path.get_path(entry, path)
+                for path in paths
+                ], expected_values),
+            ('rule paths, precompiled accessors', lambda entry: [
+                accessor.get(entry)
+                for accessor in accessors
+                ], expected_values),
+            ('canonicalize, recursive get_path (before)', canonicalize_recursive, expected_canonicals),
+            ('canonicalize, compiled accessors (after)', lambda entry: canonical_rules.canonicalize('tools', entry),
+                expected_canonicals),
+            ):
+        durations = []
+        for index in range(args.repeat):
+            start_time = time.perf_counter()
+            results = [
+                evaluate(entry)
+                for entry in entries
+                ]
+            durations.append(time.perf_counter() - start_time)
+            assert results == expected, name
+        print('{:<48} {:6.1f} us per tool'.format(name, min(durations) / len(entries) * 1e6))
+    return 0
+
+
+def make_text(random_generator, words_count=12):
+    return ' '.join(random_generator.choice(words) for index in range(words_count))
+
+
+def make_tool(random_generator, index):
+    """Return a merged tool, with data at the paths of the canonical rules for a random subset of sources."""
+    name = 'tool {}'.format(index)
+    text = lambda words_count=12: make_text(random_generator, words_count)
+    url = lambda kind: 'https://{}.example.org/tool-{}'.format(kind, index)
+    wikidata_values = lambda kind: [dict(value = url(kind))]
+    tool_by_source = {
+        'civic-tech-field-guide': dict(category = text(1), name = name),
+        'civicstack': dict(
+            description = dict(en = text(), fr = text()),
+            github = url('github'),
+            license = dict(name = dict(en = 'MIT')),
+            name = name,
+            tags = [dict(name = dict(en = text(1))), dict(name = text(1))],
+            technology = [dict(name = 'Python'), dict(name = 'JavaScript')],
+            ),
+        'debian': dict(
+            description = dict(en = dict(long_description = text(40)), fr = dict(long_description = text(40))),
+            screenshot = dict(large_image_url = url('screenshots')),
+            ),
+        'debian_appstream': dict(Categories = ['Network', 'Office'], Name = dict(C = name)),
+        'harnessing-collaborative-technologies': dict(category = 'Collab', description = text(),
+            logo_url = url('logo'), title = name),
+        'nuit-debout': {'Détails': text(), 'Fonction': text(1), 'Lien vers le code': url('code'),
+            'Nom de la licence': 'GPL', 'Outil': name},
+        'ogptoolbox-framacalc': {"Capture d'écran": url('img'), 'Catégorie': 'Débat', 'Description': text(),
+            'Licence': 'AGPL', 'Nom': name, 'Tag stack exchange': 'tool', 'URL code source': url('source'),
+            'URL suivi de bogues': url('bugs')},
+        'participatedb': dict(Category = ['Voting', 'Mapping'], Description = text(), Name = name),
+        'tech-plateforms': {'About': text(40), 'AppCivist Service 1': 'Participation', 'AppCivist Service 2': 'Voting',
+            'CivicTech or GeneralPurpose': 'CivicTech', 'Functions': 'Voting', 'Name': name},
+        'wikidata': dict(
+            bug_tracking_system = wikidata_values('bugs'),
+            description = [{'value': text(), 'xml:lang': 'en'}, {'value': text(), 'xml:lang': 'fr'}],
+            genre_label = [{'value': text(1), 'xml:lang': 'en'}],
+            image = wikidata_values('img'),
+            instance_of_label = [{'value': 'software', 'xml:lang': 'en'}],
+            label = [dict(value = name)],
+            license_label = [dict(value = 'GPL')],
+            source_code_repository = wikidata_values('source'),
+            stack_exchange_tag = [dict(value = 'tool')],
+            ),
+        }
+    return {
+        source: tool_by_source[source]
+        for source in random_generator.sample(sorted(tool_by_source), random_generator.randint(1, 6))
+        }
+
+
+if __name__ == "__main__":
+    sys.exit(main())
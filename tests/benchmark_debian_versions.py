@@ -0,0 +1,211 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Micro-benchmark of the choice of the latest version of the components of UDD packages, on a synthetic corpus of
+packages with several releases & components, some of them with long version histories (like libc or linux).
+
+Besides the plain loop over apt_pkg.version_compare used by merge.py, it times caches reused across packages (memoized
+comparisons, sort keys precomputed by version string) and across runs (latest version by tuple of version strings,
+persisted in a pickle file).
+
+Run it from the root of the repository (python-apt is required): python3 -m tests.benchmark_debian_versions
+"""
+
+
+import argparse
+import functools
+import os
+import pickle
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import apt_pkg
+
+import merge
+
+
+debian_version_part_re = re.compile(r'(\D*)(\d*)')
+
+
+def get_debian_version_key(version_str):
+    """Return a tuple that sorts like the Debian version version_str (a pure Python apt_pkg.version_compare)."""
+    epoch, separator, version_str = version_str.partition(':')
+    if not separator:
+        epoch, version_str = '0', epoch
+    upstream, separator, revision = version_str.rpartition('-')
+    if not separator:
+        upstream, revision = revision, '0'
+    return (int(epoch or 0), get_debian_version_part_key(upstream), get_debian_version_part_key(revision))
+
+
+def get_debian_version_part_key(part):
+    key = []
+    for letters, digits in debian_version_part_re.findall(part):
+        if not letters and not digits:
+            continue
+        # "~" sorts before the end of the part, which sorts before letters, which sort before other characters.
+        key.append(tuple(
+            -1 if letter == '~' else ord(letter) if letter.isalpha() else ord(letter) + 256
+            for letter in letters
+            ) + (0,))
+        key.append(int(digits or 0))
+    key.append((0,))
+    return tuple(key)
+
+
+def iter_components_versions(random_generator, packages_count, long_histories_count):
+    """Iterate over the version strings of each component of each release of synthetic packages.
+
+    The first long_histories_count packages have long version histories (100 to 1000 versions by component).
+    """
+    version_strs = [
+        make_version_str(random_generator)
+        for index in range(max(packages_count // 5, 1000))
+        ]
+    for package_index in range(packages_count):
+        if package_index < long_histories_count:
+            package_version_strs = random_generator.sample(version_strs, 1000)
+            min_versions_count, max_versions_count = 100, 1000
+        else:
+            package_version_strs = random_generator.sample(version_strs, 6)
+            min_versions_count, max_versions_count = 1, 6
+        for release_index in range(3):
+            for component_index in range(2):
+                yield random_generator.sample(package_version_strs,
+                    random_generator.randint(min_versions_count, max_versions_count))
+
+
+def make_version_str(random_generator):
+    return ''.join([
+        random_generator.choice(['', '', '', '1:', '2:']),
+        '.'.join(
+            str(random_generator.randint(0, 20))
+            for index in range(random_generator.randint(1, 4))
+            ),
+        random_generator.choice(['', '', '~rc1', '~beta2', '+dfsg', '+dfsg1', 'a', '+git20160102']),
+        random_generator.choice(['', '-1', '-2', '-1ubuntu1', '-3+deb8u1', '-1~bpo8+1', '-0.1']),
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--long-histories', default=200, dest='long_histories', type=int,
+        help='number of synthetic packages with long version histories')
+    parser.add_argument('-m', '--min-cached-versions', default=1, dest='min_cached_versions', type=int,
+        help='minimum number of versions of a component for the persisted cache of latest versions to be used')
+    parser.add_argument('-n', '--packages', default=20000, type=int, help='number of synthetic packages')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='number of runs of each variant')
+    args = parser.parse_args()
+
+    apt_pkg.init()
+    components_versions = list(iter_components_versions(random.Random(0), args.packages, args.long_histories))
+    print('{} components of {} packages ({} with long version histories), {} versions'.format(
+        len(components_versions), args.packages, args.long_histories,
+        sum(len(versions) for versions in components_versions)))
+
+    @functools.lru_cache(maxsize=65536)
+    def compare_cached(version_str1, version_str2):
+        return apt_pkg.version_compare(version_str1, version_str2)
+
+    cached_key = functools.cmp_to_key(compare_cached)
+    key = functools.cmp_to_key(apt_pkg.version_compare)
+    version_key_cache = {}
+
+    def get_cached_version_key(version_str):
+        version_key = version_key_cache.get(version_str)
+        if version_key is None:
+            version_key = version_key_cache[version_str] = get_debian_version_key(version_str)
+        return version_key
+
+    cache_dir = tempfile.mkdtemp()
+    latest_cache_path = os.path.join(cache_dir, 'latest-debian-versions.pickle')
+    latest_version_str_by_versions_str = {}
+
+    def get_cached_latest(versions):
+        if len(versions) < args.min_cached_versions:
+            return merge.get_latest_debian_version_str(versions)
+        versions = tuple(versions)
+        latest_version_str = latest_version_str_by_versions_str.get(versions)
+        if latest_version_str is None:
+            latest_version_str = latest_version_str_by_versions_str[versions] = \
+                merge.get_latest_debian_version_str(versions)
+        return latest_version_str
+
+    def load_latest_cache():
+        # Runs after the first one reuse the latest versions persisted by the previous run.
+        latest_version_str_by_versions_str.clear()
+        if os.path.exists(latest_cache_path):
+            with open(latest_cache_path, 'rb') as cache_file:
+                latest_version_str_by_versions_str.update(pickle.load(cache_file))
+
+    def save_latest_cache():
+        with open(latest_cache_path, 'wb') as cache_file:
+            pickle.dump(latest_version_str_by_versions_str, cache_file, pickle.HIGHEST_PROTOCOL)
+
+    expected = [
+        merge.get_latest_debian_version_str(versions)
+        for versions in components_versions
+        ]
+    for name, get_latest, setup, teardown in (
+            ('merge.get_latest_debian_version_str', merge.get_latest_debian_version_str, None, None),
+            ('max() & cmp_to_key(version_compare)', lambda versions: max(versions, key=key), None, None),
+            ('max() & cmp_to_key(memoized version_compare)', lambda versions: max(versions, key=cached_key),
+                compare_cached.cache_clear, None),
+            ('max() & sort keys by version (cold)', lambda versions: max(versions, key=get_cached_version_key),
+                version_key_cache.clear, None),
+            ('max() & sort keys by version (warm)', lambda versions: max(versions, key=get_cached_version_key),
+                None, None),
+            ('latest by versions, persisted (cold)', get_cached_latest,
+                latest_version_str_by_versions_str.clear, None),
+            ('latest by versions, persisted (warm)', get_cached_latest, load_latest_cache, save_latest_cache),
+            ):
+        durations = []
+        for index in range(args.repeat):
+            # Like in merge.py, where they are loaded from YAML files, version strings are new objects at each run,
+            # without their hashes.
+            components_versions = [
+                [
+                    version_str.encode('utf-8').decode('utf-8')
+                    for version_str in versions
+                    ]
+                for versions in components_versions
+                ]
+            start_time = time.perf_counter()
+            if setup is not None:
+                setup()
+            latest_version_strs = [
+                get_latest(versions)
+                for versions in components_versions
+                ]
+            if teardown is not None:
+                teardown()
+            durations.append(time.perf_counter() - start_time)
+            assert latest_version_strs == expected, name
+        print('{:<48} {:.3f} s'.format(name, min(durations)))
+    shutil.rmtree(cache_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Benchmark of the throughput of publish_to_editor.py against a local stand-in editor delaying each request, as a
+function of the number of concurrent requests.
+
+Run it from the root of the repository: python3 -m tests.benchmark_publish_to_editor
+"""
+
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml_io
+
+from tests.editor_stand_in import EditorStandIn
+
+
+script_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'publish_to_editor.py')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--concurrency', default=[1, 4, 8, 16], nargs='+', type=int,
+        help='numbers of concurrent requests to benchmark')
+    parser.add_argument('-d', '--delay', default=0.02, type=float, help='delay of each request, in seconds')
+    parser.add_argument('-n', '--tools', default=400, type=int, help='number of synthetic tools')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        source_dir = os.path.join(temporary_dir, 'tools')
+        os.makedirs(source_dir)
+        for index in range(args.tools):
+            with open(os.path.join(source_dir, 'tool-{}.yaml'.format(index)), 'w') as yaml_file:
+                yaml_io.dump(dict(
+                    canonical = dict(
+                        longDescription = dict(en = dict(value = 'Description of tool {}'.format(index))),
+                        ),
+                    name = 'tool {}'.format(index),
+                    ), yaml_file)
+        print('{} tools, {:.0f} ms per request'.format(args.tools, args.delay * 1000))
+        for concurrency in args.concurrency:
+            with EditorStandIn(delay=args.delay) as editor:
+                start_time = time.perf_counter()
+                subprocess.run(
+                    [sys.executable, script_path, source_dir, editor.url, '-u', 'user', '-p', 'password',
+                        '--concurrency', str(concurrency), '--full',
+                        '--ledger', os.path.join(temporary_dir, 'ledger-{}.json'.format(concurrency))],
+                    check = True,
+                    stdout = subprocess.DEVNULL,
+                    )
+                duration = time.perf_counter() - start_time
+            assert len(editor.tool_by_id) == args.tools
+            print('concurrency {:>3}: {:6.2f} s, {:7.1f} tools/s, at most {} requests in flight'.format(
+                concurrency, duration, args.tools / duration, editor.max_in_flight_count))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Local stand-in for the HTTP API of the OGPToolbox Editor used by publish_to_editor.py, for tests & benchmarks.
+
+It implements the login, the listing, the creation & the update of tools, keeps tools in memory and counts the
+requests it receives, as well as the maximum number of requests handled concurrently.
+"""
+
+
+import contextlib
+import http.server
+import itertools
+import json
+import threading
+import time
+
+
+class EditorRequestHandler(http.server.BaseHTTPRequestHandler):
+    disable_nagle_algorithm = True
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.editor.handle(self) as editor:
+            if self.path != '/tools':
+                return self.send_json(404, dict(error = 'Not found'))
+            with editor.lock:
+                tools = list(editor.tool_by_id.values())
+            self.send_json(200, dict(data = tools))
+
+    def do_POST(self):
+        with self.server.editor.handle(self) as editor:
+            data = self.read_json()
+            if self.path == '/login':
+                return self.send_json(200, dict(data = dict(apiKey = editor.api_key)))
+            if self.path != '/tools':
+                return self.send_json(404, dict(error = 'Not found'))
+            if not self.is_authorized():
+                return self.send_json(401, dict(error = 'Invalid API key'))
+            with editor.lock:
+                data['id'] = str(next(editor.ids))
+                editor.tool_by_id[data['id']] = data
+            self.send_json(201, dict(data = data))
+
+    def do_PUT(self):
+        with self.server.editor.handle(self) as editor:
+            data = self.read_json()
+            id = self.path[len('/tools/'):] if self.path.startswith('/tools/') else None
+            if not self.is_authorized():
+                return self.send_json(401, dict(error = 'Invalid API key'))
+            with editor.lock:
+                if id not in editor.tool_by_id:
+                    return self.send_json(404, dict(error = 'Not found'))
+                editor.tool_by_id[id] = data
+            self.send_json(200, dict(data = data))
+
+    def is_authorized(self):
+        return self.headers.get('OGPToolbox-API-Key') == self.server.editor.api_key
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        return json.loads(self.body.decode('utf-8')) if self.body else None
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client gave up waiting (request timeout).
+            self.close_connection = True
+
+
+class EditorStandIn:
+    """Editor served in a background thread. Each request is delayed by delay seconds, or by slow_delay seconds when
+    its body contains one of slow_names.
+    """
+    api_key = 'stand-in-api-key'
+
+    def __init__(self, delay=0, slow_delay=0, slow_names=()):
+        self.delay = delay
+        self.ids = itertools.count(1)
+        self.in_flight_count = 0
+        self.lock = threading.Lock()
+        self.max_in_flight_count = 0
+        self.request_counts = {}
+        self.server = None
+        self.slow_delay = slow_delay
+        self.slow_names = set(slow_names)
+        self.thread = None
+        self.tool_by_id = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @contextlib.contextmanager
+    def handle(self, handler):
+        """Count, read & delay the request of handler, for the duration of its handling."""
+        key = '{} {}'.format(handler.command, handler.path.rsplit('/', 1)[0] or handler.path)
+        handler.body = handler.rfile.read(int(handler.headers.get('Content-Length', 0)))
+        with self.lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+            self.in_flight_count += 1
+            self.max_in_flight_count = max(self.max_in_flight_count, self.in_flight_count)
+        try:
+            if any(name.encode('utf-8') in handler.body for name in self.slow_names):
+                time.sleep(self.slow_delay)
+            else:
+                time.sleep(self.delay)
+            yield self
+        finally:
+            with self.lock:
+                self.in_flight_count -= 1
+
+    def start(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), EditorRequestHandler)
+        self.server.daemon_threads = True
+        self.server.editor = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
@@ -0,0 +1,96 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Helpers of the tests running the scripts of the pipeline (merge.py, generate_canonical.py...) on small trees."""
+
+
+import filecmp
+import importlib.util
+import os
+import subprocess
+import sys
+
+import yaml_io
+
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Directories of the sources enabled in merge.py, with their sub-directories
+source_dirs = (
+    'appstream-debian-yaml',
+    'civic-graph-yaml',
+    'civic-tech-field-guide-yaml',
+    'civicstack-yaml',
+    'harnessing-collaborative-technologies-yaml',
+    'nuit-debout-yaml',
+    'ogptoolbox-framacalc-yaml',
+    os.path.join('participatedb-yaml', 'projects'),
+    os.path.join('participatedb-yaml', 'tools'),
+    'tech-plateforms-yaml',
+    os.path.join('udd-yaml', 'packages'),
+    os.path.join('udd-yaml', 'sources'),
+    'wikidata-yaml',
+    )
+stubs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+
+def iter_tree_differences(dir1, dir2):
+    """Iterate over the relative paths of the files that differ, or exist only in one of two trees (hidden files, like
+    manifests & states, excepted).
+    """
+    for relative_dir, comparison in iter_dir_comparisons('', filecmp.dircmp(dir1, dir2, ignore=[])):
+        for name in sorted(comparison.left_only + comparison.right_only + comparison.diff_files +
+                comparison.funny_files):
+            if not name.startswith('.'):
+                yield os.path.join(relative_dir, name)
+
+
+def iter_dir_comparisons(relative_dir, comparison):
+    yield relative_dir, comparison
+    for name, sub_comparison in sorted(comparison.subdirs.items()):
+        if not name.startswith('.'):
+            yield from iter_dir_comparisons(os.path.join(relative_dir, name), sub_comparison)
+
+
+def run_script(script_name, *arguments):
+    """Run a script of the repository and return its output. When python-apt is missing, a stub of apt_pkg is used."""
+    env = os.environ.copy()
+    if importlib.util.find_spec('apt_pkg') is None:
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [stubs_dir, env.get('PYTHONPATH')]))
+    process = subprocess.run([sys.executable, os.path.join(repository_dir, script_name)] + list(arguments),
+        cwd = repository_dir,
+        env = env,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.STDOUT,
+        universal_newlines = True,
+        )
+    assert process.returncode == 0, '{} failed:\n{}'.format(script_name, process.stdout)
+    return process.stdout
+
+
+def write_source_dirs(source_dir):
+    """Create the directories of all the sources enabled in merge.py."""
+    for relative_dir in source_dirs:
+        os.makedirs(os.path.join(source_dir, relative_dir), exist_ok=True)
+
+
+def write_yaml(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as yaml_file:
+        yaml_io.dump(data, yaml_file)
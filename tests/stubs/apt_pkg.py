@@ -0,0 +1,65 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Stand-in for the apt_pkg module of python-apt, used by tests when python-apt is not installed.
+
+Only init() and version_compare() (the Debian ordering of version strings) are provided.
+"""
+
+
+import re
+
+
+version_part_re = re.compile(r'(\D*)(\d*)')
+
+
+def get_part_key(part):
+    key = []
+    for letters, digits in version_part_re.findall(part):
+        if not letters and not digits:
+            continue
+        # "~" sorts before the end of the part, which sorts before letters, which sort before other characters.
+        key.append(tuple(
+            -1 if letter == '~' else ord(letter) if letter.isalpha() else ord(letter) + 256
+            for letter in letters
+            ) + (0,))
+        key.append(int(digits or 0))
+    key.append((0,))
+    return tuple(key)
+
+
+def get_version_key(version_str):
+    epoch, separator, version_str = version_str.partition(':')
+    if not separator:
+        epoch, version_str = '0', epoch
+    upstream, separator, revision = version_str.rpartition('-')
+    if not separator:
+        upstream, revision = revision, '0'
+    return (int(epoch or 0), get_part_key(upstream), get_part_key(revision))
+
+
+def init():
+    pass
+
+
+def version_compare(version_str1, version_str2):
+    key1 = get_version_key(version_str1)
+    key2 = get_version_key(version_str2)
+    return (key1 > key2) - (key1 < key2)
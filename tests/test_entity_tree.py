@@ -0,0 +1,76 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Write-if-changed output of entity trees, when files are modified behind the manifest."""
+
+
+import os
+import tempfile
+import unittest
+
+import entity_tree
+
+
+class WriteIfChangedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary_dir.cleanup)
+        self.dir = self.temporary_dir.name
+        self.manifest = {}
+        self.path = os.path.join(self.dir, 'tools', 'tool.yaml')
+
+    def read(self):
+        with open(self.path) as file:
+            return file.read()
+
+    def test_modified_file(self):
+        self.assertTrue(entity_tree.write_if_changed(self.dir, 'tools/tool.yaml', 'name: tool\n', self.manifest))
+        with open(self.path, 'w') as file:
+            file.write('garbage: 1\n')
+        self.assertIsNone(entity_tree.get_manifest_digest(self.dir, 'tools/tool.yaml', self.manifest))
+        self.assertTrue(entity_tree.write_if_changed(self.dir, 'tools/tool.yaml', 'name: tool\n', self.manifest))
+        self.assertEqual(self.read(), 'name: tool\n')
+
+    def test_old_manifest(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as file:
+            file.write('name: tool\n')
+        # Manifests written by previous versions only contain hashes.
+        self.manifest['tools/tool.yaml'] = entity_tree.hash_bytes(b'name: tool\n')
+        self.assertFalse(entity_tree.write_if_changed(self.dir, 'tools/tool.yaml', 'name: tool\n', self.manifest))
+        self.assertIsNotNone(entity_tree.get_manifest_digest(self.dir, 'tools/tool.yaml', self.manifest))
+
+    def test_touched_file(self):
+        entity_tree.write_if_changed(self.dir, 'tools/tool.yaml', 'name: tool\n', self.manifest)
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        # The file is hashed again, but not rewritten.
+        self.assertFalse(entity_tree.write_if_changed(self.dir, 'tools/tool.yaml', 'name: tool\n', self.manifest))
+        self.assertEqual(self.manifest['tools/tool.yaml']['mtime_ns'], stat.st_mtime_ns + 1000000000)
+
+    def test_unchanged_file(self):
+        self.assertTrue(entity_tree.write_if_changed(self.dir, 'tools/tool.yaml', 'name: tool\n', self.manifest))
+        self.assertFalse(entity_tree.write_if_changed(self.dir, 'tools/tool.yaml', 'name: tool\n', self.manifest))
+        self.assertTrue(entity_tree.write_if_changed(self.dir, 'tools/tool.yaml', 'name: other\n', self.manifest))
+        self.assertEqual(self.read(), 'name: other\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
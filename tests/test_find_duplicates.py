@@ -0,0 +1,95 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Suggestions of find_duplicates.py for entities enriched by update-only sources."""
+
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import find_duplicates
+import yaml_io
+
+
+description = 'Loomio is a collaborative decision making tool that helps groups discuss and decide together online'
+script_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'find_duplicates.py')
+
+
+class FindDuplicatesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary_dir.cleanup)
+        os.makedirs(os.path.join(self.temporary_dir.name, 'tools'))
+
+    def find_duplicates(self):
+        output = subprocess.check_output([sys.executable, script_path, self.temporary_dir.name],
+            universal_newlines = True)
+        return yaml_io.load(output)
+
+    def test_common_update_only_source(self):
+        self.write_tool('loomio', civicstack = dict(name = 'Loomio'), wikidata = dict(label = 'Loomio'))
+        self.write_tool('loomio-app', **{'nuit-debout': dict(Outil = 'Loomio'), 'wikidata': dict(label = 'Loomio')})
+        suggestions = self.find_duplicates()
+        self.assertEqual([
+            (suggestion['canonical'], suggestion['duplicate'], suggestion['specificities'])
+            for suggestion in suggestions
+            ], [('loomio', 'loomio-app', {'nuit-debout': {'name': 'loomio-app'}})])
+
+    def test_common_source(self):
+        self.write_tool('loomio', civicstack = dict(name = 'Loomio'))
+        self.write_tool('loomio-app', civicstack = dict(name = 'Loomio app'))
+        self.assertEqual(self.find_duplicates(), [])
+
+    def test_update_only_source_of_duplicate(self):
+        self.write_tool('loomio', civicstack = dict(name = 'Loomio'), udd = dict(name = 'loomio'),
+            wikidata = dict(label = 'Loomio'))
+        self.write_tool('loomio-app', **{'nuit-debout': dict(Outil = 'Loomio'), 'udd': dict(name = 'loomio-app')})
+        suggestions = self.find_duplicates()
+        self.assertEqual(len(suggestions), 1)
+        self.assertEqual(suggestions[0]['specificities'], {'nuit-debout': {'name': 'loomio-app'}})
+
+    def test_update_only_sources_name(self):
+        try:
+            import merge
+        except ImportError:
+            self.skipTest('python-apt is required by merge.py')
+        self.assertEqual(find_duplicates.update_only_sources_name, set(
+            source_name
+            for source_name, source_config in merge.source_config_by_name.items()
+            if source_config.get('update_only', False)
+            ))
+
+    def write_tool(self, name, **source_entity_by_source_name):
+        entry = dict(
+            canonical = dict(
+                longDescription = dict(en = dict(sources = ['civicstack'], value = description)),
+                name = dict(sources = ['civicstack'], value = 'Loomio'),
+                ),
+            )
+        entry.update(source_entity_by_source_name)
+        with open(os.path.join(self.temporary_dir.name, 'tools', '{}.yaml'.format(name)), 'w') as yaml_file:
+            yaml_io.dump(entry, yaml_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Runs with worker processes (--jobs) must give trees byte-identical to serial runs."""
+
+
+import os
+import random
+import tempfile
+import unittest
+
+from tests import pipeline
+
+
+words = ['alpha', 'beta', 'café', 'civic', 'data', 'debate', 'delta', 'élan', 'map', 'open', 'participation', 'vote']
+
+
+def make_text(random_generator, words_count=12):
+    return ' '.join(random_generator.choice(words) for index in range(words_count))
+
+
+def write_corpus(source_dir, tools_count):
+    """Write sources with overlapping tools, the files of update-only sources and projects using tools."""
+    random_generator = random.Random(0)
+    text = lambda words_count=12: make_text(random_generator, words_count)
+    tools_name = ['tool-{}'.format(index) for index in range(tools_count)] + ['firefox', 'iceweasel', 'libfoo']
+    pipeline.write_source_dirs(source_dir)
+    write = lambda relative_path, data: pipeline.write_yaml(os.path.join(source_dir, relative_path), data)
+    for name in random_generator.sample(tools_name, len(tools_name) // 2):
+        write('civicstack-yaml/{}.yaml'.format(name), dict(description = dict(en = text(), fr = text()), name = name,
+            tags = [dict(name = dict(en = random_generator.choice(words)))]))
+    for name in random_generator.sample(tools_name, len(tools_name) // 2):
+        write('nuit-debout-yaml/{}.yaml'.format(name), {'Détails': text(), 'Fonction': random_generator.choice(words),
+            'Outil': name})
+    for name in random_generator.sample(tools_name, len(tools_name) // 3):
+        write('participatedb-yaml/tools/{}.yaml'.format(name), dict(Category = ['Voting'], Description = text(),
+            Name = name))
+    for index in range(tools_count // 4):
+        write('civic-graph-yaml/actor-{}.yaml'.format(index), dict(description = text(), name = 'Actor {}'.format(index)))
+        write('participatedb-yaml/projects/project-{}.yaml'.format(index), {'Description': text(),
+            'Name': 'Project {}'.format(index), 'Tools used': random_generator.sample(tools_name, 3) + ['Unknown']})
+    for name in tools_name + ['only-update']:
+        if random_generator.random() < 0.7:
+            write('wikidata-yaml/{}.yaml'.format(name), dict(description = [{'value': text(), 'xml:lang': 'en'}],
+                label = [dict(value = name.title())]))
+        versions = random_generator.sample(['1.0-1', '1.2-1', '1.10-1', '2:0.9-1', '1.2~rc1-1', '1.2+dfsg-1'], 3)
+        shard = name[:4] if name.startswith('lib') else name[0]
+        write('udd-yaml/packages/{}/{}.yaml'.format(shard, name), dict(releases = dict(jessie = dict(main = dict(
+            descriptions = {
+                'md5-{}'.format(version): dict(en = dict(long_description = '{} {}'.format(name, version)))
+                for version in versions
+                },
+            versions = {
+                version: dict(architectures = dict(all = dict(description_md5 = 'md5-{}'.format(version))))
+                for version in versions
+                },
+            )))))
+        if random_generator.random() < 0.3:
+            write('udd-yaml/sources/{}/{}.yaml'.format(shard, name), dict(security_issues = ['CVE-1']))
+
+
+class JobsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary_dir.cleanup)
+        self.source_dir = os.path.join(self.temporary_dir.name, 'sources')
+        write_corpus(self.source_dir, 300)
+
+    def get_path(self, name):
+        return os.path.join(self.temporary_dir.name, name)
+
+    def test_generate_canonical(self):
+        pipeline.run_script('merge.py', 'all', self.source_dir, self.get_path('merged'))
+        for jobs in ('1', '2'):
+            pipeline.run_script('generate_canonical.py', self.get_path('merged'),
+                self.get_path('canonical-{}'.format(jobs)), '--jobs', jobs)
+        self.assertGreater(len(os.listdir(self.get_path('canonical-1/tools'))), 200)
+        self.assertEqual(list(pipeline.iter_tree_differences(self.get_path('canonical-1'),
+            self.get_path('canonical-2'))), [])
+
+    def test_merge(self):
+        for jobs in ('1', '2'):
+            pipeline.run_script('merge.py', 'all', self.source_dir, self.get_path('merged-{}'.format(jobs)),
+                '--canonical-dir', self.get_path('canonical-{}'.format(jobs)), '--jobs', jobs)
+        self.assertGreater(len(os.listdir(self.get_path('merged-1/tools'))), 200)
+        self.assertEqual(list(pipeline.iter_tree_differences(self.get_path('merged-1'), self.get_path('merged-2'))),
+            [])
+        self.assertEqual(list(pipeline.iter_tree_differences(self.get_path('canonical-1'),
+            self.get_path('canonical-2'))), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Incremental merges (--incremental, driven by the git history of the sources) and single-source merges must give the
+same trees as full merges of all sources.
+"""
+
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from tests import pipeline
+
+
+def make_udd_package(name, *versions):
+    return dict(releases = dict(jessie = dict(main = dict(
+        descriptions = {
+            'md5-{}'.format(version): dict(en = dict(long_description = '{} {}'.format(name, version)))
+            for version in versions
+            },
+        versions = {
+            version: dict(architectures = dict(all = dict(description_md5 = 'md5-{}'.format(version))))
+            for version in versions
+            },
+        ))))
+
+
+@unittest.skipIf(shutil.which('git') is None, 'git is required')
+class IncrementalMergeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary_dir.cleanup)
+        self.source_dir = os.path.join(self.temporary_dir.name, 'sources')
+        self.specificities_dir = os.path.join(self.temporary_dir.name, 'specificities')
+        self.target_dir = os.path.join(self.temporary_dir.name, 'merged')
+        self.canonical_dir = os.path.join(self.temporary_dir.name, 'canonical')
+        pipeline.write_source_dirs(self.source_dir)
+        # Files of several sources are renamed into the "firefox" tool.
+        pipeline.write_yaml(os.path.join(self.specificities_dir, 'firefox.yaml'), {
+            'civicstack': dict(name = 'firefox-esr'),
+            'debian-appstream': dict(name = 'iceweasel'),
+            'udd': dict(name = 'iceweasel'),
+            })
+        self.write('civic-graph-yaml/actor-a.yaml', dict(description = 'Actor A', name = 'Actor A'))
+        self.write('civic-tech-field-guide-yaml/loomio.yaml', dict(category = 'Decision', name = 'Loomio'))
+        self.write('civicstack-yaml/decidim.yaml', dict(description = dict(en = 'Decidim'), name = 'Decidim'))
+        self.write('civicstack-yaml/firefox-esr.yaml', dict(description = dict(en = 'Firefox ESR'), name = 'Firefox'))
+        self.write('civicstack-yaml/loomio.yaml', dict(description = dict(en = 'Loomio'), name = 'Loomio'))
+        self.write('nuit-debout-yaml/firefox.yaml', {'Détails': 'Navigateur', 'Outil': 'Firefox'})
+        self.write('nuit-debout-yaml/framapad.yaml', {'Détails': 'Pad', 'Outil': 'Framapad'})
+        self.write('participatedb-yaml/projects/project-a.yaml', {'Name': 'Project A', 'Tools used': ['Loomio']})
+        self.write('participatedb-yaml/tools/decidim.yaml', dict(Description = 'Decidim', Name = 'Decidim'))
+        self.write('appstream-debian-yaml/iceweasel.yaml', dict(Categories = ['Network'], Name = dict(C = 'Iceweasel')))
+        # Both files of udd are merged into the "firefox" tool: the last one wins.
+        self.write('udd-yaml/packages/f/firefox.yaml', make_udd_package('firefox', '40.0-1'))
+        self.write('udd-yaml/packages/i/iceweasel.yaml', make_udd_package('iceweasel', '38.0-1', '45.0-1'))
+        self.write('udd-yaml/packages/l/loomio.yaml', make_udd_package('loomio', '1.0-1'))
+        self.write('udd-yaml/sources/l/loomio.yaml', dict(security_issues = ['CVE-1']))
+        self.write('wikidata-yaml/etherpad.yaml', dict(label = [dict(value = 'Etherpad')]))
+        self.write('wikidata-yaml/framapad.yaml', dict(label = [dict(value = 'Framapad')]))
+        self.write('wikidata-yaml/loomio.yaml', dict(label = [dict(value = 'Loomio')]))
+        for dir in self.iter_repository_dirs():
+            self.git(dir, 'init', '-q')
+        self.commit()
+
+    def assert_same_as_full_merge(self):
+        full_target_dir = os.path.join(self.temporary_dir.name, 'full-merged')
+        full_canonical_dir = os.path.join(self.temporary_dir.name, 'full-canonical')
+        for dir in (full_target_dir, full_canonical_dir):
+            if os.path.exists(dir):
+                shutil.rmtree(dir)
+        self.merge('all', full_target_dir, '--canonical-dir', full_canonical_dir)
+        self.assertEqual(list(pipeline.iter_tree_differences(full_target_dir, self.target_dir)), [])
+        self.assertEqual(list(pipeline.iter_tree_differences(full_canonical_dir, self.canonical_dir)), [])
+
+    def commit(self):
+        for dir in self.iter_repository_dirs():
+            self.git(dir, 'add', '-A')
+            self.git(dir, '-c', 'user.email=tests@example.org', '-c', 'user.name=Tests', 'commit', '-q',
+                '--allow-empty', '-m', 'Update')
+
+    def git(self, dir, *arguments):
+        subprocess.run(['git', '-C', dir] + list(arguments), check=True)
+
+    def iter_repository_dirs(self):
+        for name in sorted(os.listdir(self.source_dir)):
+            yield os.path.join(self.source_dir, name)
+
+    def merge(self, source_name, target_dir, *arguments):
+        return pipeline.run_script('merge.py', source_name, self.source_dir, target_dir, '--specificities-dir',
+            self.specificities_dir, *arguments)
+
+    def remove(self, relative_path):
+        os.remove(os.path.join(self.source_dir, relative_path))
+
+    def test_incremental(self):
+        self.merge('all', self.target_dir, '--canonical-dir', self.canonical_dir, '--incremental')
+        self.assert_same_as_full_merge()
+
+        # Add a tool that gets the existing data of an update-only source, modify renamed & update-only files (one of
+        # them being merged into the same entity as another file), and delete the only creator of a tool.
+        self.write('nuit-debout-yaml/etherpad.yaml', {'Détails': 'Pad', 'Outil': 'Etherpad'})
+        self.write('civicstack-yaml/firefox-esr.yaml', dict(description = dict(en = 'Firefox 45'), name = 'Firefox'))
+        self.write('udd-yaml/packages/f/firefox.yaml', make_udd_package('firefox', '41.0-1'))
+        self.write('wikidata-yaml/loomio.yaml', dict(label = [dict(value = 'Loomio (software)')]))
+        self.remove('nuit-debout-yaml/framapad.yaml')
+        self.commit()
+        output = self.merge('all', self.target_dir, '--canonical-dir', self.canonical_dir, '--incremental')
+        self.assertIn('Source civicstack: 1 changed files', output)
+        self.assertIn('Source civic-graph: unchanged', output)
+        self.assertTrue(os.path.exists(os.path.join(self.target_dir, 'tools', 'etherpad.yaml')))
+        self.assertFalse(os.path.exists(os.path.join(self.target_dir, 'tools', 'framapad.yaml')))
+        self.assert_same_as_full_merge()
+
+        self.write('udd-yaml/packages/i/iceweasel.yaml', make_udd_package('iceweasel', '45.0-1', '45.1~rc1-1'))
+        self.commit()
+        self.merge('all', self.target_dir, '--canonical-dir', self.canonical_dir, '--incremental')
+        self.assert_same_as_full_merge()
+
+        # Files modified without a commit: the sources are merged again completely.
+        self.write('civicstack-yaml/decidim.yaml', dict(description = dict(en = 'Decidim 2'), name = 'Decidim'))
+        self.remove('participatedb-yaml/tools/decidim.yaml')
+        self.merge('all', self.target_dir, '--canonical-dir', self.canonical_dir, '--incremental')
+        self.assert_same_as_full_merge()
+
+    def test_single_source(self):
+        self.merge('all', self.target_dir, '--canonical-dir', self.canonical_dir)
+        self.write('civicstack-yaml/firefox-esr.yaml', dict(description = dict(en = 'Firefox 45'), name = 'Firefox'))
+        self.remove('civicstack-yaml/decidim.yaml')
+        self.commit()
+        self.merge('civicstack', self.target_dir, '--canonical-dir', self.canonical_dir)
+        self.assert_same_as_full_merge()
+
+        self.write('wikidata-yaml/loomio.yaml', dict(label = [dict(value = 'Loomio (software)')]))
+        self.remove('wikidata-yaml/framapad.yaml')
+        self.commit()
+        self.merge('wikidata', self.target_dir, '--canonical-dir', self.canonical_dir)
+        self.assert_same_as_full_merge()
+
+    def write(self, relative_path, data):
+        pipeline.write_yaml(os.path.join(self.source_dir, relative_path), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
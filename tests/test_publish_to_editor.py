@@ -0,0 +1,153 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Tests of publish_to_editor.py (concurrency, failed requests & publish ledger) against a local stand-in editor."""
+
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import yaml_io
+
+from tests.editor_stand_in import EditorStandIn
+
+
+script_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'publish_to_editor.py')
+
+
+class PublishToEditorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary_dir.cleanup)
+        self.source_dir = os.path.join(self.temporary_dir.name, 'tools')
+        os.makedirs(self.source_dir)
+        self.ledger_path = os.path.join(self.temporary_dir.name, 'ledger.json')
+        self.report_path = os.path.join(self.temporary_dir.name, 'report.json')
+        for index in range(20):
+            self.write_tool(index)
+
+    def load_ledger(self, editor):
+        with open(self.ledger_path) as ledger_file:
+            return json.load(ledger_file)[editor.url]
+
+    def load_report_counters(self):
+        with open(self.report_path) as report_file:
+            return json.load(report_file)['counters']
+
+    def publish(self, editor, *arguments, ledger=True):
+        completed_process = subprocess.run(
+            [sys.executable, script_path, self.source_dir, editor.url, '-u', 'user', '-p', 'password', '--report',
+                self.report_path] + (['--ledger', self.ledger_path] if ledger else []) + list(arguments),
+            cwd = self.temporary_dir.name,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT,
+            universal_newlines = True,
+            )
+        self.assertEqual(completed_process.returncode, 0, completed_process.stdout)
+        return completed_process.stdout
+
+    def test_concurrent_requests(self):
+        with EditorStandIn(delay=0.05) as editor:
+            self.publish(editor, '--concurrency', '4')
+        self.assertEqual(editor.request_counts, {'POST /login': 1, 'GET /tools': 1, 'POST /tools': 20})
+        self.assertEqual(len(editor.tool_by_id), 20)
+        self.assertGreater(editor.max_in_flight_count, 1)
+        self.assertLessEqual(editor.max_in_flight_count, 4)
+
+    def test_default_ledger(self):
+        with EditorStandIn() as editor:
+            # Ledger written in the source directory by a previous version
+            self.ledger_path = os.path.join(self.source_dir, '.publish-ledger.json')
+            self.publish(editor)
+
+            # It is moved to the current directory and used.
+            editor.request_counts.clear()
+            output = self.publish(editor, ledger = False)
+            self.assertIn('Moving ledger', output)
+            self.assertEqual(editor.request_counts, {'POST /login': 1, 'GET /tools': 1})
+            self.assertFalse(os.path.exists(self.ledger_path))
+            self.ledger_path = os.path.join(self.temporary_dir.name, '.publish-ledger.json')
+            self.assertEqual(len(self.load_ledger(editor)), 20)
+
+            editor.request_counts.clear()
+            self.write_tool(5, license = 'MIT')
+            self.publish(editor, ledger = False)
+            self.assertEqual(editor.request_counts, {'POST /login': 1, 'GET /tools': 1, 'PUT /tools': 1})
+            self.assertEqual(os.listdir(self.source_dir).count('.publish-ledger.json'), 0)
+
+    def test_failed_requests(self):
+        with EditorStandIn(slow_delay=2, slow_names=['tool 3"']) as editor:
+            output = self.publish(editor, '--timeout', '0.5')
+        self.assertIn('Read timed out', output)
+        self.assertEqual(self.load_report_counters()['requests_failed'], 1)
+        ledger = self.load_ledger(editor)
+        self.assertNotIn('tool 3', ledger)
+        self.assertEqual(len(ledger), 19)
+
+    def test_ledger(self):
+        with EditorStandIn() as editor:
+            self.publish(editor)
+            ledger = self.load_ledger(editor)
+            self.assertEqual(sorted(ledger), sorted('tool {}'.format(index) for index in range(20)))
+
+            # Nothing changed: only the login & the listing of tools
+            editor.request_counts.clear()
+            self.publish(editor)
+            self.assertEqual(editor.request_counts, {'POST /login': 1, 'GET /tools': 1})
+
+            # Only the changed tool is sent.
+            editor.request_counts.clear()
+            self.write_tool(5, license = 'MIT')
+            self.publish(editor)
+            self.assertEqual(editor.request_counts, {'POST /login': 1, 'GET /tools': 1, 'PUT /tools': 1})
+            self.assertEqual(self.load_ledger(editor)['tool 5']['id'], ledger['tool 5']['id'])
+
+            # A tool removed from the editor is published again.
+            editor.request_counts.clear()
+            del editor.tool_by_id[ledger['tool 8']['id']]
+            self.publish(editor)
+            self.assertEqual(editor.request_counts, {'POST /login': 1, 'GET /tools': 1, 'POST /tools': 1})
+
+            # A removed YAML file leaves the ledger.
+            os.remove(os.path.join(self.source_dir, 'tool-0.yaml'))
+            self.publish(editor)
+            self.assertNotIn('tool 0', self.load_ledger(editor))
+
+    def write_tool(self, index, **canonical):
+        canonical['longDescription'] = dict(en = 'Description of tool {}'.format(index))
+        with open(os.path.join(self.source_dir, 'tool-{}.yaml'.format(index)), 'w') as yaml_file:
+            yaml_io.dump(dict(
+                canonical = {
+                    key: dict(value = value) if isinstance(value, str) else {
+                        language: dict(value = text)
+                        for language, text in value.items()
+                        }
+                    for key, value in canonical.items()
+                    },
+                name = 'tool {}'.format(index),
+                ), yaml_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
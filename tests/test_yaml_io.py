@@ -0,0 +1,121 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""Parity of yaml_io.dumps() (libyaml with fallbacks) with the pure Python emitter of PyYAML."""
+
+
+import collections
+import random
+import unittest
+
+import yaml
+
+import yaml_io
+
+
+# Characters that need escapes, or that are handled differently by libyaml & the pure Python emitter
+adversarial_characters = [
+    '\x00', '\x07', '\t', '\n', '\r', '\x1b', '\x7f', '\x85', '\xa0', ' ', ' ', '﻿', '\U0001f600',
+    ' ', '"', "'", '#', '&', '*', '-', ':', '?', '[', '\\', ']', '{', '|', '}', '>', '%', '@', '`', '!', ',',
+    'a', 'é', '中',
+    ]
+adversarial_strings = [
+    '', ' ', '  leading', 'trailing  ', '-', '- item', '? key', ': value', 'a: b', 'a #b', '#comment', '~', 'null',
+    'Null', 'true', 'yes', 'no', 'on', 'off', '0', '007', '0x1f', '1e3', '.inf', '-.5', '2016-01-02', '12:30:00',
+    '!tag', '&anchor', '*alias', '%YAML', '---', '...', '"quoted"', "'quoted'", 'line\nline', 'line\n\nline\n',
+    'a\rb', 'a\x07b', 'tab\tbed', 'wide \U0001f600', 'nel\x85', 'ls ps ', 'bom﻿', 'x' * 200,
+    ' '.join(['word'] * 60), 'Why? Because.', 'Quoi ?\nParce que.',
+    ]
+
+
+def make_random_document(random_generator, depth=0):
+    kind = random_generator.random()
+    if depth < 3 and kind < 0.3:
+        return collections.OrderedDict(
+            (make_random_string(random_generator), make_random_document(random_generator, depth + 1))
+            for index in range(random_generator.randint(0, 4))
+            )
+    if depth < 3 and kind < 0.45:
+        return [
+            make_random_document(random_generator, depth + 1)
+            for index in range(random_generator.randint(0, 4))
+            ]
+    if kind < 0.5:
+        return random_generator.choice([None, True, False, 0, -1, 42, 3.5])
+    return make_random_string(random_generator)
+
+
+def make_random_string(random_generator):
+    if random_generator.random() < 0.3:
+        return random_generator.choice(adversarial_strings)
+    return ''.join(
+        random_generator.choice(adversarial_characters)
+        for index in range(random_generator.randint(0, 12))
+        )
+
+
+@unittest.skipUnless(yaml.__with_libyaml__, 'libyaml is not available')
+class DumpsParityTestCase(unittest.TestCase):
+    def assert_parity(self, data):
+        self.assertEqual(yaml_io.dumps(data), yaml.dump(data, Dumper=yaml_io.PythonDumper, **yaml_io.dump_options))
+
+    def test_adversarial_keys(self):
+        for string in adversarial_strings + adversarial_characters:
+            with self.subTest(key=string):
+                self.assert_parity({string: 'value', 'nested': {string: [string]}})
+                self.assert_parity([{string: 1}])
+
+    def test_adversarial_values(self):
+        for string in adversarial_strings + adversarial_characters:
+            with self.subTest(value=string):
+                self.assert_parity(dict(value = string, values = [string, dict(value = string)]))
+                self.assert_parity(dict(folded = yaml_io.folded_str(string), literal = yaml_io.literal_str(string)))
+
+    def test_entity(self):
+        self.assert_parity(collections.OrderedDict([
+            ('canonical', collections.OrderedDict([
+                ('longDescription', dict(
+                    en = dict(source = 'debian', value = 'A web browser.\nFast & free: use it!'),
+                    fr = dict(source = 'nuit-debout', value = 'Navigateur « libre » — rapide'),
+                    )),
+                ('name', dict(source = 'wikidata', value = 'Firefox')),
+                ('tags', dict(en = [dict(sources = ['civicstack', 'wikidata'], value = 'Browser')])),
+                ])),
+            ('debian', dict(screenshot = dict(large_image_url = 'http://screenshots.debian.net/firefox.png'))),
+            ('wikidata', dict(label = [dict(value = 'Firefox', **{'xml:lang': 'en'})])),
+            ]))
+
+    def test_random_documents(self):
+        random_generator = random.Random(0)
+        for index in range(3000):
+            data = make_random_document(random_generator)
+            if not isinstance(data, (dict, list)):
+                data = [data]
+            with self.subTest(index=index):
+                self.assert_parity(data)
+
+    def test_scalar_documents(self):
+        for data in (None, '', 'text', 0, True):
+            with self.subTest(data=data):
+                self.assert_parity(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# merge-open-software-base-yaml -- Merge YAML files describing software
+# By: Emmanuel Raviart <emmanuel.raviart@data.gouv.fr>
+#
+# Copyright (C) 2015, 2016 Etalab
+# https://git.framasoft.org/codegouv/merge-open-software-base-yaml
+#
+# merge-open-software-base-yaml is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# merge-open-software-base-yaml is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http:>www.gnu.org/licenses/>.
+
+
+"""YAML configuration shared by all scripts: mappings are loaded as OrderedDict and dumped with sorted keys.
+
+libyaml (CSafeLoader & CDumper) is used when available, otherwise the pure Python implementation of PyYAML.
+"""
+
+
+import collections
+import logging
+import os
+import re
+
+import yaml
+
+
+# YAML configuration
+
+
+class folded_str(str):
+    pass
+
+
+class literal_str(str):
+    pass
+
+
+class PythonLoader(yaml.SafeLoader):
+    pass
+
+
+class PythonDumper(yaml.Dumper):
+    pass
+
+
+if yaml.__with_libyaml__:
+    class Loader(yaml.CSafeLoader):
+        pass
+
+    class Dumper(yaml.CDumper):
+        pass
+else:
+    Loader = PythonLoader
+    Dumper = PythonDumper
+
+
+def dict_constructor(loader, node):
+    return collections.OrderedDict(loader.construct_pairs(node))
+
+
+def dict_representer(dumper, data):
+    return dumper.represent_dict(sorted(data.items()))
+
+
+for loader_class in {Loader, PythonLoader}:
+    loader_class.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
+
+for dumper_class in {Dumper, PythonDumper}:
+    # libyaml only emits instances of str itself, not of its subclasses.
+    dumper_class.add_representer(folded_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
+        str(data), style='>'))
+    dumper_class.add_representer(literal_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
+        str(data), style='|'))
+    dumper_class.add_representer(dict, dict_representer)
+    dumper_class.add_representer(collections.OrderedDict, dict_representer)
+    dumper_class.add_representer(str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str', data))
+
+
+#
+
+
+dump_options = dict(allow_unicode=True, default_flow_style=False, indent=2, width=120)
+# Mapping keys that libyaml emits differently from the pure Python emitter: explicit keys ("? key" lines) for keys with
+# escaped characters, and simple keys for empty keys (that the pure Python emitter writes as explicit keys)
+libyaml_differing_key_re = re.compile(r"^[ -]*(\? |'':)", re.MULTILINE)
+# Escape sequences that libyaml emits for characters that the pure Python emitter writes as is (characters outside
+# the Basic Multilingual Plane, NEL, LS & PS).
+libyaml_only_escapes = ('\\U', '\\N', '\\L', '\\P')
+# Exceptions raised when loading a YAML file with an invalid syntax
+load_errors = (UnicodeDecodeError, yaml.YAMLError)
+log = logging.getLogger(__name__)
+
+
+def dump(data, stream):
+    stream.write(dumps(data))
+
+
+def dumps(data):
+    if not isinstance(data, (dict, list)):
+        # libyaml doesn't end a document made of a single scalar (like the None of an empty file) with "...".
+        return yaml.dump(data, Dumper=PythonDumper, **dump_options)
+    text = yaml.dump(data, Dumper=Dumper, **dump_options)
+    if Dumper is not PythonDumper and (any(escape in text for escape in libyaml_only_escapes)
+            or libyaml_differing_key_re.search(text) is not None):
+        # Keep output byte-identical to the pure Python emitter.
+        text = yaml.dump(data, Dumper=PythonDumper, **dump_options)
+    return text
+
+
+def iter_yaml_files(dir, stats=None):
+    """Iterate over the (path, data) couples of the YAML files of dir.
+
+    When stats (a collections.Counter) is given, it counts files scanned & parsed, bytes read and parse failures.
+    """
+    for yaml_file_path in iter_yaml_paths(dir):
+        if stats is not None:
+            stats['files_scanned'] += 1
+            stats['bytes_read'] += os.path.getsize(yaml_file_path)
+        try:
+            data = load_file(yaml_file_path)
+        except load_errors:
+            log.warning("Invalid syntax in YAML file {}".format(yaml_file_path))
+            if stats is not None:
+                stats['parse_failures'] += 1
+            continue
+        if stats is not None:
+            stats['files_parsed'] += 1
+        yield yaml_file_path, data
+
+
+def iter_yaml_paths(dir):
+    """Iterate over the paths of the YAML files of dir, skipping hidden directories."""
+    assert os.path.exists(dir), "Directory doesn't exist: {}".format(dir)
+    for sub_dir, dirs_name, filenames in os.walk(dir):
+        for dir_name in dirs_name[:]:
+            if dir_name.startswith('.'):
+                dirs_name.remove(dir_name)
+        for filename in filenames:
+            if not filename.endswith(".yaml"):
+                continue
+            yield os.path.join(sub_dir, filename)
+
+
+def load(stream):
+    return yaml.load(stream, Loader=Loader)
+
+
+def load_file(yaml_path):
+    # Let libyaml decode the UTF-8 bytes itself.
+    with open(yaml_path, 'rb') as yaml_file:
+        return load(yaml_file)
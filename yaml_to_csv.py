@@ -21,46 +21,25 @@
 # along with this program.  If not, see <http:>www.gnu.org/licenses/>.
 
 
-"""Convert a directory of YAML files to a single CSV file."""
+"""Convert a directory of YAML files to a single CSV file.
+
+Each YAML file is flattened to a row, with a column for each path of a scalar value. Paths are interned into column
+ids when they are discovered, and each row is kept as a compact sparse couple (array of column ids, values). With the
+--streaming option, rows are not kept at all: a first pass discovers the columns and a second pass reads the YAML files
+again to write their rows.
+"""
 
 
 import argparse
-import collections
+import array
 import csv
+import json
 import logging
 import os
 import sys
 
-import yaml, yaml.constructor, yaml.parser, yaml.scanner
-
-
-# YAML configuration
-
-
-class folded_str(str):
-    pass
-
-
-class literal_str(str):
-    pass
-
-
-def dict_constructor(loader, node):
-    return collections.OrderedDict(loader.construct_pairs(node))
-
-
-def dict_representer(dumper, data):
-    return dumper.represent_dict(sorted(data.items()))
-
-
-yaml.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, dict_constructor)
-
-yaml.add_representer(folded_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='>'))
-yaml.add_representer(literal_str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str',
-    data, style='|'))
-yaml.add_representer(collections.OrderedDict, dict_representer)
-yaml.add_representer(str, lambda dumper, data: dumper.represent_scalar(u'tag:yaml.org,2002:str', data))
+import item_path
+import yaml_io
 
 
 #
@@ -71,80 +50,114 @@ args = None
 log = logging.getLogger(app_name)
 
 
-def flatten(paths, flat, path, data):
-    if isinstance(data, dict):
-        for key, value in data.items():
-            flatten(paths, flat, path + (key,), value)
-    elif isinstance(data, list):
-        for index, value in enumerate(data):
-            flatten(paths, flat, path + (index,), value)
+def flatten(data, column_id_by_path, max_depth=None, include_prefixes=None):
+    """Return the sparse row of data: an array of column ids and the list of their values.
+
+    New paths are added to column_id_by_path. Data deeper than max_depth is written as JSON in a single column. When
+    include_prefixes (a list of path tuples) is given, only the subtrees at these paths are flattened.
+    """
+    column_ids = array.array('L')
+    values = []
+    for path, value in iter_flat_items(data, (), max_depth, include_prefixes):
+        column_id = column_id_by_path.get(path)
+        if column_id is None:
+            column_id = column_id_by_path[path] = len(column_id_by_path)
+        column_ids.append(column_id)
+        values.append(value)
+    return column_ids, values
+
+
+def get_label(path):
+    label_fragments = []
+    for path_fragment in path:
+        if isinstance(path_fragment, str):
+            if label_fragments:
+                label_fragments.append('.')
+            label_fragments.append(path_fragment)
+        else:
+            assert isinstance(path_fragment, int), path_fragment
+            label_fragments.append('[{}]'.format(path_fragment))
+    return ''.join(label_fragments)
+
+
+def iter_flat_items(data, path, max_depth, include_prefixes):
+    if include_prefixes is not None:
+        if not any(path[:len(prefix)] == prefix for prefix in include_prefixes):
+            if not any(prefix[:len(path)] == path for prefix in include_prefixes):
+                # Neither in nor above an included subtree
+                return
+            if not isinstance(data, (dict, list)):
+                return
+    if isinstance(data, (dict, list)):
+        if max_depth is not None and len(path) >= max_depth:
+            yield path, json.dumps(data, default=str, ensure_ascii=False)
+            return
+        items = data.items() if isinstance(data, dict) else enumerate(data)
+        for key, value in items:
+            yield from iter_flat_items(value, path + (key,), max_depth, include_prefixes)
     elif isinstance(data, str):
         if path:
-            paths.add(path)
-        flat[path] = data
+            yield path, data
     elif data is not None:
         if path:
-            paths.add(path)
-        flat[path] = str(data)
-
-
-def iter_yaml_files(dir):
-    assert os.path.exists(dir), "Directory doesn't exist: {}".format(dir)
-    for sub_dir, dirs_name, filenames in os.walk(dir):
-        for dir_name in dirs_name[:]:
-            if dir_name.startswith('.'):
-                dirs_name.remove(dir_name)
-        for filename in filenames:
-            if not filename.endswith(".yaml"):
-                continue
-            yaml_file_path = os.path.join(sub_dir, filename)
-            with open(yaml_file_path) as yaml_file:
-                try:
-                    yield yaml_file_path, yaml.load(yaml_file)
-                except (UnicodeDecodeError, yaml.constructor.ConstructorError, yaml.parser.ParserError,
-                        yaml.scanner.ScannerError):
-                    log.warning("Invalid syntax in YAML file {}".format(yaml_file_path))
+            yield path, str(data)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('source_dir', help='path of YAML data directory')
     parser.add_argument('target_path', help='name of generated CSV file')
+    parser.add_argument('-d', '--max-depth', dest='max_depth', type=int,
+        help='maximum depth of flattened paths, deeper data being written as JSON')
+    parser.add_argument('-i', '--include-prefix', action='append', dest='include_prefixes',
+        help='dotted path (like "wikidata.license_label") of a subtree to flatten, the others being ignored'
+            ' (repeatable)')
+    parser.add_argument('-s', '--streaming', action='store_true', default=False,
+        help='read the YAML files twice (to discover columns, then to write rows) instead of keeping rows in memory')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='increase output verbosity')
     global args
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stdout)
 
-    paths = set()
+    assert args.max_depth is None or args.max_depth > 0, args.max_depth
+    include_prefixes = [
+        item_path.compile_path(include_prefix).keys
+        for include_prefix in args.include_prefixes
+        ] if args.include_prefixes else None
+
+    column_id_by_path = {}
     rows = []
-    for source_data_path, source_data in iter_yaml_files(args.source_dir):
-        flat = {}
-        flatten(paths, flat, (), source_data)
-        rows.append(flat)
-
-    labels = []
-    paths = sorted(paths)
-    for path in paths:
-        label_fragments = []
-        for path_fragment in path:
-            if isinstance(path_fragment, str):
-                if label_fragments:
-                    label_fragments.append('.')
-                label_fragments.append(path_fragment)
-            else:
-                assert isinstance(path_fragment, int), path_fragment
-                label_fragments.append('[{}]'.format(path_fragment))
-        labels.append(''.join(label_fragments))
+    for source_data_path, source_data in yaml_io.iter_yaml_files(args.source_dir):
+        row = flatten(source_data, column_id_by_path, args.max_depth, include_prefixes)
+        if not args.streaming:
+            rows.append(row)
+
+    paths = sorted(column_id_by_path)
+    log.info('{} columns'.format(len(paths)))
+    position_by_column_id = array.array('L', [0]) * len(paths)
+    for position, path in enumerate(paths):
+        position_by_column_id[column_id_by_path[path]] = position
+    if args.streaming:
+        rows = (
+            flatten(source_data, column_id_by_path, args.max_depth, include_prefixes)
+            for source_data_path, source_data in yaml_io.iter_yaml_files(args.source_dir)
+            )
 
     with open(args.target_path, 'w') as target_file:
         csv_writer = csv.writer(target_file)
-        csv_writer.writerow(labels)
-        for row in rows:
-            csv_writer.writerow([
-                row[path] if path in row else ''
-                for path in paths
-                ])
+        csv_writer.writerow([
+            get_label(path)
+            for path in paths
+            ])
+        for column_ids, values in rows:
+            cells = [''] * len(paths)
+            for column_id, value in zip(column_ids, values):
+                if column_id >= len(position_by_column_id):
+                    # Path of a YAML file modified between the two passes
+                    continue
+                cells[position_by_column_id[column_id]] = value
+            csv_writer.writerow(cells)
     return 0
 
 